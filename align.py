@@ -0,0 +1,156 @@
+import bisect
+import re
+from config import *
+from checkpoint import atomic_output
+
+# 中日韩文字和全角标点（text 模块估算 token 数时也使用）
+CJK_CHAR = re.compile(r'[\u3000-\u303f\u3400-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+class IntervalIndex:
+    """按起始时间排序的区间索引，用二分查找定位时间点所在的区间
+
+    区间 i 覆盖 [starts[i], starts[i+1])，最后一个区间一直延伸到视频结尾。
+    构建 O(n)，每次查询 O(log n)。
+    """
+    def __init__(self, starts):
+        # 起始时间必须单调不减，个别乱序的片段按前一个片段的起始时间处理
+        self.starts = []
+        for start in starts:
+            self.starts.append(max(start, self.starts[-1]) if self.starts else start)
+
+    def find(self, t):
+        """返回包含时间 t 的区间序号，t 早于第一个区间时返回0"""
+        return max(bisect.bisect_right(self.starts, t) - 1, 0)
+
+def content_length(text):
+    """去掉标点、空白和 Markdown 标记后的字符数，用于在改写前后的文本之间按比例对应位置"""
+    return len(re.sub(r'[\W_]+', '', text))
+
+def split_paragraphs(text):
+    """按空行切分段落"""
+    return [p.strip() for p in re.split(r'\n\s*\n', text) if p.strip()]
+
+def is_heading(paragraph):
+    return paragraph.startswith('#')
+
+def paragraph_times(paragraphs, segments):
+    """估计每个段落开始朗读的时间
+
+    LLM 改写会保持原文顺序，因此段落在处理后文本中的相对位置近似等于它在转录原文中的相对位置。
+    先按段落之前的字符数比例换算到原文中的字符偏移，再二分查找该偏移所在的片段，
+    在片段内按字符比例插值得到时间。
+
+    Args:
+        paragraphs (list): 处理后文本的段落
+        segments (list): 转录片段 [{'start', 'end', 'text'}]，按时间顺序
+
+    Returns:
+        list: 每个段落的起始时间（秒）
+    """
+    if not paragraphs or not segments:
+        return [0.0] * len(paragraphs)
+
+    segment_offsets = []
+    total = 0
+    for seg in segments:
+        segment_offsets.append(total)
+        total += content_length(seg['text'])
+
+    paragraph_total = sum(content_length(p) for p in paragraphs) or 1
+    times = []
+    offset = 0
+    for paragraph in paragraphs:
+        raw_offset = offset / paragraph_total * total
+        i = max(bisect.bisect_right(segment_offsets, raw_offset) - 1, 0)
+        seg = segments[i]
+        fraction = (raw_offset - segment_offsets[i]) / max(content_length(seg['text']), 1)
+        times.append(seg['start'] + min(fraction, 1.0) * (seg['end'] - seg['start']))
+        offset += content_length(paragraph)
+    return times
+
+
+def join_segment_texts(texts):
+    """拼接片段文本：中日韩文字之间不加空格，其他语言以空格分隔"""
+    result = ''
+    for text in texts:
+        if result and not (CJK_CHAR.match(result[-1]) and CJK_CHAR.match(text[0])):
+            result += ' '
+        result += text
+    return result
+
+def segment_paragraphs(segments, positions):
+    """没有经过 LLM 处理时，在关键帧的时间点把转录片段分成段落
+
+    Returns:
+        tuple: (段落列表, 每个段落的起始时间列表)
+    """
+    if not segments:
+        return [], []
+    index = IntervalIndex(seg['start'] for seg in segments)
+    breaks = sorted({0} | {index.find(position) for position in positions})
+    breaks.append(len(segments))
+    paragraphs, times = [], []
+    for begin, end in zip(breaks, breaks[1:]):
+        if begin < end:
+            paragraphs.append(join_segment_texts([seg['text'] for seg in segments[begin:end]]))
+            times.append(segments[begin]['start'])
+    return paragraphs, times
+
+def place_frames(times, positions):
+    """将每个关键帧分配到朗读时间包含其时间位置的段落
+
+    Args:
+        times (list): 段落起始时间，按顺序
+        positions (list): 关键帧时间位置
+
+    Returns:
+        list: 每个段落对应的关键帧序号列表（按时间顺序）
+    """
+    placement = [[] for _ in times]
+    if not times:
+        return placement
+    index = IntervalIndex(times)
+    for i in sorted(range(len(positions)), key=lambda i: positions[i]):
+        placement[index.find(positions[i])].append(i)
+    return placement
+
+def format_subtitle_timestamp(seconds, separator):
+    milliseconds = int(round(max(seconds, 0) * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600 * 1000)
+    minutes, milliseconds = divmod(milliseconds, 60 * 1000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{milliseconds:03d}"
+
+def render_subtitles(segments, fmt):
+    """将转录片段渲染为 SRT 或 WebVTT 字幕文本"""
+    if fmt not in ('srt', 'vtt'):
+        raise ValueError(f"不支持的字幕格式: {fmt}")
+    separator = ',' if fmt == 'srt' else '.'
+    lines = ['WEBVTT', ''] if fmt == 'vtt' else []
+    for i, seg in enumerate(segments, 1):
+        if fmt == 'srt':
+            lines.append(str(i))
+        lines.append(f"{format_subtitle_timestamp(seg['start'], separator)} --> "
+                     f"{format_subtitle_timestamp(seg['end'], separator)}")
+        lines.extend([seg['text'], ''])
+    return '\n'.join(lines)
+
+def write_subtitles(segments, base_path, formats=SUBTITLE_FORMATS):
+    """生成与 Markdown 文件同名的字幕文件（先写临时文件再原子重命名）
+
+    Args:
+        segments (list): 转录片段
+        base_path (str): 不含扩展名的输出路径
+        formats (list): 字幕格式，'srt' 和/或 'vtt'
+
+    Returns:
+        list: 生成的字幕文件路径
+    """
+    paths = []
+    for fmt in formats:
+        path = f"{base_path}.{fmt}"
+        with atomic_output(path) as tmp_path:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(render_subtitles(segments, fmt))
+        paths.append(path)
+    return paths
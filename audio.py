@@ -1,7 +1,19 @@
 import ffmpeg
 import requests
+import io
 import os
+import re
+import subprocess
+import threading
+import wave
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from config import *
+from net import get_session, post_with_retries, MultipartFile
+from checkpoint import atomic_output, temp_path_for
+from metrics import in_current_context
+from governor import ffmpeg_input_kwargs
 
 def extract_audio_from_video(video_path, audio_path):
     """从视频中提取音频并转换为指定采样率的 WAV 格式
@@ -14,25 +26,39 @@ def extract_audio_from_video(video_path, audio_path):
         Exception: 音频提取失败时抛出异常
     """
     try:
-        # 确保输出目录存在
-        os.makedirs(os.path.dirname(audio_path), exist_ok=True)
-        
-        # 配置ffmpeg流
-        stream = ffmpeg.input(video_path)
-        stream = ffmpeg.output(stream, 
-                             audio_path, 
-                             ar=AUDIO_SAMPLE_RATE,  # 设置采样率
-                             acodec=AUDIO_CODEC)    # 设置音频编码
-        
-        # 执行转换
-        ffmpeg.run(stream, overwrite_output=True)
-        
-        if not os.path.exists(audio_path):
-            raise Exception("音频文件未生成")
+        # 先输出到同目录的临时文件，完成后再重命名，避免中断时留下不完整的音频文件
+        with atomic_output(audio_path) as tmp_path:
+            # 配置ffmpeg流
+            stream = ffmpeg.input(video_path, **ffmpeg_input_kwargs())
+            stream = ffmpeg.output(stream, 
+                                 tmp_path, 
+                                 ar=AUDIO_SAMPLE_RATE,  # 设置采样率
+                                 acodec=AUDIO_CODEC)    # 设置音频编码
+            
+            # 执行转换
+            ffmpeg.run(stream, overwrite_output=True)
+            
+            if not os.path.exists(tmp_path):
+                raise Exception("音频文件未生成")
             
     except Exception as e:
         raise Exception(f"音频提取失败: {str(e)}")
 
+def parse_transcription(result):
+    """解析 whisper-server 的 verbose_json 响应
+    
+    Returns:
+        dict: {'text': 文本, 'segments': [{'start', 'end', 'text'}]}，服务器没有返回分段信息时片段为空
+    """
+    if 'text' not in result:
+        raise Exception("Whisper服务器返回的数据格式不正确")
+    segments = [
+        {'start': float(seg['start']), 'end': float(seg['end']), 'text': seg['text'].strip()}
+        for seg in result.get('segments') or []
+        if seg.get('text', '').strip()
+    ]
+    return {'text': result['text'], 'segments': segments}
+
 def transcribe_audio_with_whisper_server(audio_path):
     """使用 whisper-server 转录音频
     
@@ -40,7 +66,7 @@ def transcribe_audio_with_whisper_server(audio_path):
         audio_path (str): 音频文件路径
         
     Returns:
-        str: 转录的文本
+        dict: {'text': 转录的文本, 'segments': [{'start', 'end', 'text'}]}
         
     Raises:
         Exception: 转录失败时抛出异常
@@ -49,32 +75,401 @@ def transcribe_audio_with_whisper_server(audio_path):
         if not os.path.exists(audio_path):
             raise FileNotFoundError(f"音频文件不存在: {audio_path}")
             
-        with open(audio_path, 'rb') as audio_file:
-            files = {
-                'file': ('audio.wav', audio_file, 'audio/wav')
-            }
-            data = {
-                'temperature': '0.0',
-                'temperature_inc': '0.2',
-                'response_format': 'json'
-            }
-            
-            # 发送请求到Whisper服务器
-            response = requests.post(WHISPER_SERVER_URL, 
-                                  files=files, 
-                                  data=data)
-            
-            if response.status_code != 200:
-                raise Exception(f"Whisper服务器错误: {response.text}")
-                
-            result = response.json()
-            if 'text' not in result:
-                raise Exception("Whisper服务器返回的数据格式不正确")
-                
-            print("音频转录完成")
-            return result['text']
+        # 流式上传，每次重试重新读取文件，不在内存中保留整个 WAV
+        body = MultipartFile('file', audio_path, 'audio/wav', filename='audio.wav', fields={
+            'temperature': '0.0',
+            'temperature_inc': '0.2',
+            'response_format': 'verbose_json'
+        })
+        # 通过共享会话发送，服务模式下复用与Whisper服务器的长连接
+        response = post_with_retries(
+            get_session('whisper', WHISPER_CONCURRENCY), WHISPER_SERVER_URL,
+            retries=WHISPER_RETRIES,
+            data=body,
+            headers={'Content-Type': body.content_type},
+            timeout=WHISPER_TIMEOUT)
+        
+        if response.status_code != 200:
+            raise Exception(f"Whisper服务器错误: {response.text}")
             
+        result = parse_transcription(response.json())
+        print("音频转录完成")
+        return result
+        
     except requests.exceptions.RequestException as e:
         raise Exception(f"Whisper服务器连接失败: {str(e)}")
     except Exception as e:
         raise Exception(f"音频转录失败: {str(e)}")
+
+def find_silence(pcm, sample_rate, channels, frame_ms=20):
+    """在一段 PCM 数据中找到能量最低的位置
+    
+    Args:
+        pcm (bytes): s16le 格式的 PCM 数据
+        sample_rate (int): 采样率
+        channels (int): 声道数
+        frame_ms (int): 计算能量的窗口长度（毫秒）
+        
+    Returns:
+        int: 能量最低窗口中心所在的采样帧序号（相对于 pcm 开头）
+    """
+    samples = np.frombuffer(pcm, dtype='<i2').reshape(-1, channels).astype(np.float32).mean(axis=1)
+    frame_len = max(int(sample_rate * frame_ms / 1000), 1)
+    n_frames = len(samples) // frame_len
+    if n_frames == 0:
+        return len(samples)
+    energy = (samples[:n_frames * frame_len].reshape(n_frames, frame_len) ** 2).mean(axis=1)
+    return int(np.argmin(energy)) * frame_len + frame_len // 2
+
+def iter_pcm_chunks(read, sample_rate, channels=1, window=WHISPER_CHUNK_SECONDS,
+                    overlap=WHISPER_CHUNK_OVERLAP, split_mode=WHISPER_SPLIT_MODE,
+                    silence_search=WHISPER_SILENCE_SEARCH):
+    """将顺序读取的 PCM 数据切分为带重叠的音频块
+    
+    只缓存一个窗口加重叠部分的数据，可以用于文件或 ffmpeg 管道等任意顺序数据源。
+    
+    Args:
+        read (callable): read(n) 返回最多 n 字节的 s16le PCM 数据，返回空bytes表示结束
+        sample_rate (int): 采样率
+        channels (int): 声道数
+        window (float): 每块的目标时长（秒）
+        overlap (float): 相邻块之间的重叠时长（秒）
+        split_mode (str): 'fixed' 按固定窗口切分，'silence' 在窗口末尾附近的静音处切分
+        silence_search (float): 静音切分时，在窗口末尾向前搜索的时长（秒）
+        
+    Yields:
+        tuple: (块起始时间（秒）, 块的 PCM 数据)
+    """
+    if split_mode not in ('fixed', 'silence'):
+        raise ValueError(f"不支持的音频切分方式: {split_mode}")
+    
+    frame_bytes = 2 * channels
+    window_frames = int(window * sample_rate)
+    overlap_frames = int(overlap * sample_rate)
+    search_frames = min(int(silence_search * sample_rate), window_frames // 2)
+    needed = (window_frames + overlap_frames) * frame_bytes
+    
+    buffer = bytearray()
+    offset = 0  # buffer 开头对应的采样帧序号
+    eof = False
+    while True:
+        while not eof and len(buffer) < needed:
+            data = read(needed - len(buffer))
+            if not data:
+                eof = True
+            else:
+                buffer += data
+        
+        if eof and len(buffer) <= needed:
+            usable = len(buffer) - len(buffer) % frame_bytes
+            if usable:
+                yield offset / sample_rate, bytes(buffer[:usable])
+            return
+        
+        cut = window_frames
+        if split_mode == 'silence' and search_frames:
+            search_start = (window_frames - search_frames) * frame_bytes
+            cut = window_frames - search_frames + find_silence(
+                bytes(buffer[search_start:window_frames * frame_bytes]), sample_rate, channels)
+        
+        yield offset / sample_rate, bytes(buffer[:(cut + overlap_frames) * frame_bytes])
+        del buffer[:cut * frame_bytes]
+        offset += cut
+
+def encode_wav(pcm, sample_rate, channels=1):
+    """将 s16le PCM 数据封装为 WAV 格式"""
+    output = io.BytesIO()
+    with wave.open(output, 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm)
+    return output.getvalue()
+
+UPLOAD_FORMATS = {
+    # 格式: (ffmpeg输出参数, 上传文件名, Content-Type)
+    'flac': (['-c:a', 'flac', '-f', 'flac'], 'audio.flac', 'audio/flac'),
+    'opus': (['-c:a', 'libopus', '-b:a', WHISPER_OPUS_BITRATE, '-f', 'ogg'], 'audio.ogg', 'audio/ogg'),
+}
+
+def encode_audio_chunk(pcm, sample_rate, channels=1, upload_format=WHISPER_UPLOAD_FORMAT):
+    """将 PCM 数据编码为上传格式
+    
+    Args:
+        pcm (bytes): s16le 格式的 PCM 数据
+        sample_rate (int): 采样率
+        channels (int): 声道数
+        upload_format (str): 'wav'、'flac' 或 'opus'
+        
+    Returns:
+        tuple: (编码后的数据, 上传文件名, Content-Type)
+    """
+    if upload_format == 'wav':
+        return encode_wav(pcm, sample_rate, channels), 'audio.wav', 'audio/wav'
+    if upload_format not in UPLOAD_FORMATS:
+        raise ValueError(f"不支持的上传格式: {upload_format}")
+    
+    output_args, filename, content_type = UPLOAD_FORMATS[upload_format]
+    process = subprocess.run(
+        ['ffmpeg', '-nostdin', '-loglevel', 'error',
+         '-f', 's16le', '-ar', str(sample_rate), '-ac', str(channels), '-i', 'pipe:0',
+         *output_args, 'pipe:1'],
+        input=pcm, capture_output=True)
+    if process.returncode != 0:
+        raise Exception(f"音频编码失败: {process.stderr.decode('utf-8', 'replace')}")
+    return process.stdout, filename, content_type
+
+def transcribe_encoded_chunk(pcm, sample_rate, channels=1):
+    """编码并转录单个音频块（在线程池中执行，编码与上传都可以并行）"""
+    return transcribe_chunk(*encode_audio_chunk(pcm, sample_rate, channels, WHISPER_UPLOAD_FORMAT))
+
+def transcribe_chunk(data, filename='audio.wav', content_type='audio/wav'):
+    """转录单个音频块
+    
+    Args:
+        data (bytes): 编码后的音频数据
+        
+    Returns:
+        dict: {'text': 文本, 'segments': [{'start', 'end', 'text'}]}，时间相对于块开头
+    """
+    session = get_session('whisper', WHISPER_CONCURRENCY)
+    response = post_with_retries(
+        session, WHISPER_SERVER_URL,
+        retries=WHISPER_RETRIES,
+        files={'file': (filename, data, content_type)},
+        data={
+            'temperature': '0.0',
+            'temperature_inc': '0.2',
+            'response_format': 'verbose_json'
+        },
+        timeout=WHISPER_TIMEOUT)
+    
+    if response.status_code != 200:
+        raise Exception(f"Whisper服务器错误: {response.text}")
+    
+    return parse_transcription(response.json())
+
+def normalize_segment_text(text):
+    """去掉标点和空白后用于比较重复片段"""
+    return re.sub(r'[\W_]+', '', text).lower()
+
+def stitch_segments(chunks):
+    """拼接各块的转录结果
+    
+    相邻块在重叠区间内会重复转录同一段语音。以重叠区间的中点为分界，
+    每个片段只保留在其中心时间所属的块中；时间戳不准时同一句话可能两块都保留，
+    因此后一块中开始于重叠区间内的片段，与前一块落在重叠区间内的片段文本相同时丢弃。
+    只在块的边界处比较，语音中真实重复的句子不受影响。
+    
+    Args:
+        chunks (list): [(块起始时间, 块结束时间, 转录结果)]，按时间顺序
+        
+    Returns:
+        list: 带绝对时间戳的片段列表
+    """
+    segments = []
+    previous = []  # 前一块保留的片段
+    for i, (start, end, result) in enumerate(chunks):
+        lower = (chunks[i - 1][1] + start) / 2 if i > 0 else float('-inf')
+        upper = (end + chunks[i + 1][0]) / 2 if i + 1 < len(chunks) else float('inf')
+        overlap_end = chunks[i - 1][1] if i > 0 else start
+        overlap_texts = {normalize_segment_text(seg['text']) for seg in previous if seg['end'] > start}
+        
+        chunk_segments = result['segments']
+        if not chunk_segments and result['text'].strip():
+            # 服务器没有返回分段信息时，整块作为一个片段
+            chunk_segments = [{'start': 0.0, 'end': end - start, 'text': result['text'].strip()}]
+        
+        kept = []
+        for seg in chunk_segments:
+            seg_start, seg_end = start + seg['start'], start + seg['end']
+            if not lower <= (seg_start + seg_end) / 2 < upper:
+                continue
+            if seg_start < overlap_end and normalize_segment_text(seg['text']) in overlap_texts:
+                continue
+            kept.append({'start': seg_start, 'end': seg_end, 'text': seg['text']})
+        segments.extend(kept)
+        previous = kept
+    return segments
+
+def transcribe_pcm_stream(read, sample_rate, channels=1):
+    """将顺序读取的 PCM 数据分块并发转录
+    
+    正在上传或等待中的块不超过 WHISPER_CONCURRENCY 的两倍，内存占用与音频总长度无关。
+    
+    Args:
+        read (callable): read(n) 返回最多 n 字节的 s16le PCM 数据
+        sample_rate (int): 采样率
+        channels (int): 声道数
+        
+    Returns:
+        dict: {'text': 完整文本, 'segments': 带绝对时间戳的片段列表}
+    """
+    chunks = []
+    pending = deque()
+    
+    def collect():
+        start, end, future = pending.popleft()
+        chunks.append((start, end, future.result()))
+    
+    # 在当前阶段的上下文中执行，以便统计远程请求耗时
+    transcribe = in_current_context(transcribe_encoded_chunk)
+    with ThreadPoolExecutor(max_workers=WHISPER_CONCURRENCY) as executor:
+        for start, pcm in iter_pcm_chunks(read, sample_rate, channels, WHISPER_CHUNK_SECONDS, WHISPER_CHUNK_OVERLAP,
+                                          WHISPER_SPLIT_MODE, WHISPER_SILENCE_SEARCH):
+            end = start + len(pcm) / (2 * channels * sample_rate)
+            pending.append((start, end, executor.submit(transcribe, pcm, sample_rate, channels)))
+            while len(pending) > WHISPER_CONCURRENCY * 2:
+                collect()
+        while pending:
+            collect()
+    
+    segments = stitch_segments(chunks)
+    print(f"音频转录完成，共 {len(chunks)} 块，{len(segments)} 个片段")
+    return {'text': ' '.join(seg['text'] for seg in segments), 'segments': segments}
+
+def transcribe_audio_chunked(audio_path):
+    """将 WAV 音频切块后并发发送到 whisper-server 转录
+    
+    Args:
+        audio_path (str): s16le 编码的 WAV 文件路径
+        
+    Returns:
+        dict: {'text': 完整文本, 'segments': [{'start', 'end', 'text'}]}
+        
+    Raises:
+        Exception: 转录失败时抛出异常
+    """
+    try:
+        if not os.path.exists(audio_path):
+            raise FileNotFoundError(f"音频文件不存在: {audio_path}")
+        
+        with wave.open(audio_path, 'rb') as wav:
+            if wav.getsampwidth() != 2:
+                raise Exception("仅支持16位PCM编码的WAV文件")
+            frame_bytes = 2 * wav.getnchannels()
+            return transcribe_pcm_stream(lambda n: wav.readframes(n // frame_bytes),
+                                         wav.getframerate(), wav.getnchannels())
+    
+    except requests.exceptions.RequestException as e:
+        raise Exception(f"Whisper服务器连接失败: {str(e)}")
+    except Exception as e:
+        raise Exception(f"音频转录失败: {str(e)}")
+
+def transcribe_audio(audio_path):
+    """按配置选择整段或分块方式转录音频
+    
+    Returns:
+        dict: {'text': 完整文本, 'segments': [{'start', 'end', 'text'}]}
+    """
+    if WHISPER_CHUNKED:
+        return transcribe_audio_chunked(audio_path)
+    return transcribe_audio_with_whisper_server(audio_path)
+
+def open_audio_stream(video_path):
+    """启动 ffmpeg，将视频中的音频以单声道 s16le PCM 的形式输出到 stdout
+    
+    Returns:
+        subprocess.Popen: ffmpeg 进程
+    """
+    return (
+        ffmpeg
+        .input(video_path, **ffmpeg_input_kwargs())
+        .output('pipe:', format='s16le', acodec='pcm_s16le', ac=1, ar=AUDIO_SAMPLE_RATE)
+        .global_args('-nostdin', '-loglevel', 'error')
+        .run_async(pipe_stdout=True, pipe_stderr=True)
+    )
+
+class StderrTail:
+    """在后台线程持续读取 ffmpeg 的 stderr，只保留最后几行用于报告错误
+
+    stderr 不及时读取时，ffmpeg 输出的警告超过管道缓冲区后会阻塞，读取 stdout 的一方也随之挂起。
+    """
+    def __init__(self, stderr, max_lines=20):
+        self.lines = deque(maxlen=max_lines)
+        self._thread = threading.Thread(target=self._read, args=(stderr,), daemon=True)
+        self._thread.start()
+
+    def _read(self, stderr):
+        for line in stderr:
+            self.lines.append(line.decode('utf-8', 'replace').rstrip())
+
+    def text(self):
+        """等待 stderr 结束，返回保留的最后几行"""
+        self._thread.join()
+        return '\n'.join(self.lines)
+
+def transcribe_pcm_source(read, sample_rate, channels=1):
+    """转录顺序读取的 PCM 数据源（例如 ffmpeg 管道）
+    
+    总是边读边分块上传（与 WHISPER_CHUNKED 无关）：整段上传需要在内存中保留完整的音频，
+    内存占用会随视频长度增长。
+    
+    Args:
+        read (callable): read(n) 返回最多 n 字节的 s16le PCM 数据，返回空bytes表示结束
+        
+    Returns:
+        dict: {'text': 完整文本, 'segments': [{'start', 'end', 'text'}]}
+    """
+    return transcribe_pcm_stream(read, sample_rate, channels)
+
+def transcribe_video_stream(video_path, audio_path=None):
+    """直接读取 ffmpeg 输出的音频流并转录，不经过完整的 WAV 中间文件
+    
+    音频数据按块从管道读出后立即分块上传，内存中只保留有限的缓冲区。
+    
+    Args:
+        video_path (str): 视频文件路径
+        audio_path (str): 可选，同时将音频保存为 WAV 文件；None表示不落盘
+        
+    Returns:
+        dict: {'text': 完整文本, 'segments': [{'start', 'end', 'text'}]}
+        
+    Raises:
+        Exception: 音频提取或转录失败时抛出异常
+    """
+    sample_rate = int(AUDIO_SAMPLE_RATE)
+    process = open_audio_stream(video_path)
+    stderr = StderrTail(process.stderr)
+    wav_out = None
+    # WAV 文件先写入临时路径，转录和提取都成功后才重命名为目标文件
+    tmp_path = temp_path_for(audio_path) if audio_path else None
+    transcribed = False
+    try:
+        if audio_path:
+            os.makedirs(os.path.dirname(audio_path) or '.', exist_ok=True)
+            wav_out = wave.open(tmp_path, 'wb')
+            wav_out.setnchannels(1)
+            wav_out.setsampwidth(2)
+            wav_out.setframerate(sample_rate)
+        
+        def read(n):
+            data = process.stdout.read(n)
+            if wav_out and data:
+                wav_out.writeframes(data)
+            return data
+        
+        result = transcribe_pcm_source(read, sample_rate)
+        transcribed = True
+    
+    except requests.exceptions.RequestException as e:
+        process.kill()
+        raise Exception(f"Whisper服务器连接失败: {str(e)}")
+    except Exception as e:
+        process.kill()
+        raise Exception(f"音频转录失败: {str(e)}")
+    finally:
+        if wav_out:
+            wav_out.close()
+        process.stdout.close()
+        process.wait()
+        errors = stderr.text()
+        process.stderr.close()
+        if tmp_path and (not transcribed or process.returncode != 0) and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    
+    if process.returncode != 0:
+        raise Exception(f"音频提取失败: {errors}")
+    if tmp_path:
+        os.replace(tmp_path, audio_path)
+    return result
@@ -0,0 +1,156 @@
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from config import *
+from download import is_url
+from governor import configure_resources
+import main
+
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.mov', '.avi', '.flv', '.webm', '.m4v', '.ts')
+
+def read_list_file(path):
+    """读取URL列表或清单文件
+
+    支持两种格式：
+    - JSON 清单：字符串列表，或包含 "input" 字段的对象列表
+    - 纯文本：每行一个URL或路径，忽略空行和以 # 开头的注释
+
+    Returns:
+        list: 输入项列表
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read()
+
+    if path.endswith('.json'):
+        manifest = json.loads(content)
+        if isinstance(manifest, dict):
+            manifest = manifest.get('inputs', [])
+        return [item['input'] if isinstance(item, dict) else item for item in manifest]
+
+    return [line.strip() for line in content.splitlines()
+            if line.strip() and not line.strip().startswith('#')]
+
+def collect_inputs(sources):
+    """将命令行给出的来源展开为待处理的视频路径或URL列表
+
+    Args:
+        sources (list): 视频文件、目录、通配符、URL，或以 @ 开头的列表/清单文件
+
+    Returns:
+        list: 去重后的输入项，保持原有顺序
+    """
+    inputs = []
+    for source in sources:
+        if is_url(source):
+            inputs.append(source)
+        elif source.startswith('@'):
+            inputs.extend(collect_inputs(read_list_file(source[1:])))
+        elif os.path.isdir(source):
+            for root, _, files in os.walk(source):
+                inputs.extend(os.path.join(root, name) for name in sorted(files)
+                              if name.lower().endswith(VIDEO_EXTENSIONS))
+        elif glob.has_magic(source):
+            inputs.extend(sorted(glob.glob(source, recursive=True)))
+        else:
+            inputs.append(source)
+    return list(dict.fromkeys(inputs))
+
+def process_with_retries(input_path, retries=BATCH_RETRIES):
+    """处理单个输入项，失败时重试
+
+    Returns:
+        dict: 包含 input、ok、attempts 以及成功时 main.main 的返回值或失败时的 error
+    """
+    for attempt in range(1, retries + 2):
+        try:
+            result = main.main(input_path)
+            return {'input': input_path, 'ok': True, 'attempts': attempt, **result}
+        except Exception as e:
+            if attempt > retries:
+                return {'input': input_path, 'ok': False, 'attempts': attempt, 'error': str(e)}
+            print(f"处理 {input_path} 失败，正在重试 ({attempt}/{retries})...")
+            time.sleep(BATCH_RETRY_BACKOFF * attempt)
+
+def print_summary(results, elapsed):
+    """打印批处理的吞吐量汇总"""
+    succeeded = [r for r in results if r['ok']]
+    failed = [r for r in results if not r['ok']]
+    input_bytes = sum(os.path.getsize(r['video_path']) for r in succeeded
+                      if os.path.exists(r['video_path']))
+
+    stage_totals = {}
+    for r in succeeded:
+        for name, seconds in r['timings'].items():
+            stage_totals[name] = stage_totals.get(name, 0.0) + seconds
+
+    print("\n批处理汇总：")
+    print("-" * 50)
+    print(f"{'成功':<12} {len(succeeded)}")
+    print(f"{'失败':<12} {len(failed)}")
+    print(f"{'总耗时':<12} {elapsed:.2f}s")
+    if elapsed > 0:
+        print(f"{'吞吐量':<12} {len(succeeded) / elapsed * 60:.2f} 个/分钟, "
+              f"{input_bytes / elapsed / 1024 / 1024:.2f} MB/s")
+    if stage_totals:
+        print("\n各阶段累计耗时：")
+        for name, seconds in sorted(stage_totals.items(), key=lambda item: -item[1]):
+            print(f"{name:<20} {seconds:>10.2f}s")
+    for r in failed:
+        print(f"失败: {r['input']} ({r['error']})")
+    print("-" * 50)
+
+def run_batch(inputs, workers=BATCH_WORKERS, limits=None):
+    """使用有界的工作线程池批量处理视频
+
+    Args:
+        inputs (list): 视频路径或URL列表
+        workers (int): 同时处理的视频数
+        limits (dict): 各资源类别（download/cpu/remote）的最大并发阶段数，
+                       cpu 为None时由资源调度器决定
+
+    Returns:
+        list: 每个输入项的处理结果
+    """
+    limits = dict(limits or {
+        'download': BATCH_DOWNLOAD_CONCURRENCY,
+        'cpu': BATCH_CPU_CONCURRENCY,
+        'remote': BATCH_REMOTE_CONCURRENCY,
+    })
+    limits['cpu'] = configure_resources(workers, limits.get('cpu'))['cpu_stages']
+    main.set_stage_limits(limits)
+
+    start_time = time.perf_counter()
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_with_retries, item): item for item in inputs}
+        for i, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            results.append(result)
+            status = "完成" if result['ok'] else "失败"
+            print(f"[{i}/{len(inputs)}] {status}: {result['input']}")
+
+    print_summary(results, time.perf_counter() - start_time)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="批量将视频文件或在线视频转换为 Markdown 文件")
+    parser.add_argument('sources', nargs='+',
+                        help="视频文件、目录、通配符、URL，或以 @ 开头的URL列表/JSON清单文件")
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS, help="同时处理的视频数")
+    parser.add_argument('--download', type=int, default=BATCH_DOWNLOAD_CONCURRENCY, help="下载阶段的最大并发数")
+    parser.add_argument('--cpu', type=int, default=BATCH_CPU_CONCURRENCY,
+                        help="ffmpeg/OpenCV 阶段的最大并发数（默认根据核数和内存自动决定）")
+    parser.add_argument('--remote', type=int, default=BATCH_REMOTE_CONCURRENCY, help="Whisper/LLM 阶段的最大并发数")
+    args = parser.parse_args()
+
+    inputs = collect_inputs(args.sources)
+    if not inputs:
+        parser.error("没有找到需要处理的视频")
+    print(f"共 {len(inputs)} 个待处理项")
+
+    results = run_batch(inputs, args.workers,
+                        {'download': args.download, 'cpu': args.cpu, 'remote': args.remote})
+    raise SystemExit(0 if all(r['ok'] for r in results) else 1)
@@ -0,0 +1,257 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+from config import *
+from image import extract_key_frames, choose_strategy, get_video_info
+from governor import plan_resources
+from fake_server import FakeInferenceServer
+
+def generate_test_video(path, duration, height=720, fps=30, gop=250):
+    """生成合成测试视频
+
+    有 ffmpeg 时使用 testsrc2 测试源并用 libx264 编码（可控制GOP），
+    否则退回到 OpenCV 的 VideoWriter（mp4v，GOP由编码器决定）。
+
+    Args:
+        path (str): 输出视频路径
+        duration (int): 时长（秒）
+        height (int): 视频高度，宽度按16:9计算
+        fps (int): 帧率
+        gop (int): 关键帧间隔（帧）
+    """
+    width = int(round(height * 16 / 9 / 2)) * 2
+    if shutil.which('ffmpeg'):
+        subprocess.run([
+            'ffmpeg', '-v', 'error', '-y',
+            '-f', 'lavfi', '-i', f"testsrc2=size={width}x{height}:rate={fps}:duration={duration}",
+            '-f', 'lavfi', '-i', f"sine=frequency=440:duration={duration}",
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-g', str(gop), '-keyint_min', str(gop),
+            '-c:a', 'aac', '-shortest', path,
+        ], check=True)
+        return
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    try:
+        for i in range(int(duration * fps)):
+            frame = np.full((height, width, 3), (i * 7) % 256, np.uint8)
+            cv2.putText(frame, str(i), (width // 4, height // 2), cv2.FONT_HERSHEY_SIMPLEX,
+                        height / 100, (0, 0, 255), 3)
+            writer.write(frame)
+    finally:
+        writer.release()
+
+def time_call(func, *args, repeat=1, **kwargs):
+    """多次执行函数，返回最短耗时（秒）和最后一次的返回值"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def bench_frames(args):
+    """比较各关键帧提取策略在不同时长和GOP下的耗时"""
+    strategies = args.strategies
+    if not shutil.which('ffmpeg') and 'keyframe' in strategies:
+        print("警告：未找到ffmpeg，跳过 keyframe 策略")
+        strategies = [s for s in strategies if s != 'keyframe']
+
+    print(f"{'时长':>6} {'GOP':>5} {'高度':>5} {'策略':<20} {'耗时(s)':>9} {'帧数':>5}")
+    print("-" * 58)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for duration in args.durations:
+            for gop in args.gops:
+                path = os.path.join(tmp_dir, f"test-{duration}-{gop}.mp4")
+                generate_test_video(path, duration, args.height, gop=gop)
+                for strategy in strategies:
+                    elapsed, (frames, _) = time_call(extract_key_frames, path, args.max_images,
+                                                     strategy, repeat=args.repeat)
+                    # auto 同时显示实际选择的策略，包含探测关键帧间隔的耗时
+                    label = strategy
+                    if strategy == 'auto':
+                        label = f"auto({choose_strategy(path, get_video_info(path), args.max_images)})"
+                    print(f"{duration:>6} {gop:>5} {args.height:>5} {label:<20} "
+                          f"{elapsed:>9.3f} {len(frames):>5}")
+
+# 读取了 config 中配置项的项目模块；覆盖配置时需要同时修改这些模块中的同名变量
+PROJECT_MODULES = ('config', 'main', 'audio', 'image', 'text', 'download', 'cache', 'checkpoint',
+                   'fingerprint', 'metrics', 'net', 'video_store', 'media', 'align', 'dedup', 'governor')
+
+@contextlib.contextmanager
+def override_config(**values):
+    """临时覆盖配置项（包括已通过 from config import * 导入到各模块中的副本）
+
+    只对运行时读取的配置生效。函数的默认参数在导入时绑定，覆盖配置不会改变它们；
+    处理流程中影响缓存键（frame_settings() 等）的配置都由调用方显式传入，因此可以覆盖，
+    但直接调用依赖默认参数的函数时（例如 extract_key_frames 的 strategy）仍使用导入时的值。
+    """
+    saved = []
+    for module_name in PROJECT_MODULES:
+        module = sys.modules.get(module_name)
+        if module is None:
+            continue
+        for name, value in values.items():
+            if hasattr(module, name):
+                saved.append((module, name, getattr(module, name)))
+                setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for module, name, value in reversed(saved):
+            setattr(module, name, value)
+
+def environment_info():
+    """记录影响结果可比性的环境信息"""
+    def command_output(*cmd):
+        try:
+            return subprocess.run(cmd, capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    ffmpeg_version = command_output('ffmpeg', '-version')
+    return {
+        'commit': command_output('git', '-C', os.path.dirname(os.path.abspath(__file__)), 'rev-parse', '--short', 'HEAD'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'resources': plan_resources(mode=GOVERNOR_MODE),
+        'opencv': cv2.__version__,
+        'ffmpeg': ffmpeg_version.splitlines()[0] if ffmpeg_version else None,
+    }
+
+def run_pipeline(video_path, work_dir):
+    """在独立的工作目录中完整运行一次 main.main，返回各阶段记录和总耗时"""
+    import main
+    os.makedirs(work_dir)
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = main.main(os.path.abspath(video_path))
+    finally:
+        os.chdir(cwd)
+    stages = {stage.stage: {'wall': stage.wall_seconds, 'cpu': stage.cpu_seconds, 'peak_rss': stage.peak_rss}
+              for stage in result['timings'].stages}
+    return stages, result['elapsed']
+
+def summarize_runs(runs):
+    """将多次运行合并为每个阶段的中位数"""
+    summary = {}
+    for name in sorted({name for stages, _ in runs for name in stages}):
+        values = [stages[name] for stages, _ in runs if name in stages]
+        summary[name] = {
+            'wall': round(statistics.median(v['wall'] for v in values), 4),
+            'cpu': round(statistics.median(v['cpu'] for v in values), 4),
+            'peak_rss_mb': round(max(v['peak_rss'] for v in values) / 1024 / 1024, 1),
+        }
+    return summary, round(statistics.median(total for _, total in runs), 4)
+
+def bench_e2e(args):
+    """端到端测试：对不同时长、分辨率和GOP的合成视频运行完整流程，记录各阶段耗时"""
+    whisper = FakeInferenceServer(latency=args.whisper_latency, segment_seconds=args.segment_seconds)
+    llm = FakeInferenceServer(latency=args.llm_latency, token_latency=args.token_latency)
+    overrides = {
+        'WHISPER_SERVER_URL': None, 'LLM_SERVER_URL': None,
+        # 每次运行都从头处理，不使用任何缓存和检查点
+        'CACHE_ENABLED': False, 'LLM_CACHE_ENABLED': False, 'CHECKPOINT_ENABLED': False,
+        'METRICS_OUTPUT': None, 'PROFILE_DIR': None,
+    }
+    report = {'environment': environment_info(),
+              'settings': {'whisper_latency': args.whisper_latency, 'llm_latency': args.llm_latency,
+                           'token_latency': args.token_latency, 'repeat': args.repeat,
+                           'max_images': MAX_IMAGES, 'keyframe_mode': KEYFRAME_MODE,
+                           'whisper_chunked': WHISPER_CHUNKED, 'llm_stream': LLM_STREAM},
+              'cases': []}
+
+    with whisper, llm, tempfile.TemporaryDirectory() as tmp_dir:
+        overrides.update(WHISPER_SERVER_URL=whisper.url('/inference'),
+                         LLM_SERVER_URL=llm.url('/v1/chat/completions'))
+        import main  # 在覆盖配置之前导入，确保各模块中的配置副本都能被覆盖
+        with override_config(**overrides):
+            for duration in args.durations:
+                for height in args.heights:
+                    for gop in args.gops:
+                        name = f"{duration}s-{height}p-gop{gop}"
+                        video_path = os.path.join(tmp_dir, f"{name}.mp4")
+                        generate_test_video(video_path, duration, height, gop=gop)
+                        runs = [run_pipeline(video_path, os.path.join(tmp_dir, f"{name}-run{i}"))
+                                for i in range(args.repeat)]
+                        stages, total = summarize_runs(runs)
+                        report['cases'].append({'name': name, 'duration': duration, 'height': height, 'gop': gop,
+                                                'size_mb': round(os.path.getsize(video_path) / 1024 / 1024, 2),
+                                                'total': total, 'stages': stages})
+                        print(f"{name:<24} total {total:>8.2f}s  " +
+                              "  ".join(f"{stage} {values['wall']:.2f}s" for stage, values in stages.items()))
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write('\n')
+    print(f"报告已保存到: {args.output}")
+
+def bench_compare(args):
+    """对比两份端到端测试报告中各阶段的耗时变化"""
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = {case['name']: case for case in json.load(f)['cases']}
+    with open(args.current, 'r', encoding='utf-8') as f:
+        current = json.load(f)['cases']
+
+    print(f"{'用例':<24} {'阶段':<18} {'基准(s)':>9} {'当前(s)':>9} {'变化':>8}")
+    print("-" * 72)
+    for case in current:
+        base = baseline.get(case['name'])
+        if base is None:
+            continue
+        rows = [(stage, base['stages'][stage]['wall'], values['wall'])
+                for stage, values in case['stages'].items() if stage in base['stages']]
+        rows.append(('total', base['total'], case['total']))
+        for stage, old, new in rows:
+            change = (new - old) / old * 100 if old else 0.0
+            flag = ' *' if abs(change) >= args.threshold and abs(new - old) >= 0.05 else ''
+            print(f"{case['name']:<24} {stage:<18} {old:>9.3f} {new:>9.3f} {change:>+7.1f}%{flag}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="使用本地生成的合成视频进行性能测试")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    frames_parser = subparsers.add_parser('frames', help="比较关键帧提取策略")
+    frames_parser.add_argument('--durations', type=int, nargs='+', default=[30, 180], help="测试视频时长（秒）")
+    frames_parser.add_argument('--gops', type=int, nargs='+', default=[30, 250], help="测试视频关键帧间隔（帧）")
+    frames_parser.add_argument('--height', type=int, default=720, help="测试视频高度")
+    frames_parser.add_argument('--max-images', type=int, default=MAX_IMAGES, help="提取的关键帧数量")
+    frames_parser.add_argument('--strategies', nargs='+', default=['auto', 'seek', 'sequential', 'keyframe'],
+                               help="参与比较的策略（auto 为自动选择）")
+    frames_parser.add_argument('--repeat', type=int, default=1, help="每项重复次数（取最短耗时）")
+    frames_parser.set_defaults(func=bench_frames)
+
+    e2e_parser = subparsers.add_parser('e2e', help="使用假的 Whisper/LLM 服务运行完整流程")
+    e2e_parser.add_argument('--durations', type=int, nargs='+', default=[30, 120], help="测试视频时长（秒）")
+    e2e_parser.add_argument('--heights', type=int, nargs='+', default=[480, 1080], help="测试视频高度")
+    e2e_parser.add_argument('--gops', type=int, nargs='+', default=[250], help="测试视频关键帧间隔（帧）")
+    e2e_parser.add_argument('--whisper-latency', type=float, default=0.2, help="假 Whisper 服务每个请求的延迟（秒）")
+    e2e_parser.add_argument('--llm-latency', type=float, default=0.5, help="假 LLM 服务每个请求的延迟（秒）")
+    e2e_parser.add_argument('--token-latency', type=float, default=0.0, help="假 LLM 服务流式回复的增量间隔（秒）")
+    e2e_parser.add_argument('--segment-seconds', type=float, default=5.0, help="假 Whisper 服务返回的片段时长（秒）")
+    e2e_parser.add_argument('--repeat', type=int, default=1, help="每个用例的运行次数（取中位数）")
+    e2e_parser.add_argument('--output', default='bench-e2e.json', help="报告输出路径")
+    e2e_parser.set_defaults(func=bench_e2e)
+
+    compare_parser = subparsers.add_parser('compare', help="对比两份端到端测试报告")
+    compare_parser.add_argument('baseline', help="基准报告")
+    compare_parser.add_argument('current', help="当前报告")
+    compare_parser.add_argument('--threshold', type=float, default=10.0, help="标记变化超过该百分比的阶段")
+    compare_parser.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,250 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from config import *
+
+META_FILE = 'meta.json'
+
+# 缓存目录的绝对路径 -> {'total': 已知的总字节数, 'scanned': 上次完整扫描的时间}
+# 同一进程中的多个 ResultCache 实例共享，写入条目时累加，不必每次都扫描整个目录
+_usage = {}
+_usage_lock = threading.Lock()
+
+def make_key(video_hash, stage, settings):
+    """根据视频内容哈希、阶段名称和相关配置计算缓存键
+
+    Args:
+        video_hash (str): 视频内容哈希
+        stage (str): 阶段名称
+        settings (dict): 影响该阶段输出的配置项
+
+    Returns:
+        str: 缓存键（sha256 十六进制字符串）
+    """
+    payload = json.dumps({'video': video_hash, 'stage': stage, 'settings': settings},
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def restore_file(src, dst):
+    """将缓存中的产物复制到输出路径
+
+    不使用硬链接：输出文件之后可能被原地覆盖写入，共享inode会污染缓存条目。
+    """
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    shutil.copyfile(src, dst)
+
+class ResultCache:
+    """按内容寻址的阶段结果缓存
+
+    每个条目是 CACHE_DIR 下的一个目录，包含阶段产物文件和 meta.json。
+    meta.json 最后写入并通过整体重命名发布，因此只要条目存在就是完整的。
+    meta.json 的修改时间作为最近访问时间，用于按时间和容量淘汰。
+    写入条目时累加已知的总大小，只有超过容量上限或距上次完整扫描超过 scan_interval 时才扫描目录并淘汰；
+    其他进程写入的条目在下次完整扫描时计入。
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_size_mb=CACHE_MAX_SIZE_MB,
+                 max_age_days=CACHE_MAX_AGE_DAYS, scan_interval=CACHE_SCAN_INTERVAL):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024 if max_size_mb else None
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.scan_interval = scan_interval
+        self._usage_key = os.path.abspath(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        """读取缓存条目
+
+        Args:
+            key (str): 缓存键
+
+        Returns:
+            dict: {'files': {名称: 路径}, 'data': {...}}，未命中或条目无效时返回None
+        """
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, META_FILE)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        files = {}
+        for name, size in meta.get('files', {}).items():
+            path = os.path.join(entry_dir, name)
+            # 产物缺失或大小不符时视为无效条目
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                return None
+            files[name] = path
+
+        # 更新访问时间用于LRU淘汰
+        os.utime(meta_path, None)
+        return {'files': files, 'data': meta.get('data', {})}
+
+    def put(self, key, files=None, data=None):
+        """写入缓存条目
+
+        Args:
+            key (str): 缓存键
+            files (dict): 条目内文件名到源文件路径的映射，源文件会被复制到条目中
+            data (dict): 可JSON序列化的附加数据
+        """
+        entry_dir = self._entry_dir(key)
+        tmp_dir = f"{entry_dir}.tmp-{uuid.uuid4().hex}"
+        os.makedirs(tmp_dir)
+        try:
+            sizes = {}
+            for name, src in (files or {}).items():
+                dst = os.path.join(tmp_dir, name)
+                shutil.copyfile(src, dst)
+                sizes[name] = os.path.getsize(dst)
+            with open(os.path.join(tmp_dir, META_FILE), 'w', encoding='utf-8') as f:
+                json.dump({'key': key, 'created': time.time(), 'files': sizes,
+                           'data': data or {}}, f, ensure_ascii=False)
+            size = sum(sizes.values()) + os.path.getsize(os.path.join(tmp_dir, META_FILE))
+
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                # 其他进程已经写入了相同的条目
+                pass
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self._account(size)
+
+    def _account(self, size):
+        """累加新写入条目的大小，超过容量上限或到了扫描间隔时执行淘汰"""
+        with _usage_lock:
+            usage = _usage.get(self._usage_key)
+            if usage is None:
+                due = True
+            else:
+                usage['total'] += size
+                due = ((self.max_size is not None and usage['total'] > self.max_size)
+                       or time.time() - usage['scanned'] > self.scan_interval)
+        if due:
+            self.evict()
+
+    def _entries(self):
+        """列出所有条目：(最近访问时间, 占用字节数, 目录)"""
+        entries = []
+        for shard in os.listdir(self.cache_dir):
+            shard_dir = os.path.join(self.cache_dir, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                entry_dir = os.path.join(shard_dir, name)
+                meta_path = os.path.join(entry_dir, META_FILE)
+                if not os.path.exists(meta_path):
+                    continue
+                size = sum(os.path.getsize(os.path.join(entry_dir, f))
+                           for f in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(meta_path), size, entry_dir))
+        return entries
+
+    def evict(self):
+        """扫描整个缓存目录，按最长未访问时间和总容量淘汰条目，并校准已知的总大小
+
+        Returns:
+            int: 被淘汰的条目数
+        """
+        entries = sorted(self._entries())
+        now = time.time()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+
+        for atime, size, entry_dir in entries:
+            expired = self.max_age is not None and now - atime > self.max_age
+            oversize = self.max_size is not None and total > self.max_size
+            if not expired and not oversize:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            evicted += 1
+
+        with _usage_lock:
+            _usage[self._usage_key] = {'total': total, 'scanned': now}
+        return evicted
+
+class LLMCache:
+    """基于 SQLite 的LLM回复缓存
+
+    键为请求内容（模型、消息、temperature、max_tokens）的哈希。
+    总大小超过上限时按最近访问时间淘汰（LRU）。
+    """
+    def __init__(self, path=LLM_CACHE_PATH, max_size_mb=LLM_CACHE_MAX_SIZE_MB):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.max_size = max_size_mb * 1024 * 1024 if max_size_mb else None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    content TEXT NOT NULL,
+                    usage TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed ON responses (accessed)")
+
+    @staticmethod
+    def make_key(model, messages, temperature, max_tokens):
+        """计算请求的缓存键"""
+        payload = json.dumps({'model': model, 'messages': messages, 'temperature': temperature,
+                              'max_tokens': max_tokens}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """读取缓存的回复
+
+        Returns:
+            tuple: (回复内容, usage 字典)，未命中时返回None
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT content, usage FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self._conn:
+                self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+            return row[0], json.loads(row[1])
+
+    def put(self, key, content, usage=None):
+        """写入回复并在超过容量上限时淘汰最久未访问的条目"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, content, usage, size, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, content, json.dumps(usage or {}), len(content.encode('utf-8')), now, now))
+            if self.max_size is not None:
+                total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                while total > self.max_size:
+                    row = self._conn.execute(
+                        "SELECT key, size FROM responses ORDER BY accessed LIMIT 1").fetchone()
+                    if row is None:
+                        break
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+                    total -= row[1]
+
+    def stats(self):
+        """返回命中/未命中次数以及条目数和总大小"""
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'size': size}
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from config import *
+
+def temp_path_for(path):
+    """生成与目标文件同目录的临时文件路径，保证之后的重命名是原子的
+
+    保留原扩展名，以便 ffmpeg 等工具根据扩展名判断输出格式。
+    """
+    directory, name = os.path.split(path)
+    stem, ext = os.path.splitext(name)
+    return os.path.join(directory, f".{stem}.{uuid.uuid4().hex}.tmp{ext}")
+
+@contextmanager
+def atomic_output(path):
+    """原子地生成文件：在上下文中写入临时路径，成功退出后重命名为目标路径
+
+    出现异常时删除临时文件，目标文件保持不变，因此不会把写了一半的文件当作完成。
+
+    用法：
+        with atomic_output(txt_path) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                ...
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = temp_path_for(path)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def file_sha256(path, buffer_size=1024 * 1024):
+    """计算文件内容的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(buffer_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_record(path):
+    """记录文件的大小、修改时间和内容哈希，用于之后判断文件是否被改动"""
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_sha256(path)}
+
+def file_matches(path, record):
+    """判断文件是否与记录一致
+
+    大小和修改时间都没变时直接认为一致，不重新读取文件；
+    只有修改时间变了而大小相同时（例如文件被复制或 touch）才计算内容哈希比较，
+    内容一致时更新记录中的修改时间，之后的查询不再重复计算。
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if stat.st_size != record['size']:
+        return False
+    if stat.st_mtime_ns == record['mtime_ns']:
+        return True
+    if file_sha256(path) != record['sha256']:
+        return False
+    record['mtime_ns'] = stat.st_mtime_ns
+    return True
+
+def restore_output(src, dst):
+    """将检查点中记录的产物复制到本次运行的输出路径（路径相同时不做任何事）"""
+    if os.path.abspath(src) == os.path.abspath(dst):
+        return
+    with atomic_output(dst) as tmp_path:
+        shutil.copyfile(src, tmp_path)
+
+class JobManifest:
+    """单个视频的处理清单，用于中断后从第一个未完成的阶段继续
+
+    每个阶段记录状态、所用配置、输出文件路径及其大小、修改时间和内容哈希。
+    只有状态为完成、配置相同且所有输出文件都没有被改动时，阶段才被视为已完成；
+    大小和修改时间都没变时不重新计算哈希，恢复任务时不需要重新读取全部产物。
+    清单本身也通过临时文件加重命名的方式原子写入。
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {'stages': {}}
+
+    @classmethod
+    def for_video(cls, video_md5, manifest_dir=MD_DIR):
+        return cls(os.path.join(manifest_dir, f"{video_md5}.manifest.json"))
+
+    def _save(self):
+        with atomic_output(self.path) as tmp_path:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.data, f, ensure_ascii=False, indent=2)
+
+    def completed(self, stage, settings):
+        """查询已完成的阶段
+
+        Args:
+            stage (str): 阶段名称
+            settings (dict): 本次运行该阶段的配置
+
+        Returns:
+            dict: {'outputs': {名称: 路径}, 'data': {...}}，未完成或已失效时返回None
+        """
+        with self._lock:
+            record = self.data['stages'].get(stage)
+        if not record or record.get('status') != 'done' or record.get('settings') != settings:
+            return None
+
+        outputs = {}
+        touched = False
+        for name, output in record['outputs'].items():
+            if 'files' not in output:  # 旧格式的清单
+                return None
+            paths = output['path'] if isinstance(output['path'], list) else [output['path']]
+            files = output['files'] if isinstance(output['files'], list) else [output['files']]
+            if len(paths) != len(files):
+                return None
+            for p, f in zip(paths, files):
+                mtime = f['mtime_ns']
+                if not file_matches(p, f):
+                    return None
+                touched = touched or f['mtime_ns'] != mtime
+            outputs[name] = output['path']
+        if touched:
+            with self._lock:
+                self._save()
+        return {'outputs': outputs, 'data': record.get('data', {})}
+
+    def mark_done(self, stage, settings, outputs=None, data=None):
+        """记录阶段完成
+
+        Args:
+            stage (str): 阶段名称
+            settings (dict): 该阶段使用的配置
+            outputs (dict): 输出名称到文件路径（或路径列表）的映射
+            data (dict): 可JSON序列化的附加数据
+        """
+        recorded = {}
+        for name, path in (outputs or {}).items():
+            if isinstance(path, list):
+                recorded[name] = {'path': path, 'files': [file_record(p) for p in path]}
+            else:
+                recorded[name] = {'path': path, 'files': file_record(path)}
+
+        with self._lock:
+            self.data['stages'][stage] = {
+                'status': 'done',
+                'settings': settings,
+                'outputs': recorded,
+                'data': data or {},
+                'finished': time.time(),
+            }
+            self._save()
+
+    @contextmanager
+    def recording_failure(self, stage):
+        """在上下文中出现异常时将阶段记录为失败，异常继续向上抛出"""
+        try:
+            yield
+        except Exception as e:
+            self.mark_failed(stage, str(e))
+            raise
+
+    def mark_failed(self, stage, error):
+        """记录阶段失败（保留之前的输出记录以便排查）"""
+        with self._lock:
+            record = self.data['stages'].setdefault(stage, {})
+            record.update(status='failed', error=error, finished=time.time())
+            self._save()
@@ -1,8 +1,21 @@
 # LLM 配置
 LLM_PROCESS = True
 LLM_SERVER_URL = 'http://127.0.0.1:1234/v1/chat/completions'
+LLM_MODEL = ''  # 请求中指定的模型名称，留空表示使用服务器当前加载的模型
 LLM_TEMPERATURE = 0.7
 LLM_MAX_TOKENS = 2000
+LLM_CHUNK_TOKENS = 1500  # 长文本按句子切分，每块的最大输入 token 数（估算值）
+LLM_CONCURRENCY = 2  # 同时发送的LLM请求数
+LLM_RETRIES = 2  # 单块请求失败后的重试次数
+LLM_TIMEOUT = 600  # 单个请求的超时时间（秒）
+LLM_FALLBACK_TO_RAW = True  # 某块处理失败时是否保留该块原文；False 时直接报错
+LLM_STREAM = False  # 是否以流式方式接收LLM输出并边接收边写入Markdown（不进行合并整理）
+LLM_MERGE_PASS = False  # 分块处理后是否再做一次合并整理
+LLM_MERGE_MAX_TOKENS = 1500  # 合并整理的最大输入 token 数，超过时跳过合并
+LLM_CACHE_ENABLED = True  # 是否缓存LLM回复（按请求内容哈希）
+LLM_CACHE_BYPASS = False  # 为True时不读取缓存（仍会写入新的回复）
+LLM_CACHE_PATH = 'cache/llm.sqlite3'
+LLM_CACHE_MAX_SIZE_MB = 512  # 回复缓存的容量上限，超出后按最近最少使用淘汰，None表示不限制
 
 # 提示词配置
 ROLE_PROMPT = "你是一个专业的文本处理助手"
@@ -19,8 +32,30 @@ PROMPT_TEMPLATE = """
 4. 修正可能的语法错误
 """
 
+MERGE_PROMPT_TEMPLATE = """
+```
+{text}
+```
+
+以上markdown文本是分段处理后拼接而成的，请进行整理，要求：
+
+1. 统一章节标题的层级，合并重复的标题
+2. 修正段落之间的衔接
+3. 不要删减或新增内容
+"""
+
 # Whisper Server 配置
 WHISPER_SERVER_URL = 'http://127.0.0.1:8080/inference'
+WHISPER_CHUNKED = False  # 是否将音频切块后并发转录（返回带时间戳的片段）
+WHISPER_CHUNK_SECONDS = 120  # 每块的目标时长（秒）
+WHISPER_CHUNK_OVERLAP = 2  # 相邻块的重叠时长（秒），用于避免切断词语
+WHISPER_SPLIT_MODE = 'silence'  # 'silence' 在窗口末尾附近的静音处切分，'fixed' 按固定窗口切分
+WHISPER_SILENCE_SEARCH = 10  # 静音切分时向前搜索的时长（秒）
+WHISPER_CONCURRENCY = 4  # 同时发送的转录请求数
+WHISPER_RETRIES = 3  # 单块失败后的重试次数
+WHISPER_TIMEOUT = 600  # 单个请求的超时时间（秒）
+WHISPER_UPLOAD_FORMAT = 'wav'  # 分块或流式模式下的上传格式：'wav'、'flac' 或 'opus'；压缩格式需要 whisper-server 启用 --convert
+WHISPER_OPUS_BITRATE = '32k'  # opus 上传格式的码率
 
 # 文件目录配置
 AUDIO_DIR = 'audio'
@@ -37,6 +72,19 @@ SUPPORTED_VIDEO_DOMAINS = {
 
 # 下载器配置
 YOUTUBE_DOWNLOAD_QUALITY = 'best'
+DOWNLOAD_FRAGMENT_CONCURRENCY = 4  # HLS/DASH 等分片格式同时下载的分片数
+INFO_CACHE_ENABLED = True  # 是否在磁盘上缓存 yt_dlp 获取的视频信息
+INFO_CACHE_DIR = 'cache/info'
+INFO_CACHE_TTL = 3600  # 视频信息缓存的有效期（秒）；信息中的下载地址通常几个小时后失效
+INFO_MEMORY_ENTRIES = 64  # 进程内保留的视频信息条数，超出后淘汰最近最少使用的（服务模式长时间运行时限制内存）
+VIDEO_STORE_DIR = VIDEO_DIR  # 视频存储目录，按 平台/视频ID-格式 保存下载的视频，已下载的视频不再重复下载
+VIDEO_STORE_MAX_SIZE_MB = 20480  # 视频存储的总容量上限，超出后按最近最少使用淘汰，None表示不限制
+
+# 流水线下载：分别下载纯音频流和低分辨率视频流，音频下载完成后立即开始转录，不必等待视频
+DOWNLOAD_PIPELINED = False
+DOWNLOAD_AUDIO_FORMAT = 'bestaudio/worst'  # 音频流的 yt_dlp 格式选择
+DOWNLOAD_VIDEO_FORMAT = (f'bestvideo[height<={TARGET_RESOLUTION}]/best[height<={TARGET_RESOLUTION}]'
+                         '/worstvideo/worst')  # 关键帧使用的视频流，不超过 TARGET_RESOLUTION
 
 BILIBILI_FORMAT = 'best'  # 可以是具体的format ID，如'80'表示1080P，或'best'表示最佳质量
 # --------------------------------------------------------------------------------
@@ -62,3 +110,93 @@ BILIBILI_FORMAT = 'best'  # 可以是具体的format ID，如'80'表示1080P，
 # 音频配置
 AUDIO_SAMPLE_RATE = '16000'
 AUDIO_CODEC = 'pcm_s16le'
+AUDIO_STREAMING = False  # 是否直接从 ffmpeg 管道读取音频并转录，不生成完整的中间 WAV 文件（总是分块转录）
+AUDIO_KEEP_FILE = True  # 是否保留 AUDIO_DIR 中的 WAV 文件；False 时转录完成后删除（流式模式下不生成）
+
+# 流水线配置
+PARALLEL_STAGES = True  # 音频转录与关键帧提取是否并行执行
+SINGLE_DECODE = False  # 并行执行时是否由同一个 ffmpeg 进程同时解码音频和关键帧（仅POSIX，输入只解复用一次）
+MAX_IMAGES = 15  # 每个视频提取的关键帧数量
+
+# Markdown 输出配置
+FRAME_PLACEMENT = 'section'  # 'section' 关键帧集中放在文末，'inline' 按转录时间戳插入到对应段落旁边
+SUBTITLE_FORMATS = []  # 同时生成的字幕文件格式，例如 ['srt', 'vtt']
+
+# 结果缓存配置
+CACHE_ENABLED = True
+CACHE_DIR = 'cache/stages'  # 阶段结果缓存独占的目录，容量统计和淘汰只涉及这里的条目
+CACHE_MAX_SIZE_MB = 10240  # 缓存总容量上限，超出后按最近最少使用淘汰，None表示不限制
+CACHE_MAX_AGE_DAYS = 30  # 超过该天数未被访问的条目会被淘汰，None表示不限制
+CACHE_SCAN_INTERVAL = 3600  # 两次完整扫描缓存目录的最长间隔（秒）；期间只在累计大小超过上限时才扫描淘汰
+
+# 断点续跑配置
+CHECKPOINT_ENABLED = True  # 是否在 MD_DIR 中为每个视频记录处理清单，重新运行时跳过已完成的阶段
+
+# 指标与性能剖析配置
+METRICS_OUTPUT = None  # 阶段指标的输出文件，例如 'metrics/stages.jsonl'；None表示不输出
+METRICS_FORMAT = 'jsonl'  # 'jsonl' 每个阶段一行JSON，'prometheus' 累计指标的文本格式
+PROFILE_DIR = None  # 设置后对单次运行进行 cProfile/tracemalloc 剖析，结果保存到该目录
+
+# 视频指纹配置（指纹用于输出文件命名和缓存键）
+FINGERPRINT_MODE = 'sampled'  # 'sampled' 文件大小+固定位置采样块，'full' 完整文件MD5
+FINGERPRINT_SAMPLE_BLOCKS = 16  # 采样模式下读取的数据块数量
+FINGERPRINT_BLOCK_SIZE = 1024 * 1024  # 采样模式下每个数据块的大小（字节）
+FINGERPRINT_BUFFER_SIZE = 8 * 1024 * 1024  # 完整模式下的读取缓冲区大小（字节）
+FINGERPRINT_USE_MMAP = False  # 完整模式下是否使用mmap读取
+FINGERPRINT_BACKGROUND = False  # 完整模式下是否在后台线程计算指纹，同时提前提取音频
+
+# 关键帧提取配置
+KEYFRAME_MODE = 'uniform'  # 'uniform' 均匀间隔取帧，'scene' 按场景变化取帧
+KEYFRAME_STRATEGY = 'auto'  # 'auto' 自动选择，'seek' 逐帧定位，'sequential' 顺序解码，'keyframe' 仅解码I帧（需要ffmpeg）
+KEYFRAME_MAX_HEIGHT = None  # 关键帧最大高度，例如720；None表示保持原始分辨率
+IMAGE_JPEG_QUALITY = 90  # 关键帧图片的 JPEG 质量（0-100）
+IMAGE_ENCODE_WORKERS = 4  # JPEG 编码线程数
+# auto 策略按实测的关键帧间隔估算各策略的解码量（以顺序解码一帧为单位），选择最小的
+KEYFRAME_PROBE_PACKETS = 3000  # 探测关键帧间隔时读取的数据包数（只解复用不解码）
+KEYFRAME_DEFAULT_GOP = 250  # 无法探测时假定的关键帧间隔（帧）
+KEYFRAME_SEEK_OVERHEAD = 10  # 每次定位的固定开销，折算为解码帧数
+KEYFRAME_IFRAME_COST = 6  # I帧解码（含ffmpeg管道传输）的开销，折算为解码帧数
+KEYFRAME_DEMUX_COST = 0.03  # I帧解码时跳过每个非关键帧数据包的开销，折算为解码帧数
+KEYFRAME_IFRAME_MIN_RATIO = 1.0  # 关键帧数量不低于目标帧数的该倍数时才考虑I帧解码，否则时间位置过于稀疏
+
+# 关键帧去重配置（感知哈希）
+FRAME_DEDUP = 'none'  # 'none' 不去重，'consecutive' 与上一个保留的帧比较，'global' 与本视频所有保留的帧比较
+DEDUP_HASH = 'dhash'  # 'ahash' 均值哈希，'dhash' 差分哈希，'phash' DCT哈希
+DEDUP_THRESHOLD = 6  # 64位哈希的汉明距离不超过该值时视为重复
+DEDUP_BATCH_SIZE = 16  # 每批向量化计算哈希的帧数
+FRAME_INDEX_ENABLED = False  # 是否跨视频共享重复的关键帧（例如系列视频的片头片尾只保存一次，按路径引用）
+FRAME_INDEX_PATH = 'cache/frames.sqlite3'
+FRAME_STORE_DIR = 'cache/frames'  # 被其他视频引用的关键帧按内容哈希命名复制到这里，原视频的输出目录被覆盖时不受影响
+
+# 场景变化检测配置（KEYFRAME_MODE = 'scene' 时生效）
+SCENE_METRIC = 'hist'  # 'hist' 灰度直方图差异，'pixel' 像素平均绝对差
+SCENE_THRESHOLD = 0.3  # 差异分数（0~1）不低于该值时视为场景变化
+SCENE_SAMPLE_FPS = 2  # 每秒分析的帧数
+SCENE_BATCH_SIZE = 16  # 每批向量化计算的帧数
+SCENE_MIN_GAP = 2.0  # 两个场景边界之间的最小间隔（秒）
+SCENE_THUMB_SIZE = (64, 36)  # 用于检测的缩略图尺寸（宽, 高）
+
+# 资源调度配置（根据可用核数和内存决定 ffmpeg/OpenCV 的线程数和CPU阶段的并发数）
+GOVERNOR_ENABLED = True
+GOVERNOR_MODE = 'latency'  # 'latency' 单个任务尽快完成（每个阶段多线程），'throughput' 多任务总吞吐优先（更多阶段并发，每阶段少线程）
+GOVERNOR_CPUS = None  # 可用核数，None表示自动检测（考虑CPU亲和性和cgroup配额）
+GOVERNOR_MEMORY_MB = None  # 可用内存，None表示自动检测（考虑cgroup内存上限）
+GOVERNOR_LATENCY_THREADS = 4  # latency 模式下每个CPU阶段的最少线程数
+GOVERNOR_STAGE_MEMORY_MB = 512  # 估计的单个CPU阶段峰值内存，用于按内存限制并发阶段数
+
+# 批处理/服务模式配置
+BATCH_WORKERS = 4  # 同时处理的视频数
+BATCH_DOWNLOAD_CONCURRENCY = 2  # 同时进行的下载数
+BATCH_CPU_CONCURRENCY = None  # 同时进行的 ffmpeg/OpenCV 阶段数，None表示由资源调度器根据核数和内存决定
+BATCH_REMOTE_CONCURRENCY = 2  # 同时进行的 Whisper/LLM 请求阶段数
+BATCH_RETRIES = 1  # 单个视频失败后的重试次数
+BATCH_RETRY_BACKOFF = 5  # 重试前的等待时间（秒），随重试次数线性增加
+
+# 服务模式配置
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+SERVICE_WORKERS = 2  # 同时处理的任务数（各阶段的并发上限与批处理模式共用）
+SERVICE_DB = 'jobs.sqlite3'  # 持久化的任务队列，重启后继续处理未完成的任务
+SERVICE_WATCH_DIR = None  # 监视的目录，新出现的视频文件会自动加入队列；None表示不监视
+SERVICE_WATCH_INTERVAL = 5  # 扫描监视目录的间隔（秒）
+SERVICE_MAX_ATTEMPTS = 2  # 每个任务的最大尝试次数
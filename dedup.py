@@ -0,0 +1,228 @@
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import cv2
+import numpy as np
+from config import *
+from checkpoint import atomic_output, file_sha256
+
+HASH_SIZE = 8  # 每个哈希 8x8 = 64 位
+PHASH_SIZE = 32  # pHash 在 32x32 的缩略图上做DCT
+
+def dct_matrix(n):
+    """n 点 DCT-II 的正交变换矩阵，用于对整批缩略图做矩阵乘法形式的二维DCT"""
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+_DCT = dct_matrix(PHASH_SIZE)
+
+def thumbnails(frames, size):
+    """将帧缩小为灰度缩略图并堆叠成 (B, 高, 宽) 的 float32 数组"""
+    return np.stack([
+        cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame,
+                   size, interpolation=cv2.INTER_AREA)
+        for frame in frames
+    ]).astype(np.float32)
+
+def hash_frames(frames, method=DEDUP_HASH):
+    """批量计算感知哈希
+
+    Args:
+        frames (list): BGR 帧列表
+        method (str): 'ahash' 均值哈希，'dhash' 相邻像素差分哈希，'phash' DCT 低频系数哈希
+
+    Returns:
+        np.ndarray: 形状为 (B,) 的 uint64 哈希
+    """
+    if not frames:
+        return np.zeros(0, dtype=np.uint64)
+    if method == 'ahash':
+        thumbs = thumbnails(frames, (HASH_SIZE, HASH_SIZE))
+        bits = thumbs > thumbs.mean(axis=(1, 2), keepdims=True)
+    elif method == 'dhash':
+        thumbs = thumbnails(frames, (HASH_SIZE + 1, HASH_SIZE))
+        bits = thumbs[:, :, 1:] > thumbs[:, :, :-1]
+    elif method == 'phash':
+        thumbs = thumbnails(frames, (PHASH_SIZE, PHASH_SIZE))
+        coefficients = (_DCT @ thumbs @ _DCT.T)[:, :HASH_SIZE, :HASH_SIZE].reshape(len(frames), -1)
+        # 直流分量只反映整体亮度，不参与计算中位数
+        median = np.median(coefficients[:, 1:], axis=1, keepdims=True)
+        bits = coefficients > median
+    else:
+        raise ValueError(f"不支持的感知哈希算法: {method}")
+    packed = np.packbits(bits.reshape(len(frames), -1), axis=1)
+    return packed.view('>u8').ravel().astype(np.uint64)
+
+def hamming_distances(hashes, value):
+    """计算一组哈希与单个哈希之间的汉明距离"""
+    diff = np.bitwise_xor(np.asarray(hashes, dtype=np.uint64), np.uint64(value))
+    return np.unpackbits(diff.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+def dedup_frames(frames, mode=FRAME_DEDUP, method=DEDUP_HASH, threshold=DEDUP_THRESHOLD,
+                 batch_size=DEDUP_BATCH_SIZE):
+    """丢弃近似重复的关键帧
+
+    每攒够 batch_size 帧向量化计算一次哈希，再与已保留帧的哈希比较，
+    汉明距离不超过 threshold 的帧视为重复。
+
+    Args:
+        frames (iterable): (帧, 时间位置) 的序列
+        mode (str): 'none' 不去重，'consecutive' 只与上一个保留的帧比较，'global' 与本视频所有保留的帧比较
+
+    Yields:
+        tuple: (帧, 时间位置)
+    """
+    if mode == 'none':
+        yield from frames
+        return
+    if mode not in ('consecutive', 'global'):
+        raise ValueError(f"不支持的关键帧去重方式: {mode}")
+
+    kept = np.zeros(0, dtype=np.uint64)
+    dropped = 0
+    batch = []
+
+    def flush():
+        nonlocal kept, dropped
+        for (frame, position), value in zip(batch, hash_frames([frame for frame, _ in batch], method)):
+            reference = kept[-1:] if mode == 'consecutive' else kept
+            if len(reference) and hamming_distances(reference, value).min() <= threshold:
+                dropped += 1
+                continue
+            kept = np.append(kept, value)
+            yield frame, position
+
+    for item in frames:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield from flush()
+            batch = []
+    if batch:
+        yield from flush()
+    if dropped:
+        print(f"去除了 {dropped} 个重复的关键帧")
+
+class FrameHashIndex:
+    """基于 SQLite 的跨视频关键帧哈希索引
+
+    记录每张已保存图片的感知哈希、路径和内容的 SHA-256。同一系列视频中反复出现的画面（片头、片尾等）
+    只保存一次，之后的视频在 Markdown 中直接引用已有的图片。
+    原视频的输出目录可能被重新生成，因此图片第一次被其他视频引用时，先确认内容没有变化，
+    再复制到 store_dir 中以内容哈希命名，之后都引用这个不再改变的副本；
+    只有真正被共享的图片才会复制，store_dir 不会随处理的视频数增长。
+    所有哈希同时保存在内存数组中以便向量化比较，查询前增量读取其他进程新写入的记录。
+    """
+    def __init__(self, path=FRAME_INDEX_PATH, store_dir=FRAME_STORE_DIR):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.store_dir = store_dir
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS frames (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    method TEXT NOT NULL,
+                    hash INTEGER NOT NULL,
+                    path TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    video TEXT NOT NULL,
+                    created REAL NOT NULL
+                )""")
+        self._last_id = 0
+        self._hashes = {}  # 哈希算法 -> (哈希数组, 路径列表, SHA-256列表, 视频列表)
+
+    def _refresh(self):
+        rows = self._conn.execute("SELECT id, method, hash, path, sha256, video FROM frames WHERE id > ? ORDER BY id",
+                                  (self._last_id,)).fetchall()
+        if not rows:
+            return
+        grouped = {}
+        for _, method, *row in rows:
+            columns = grouped.setdefault(method, ([], [], [], []))
+            for column, value in zip(columns, row):
+                column.append(value)
+        for method, (new_values, new_paths, new_digests, new_videos) in grouped.items():
+            hashes, paths, digests, videos = self._hashes.get(method, (np.zeros(0, dtype=np.uint64), [], [], []))
+            # SQLite 只支持有符号64位整数，存储时按补码转换；每次刷新只拼接一次数组
+            hashes = np.concatenate([hashes, np.array(new_values, dtype=np.int64).view(np.uint64)])
+            paths.extend(new_paths)
+            digests.extend(new_digests)
+            videos.extend(new_videos)
+            self._hashes[method] = (hashes, paths, digests, videos)
+        self._last_id = rows[-1][0]
+
+    def _share(self, path, digest):
+        """返回图片在共享目录中的副本路径；副本不存在时从原图复制，原图已被删除或修改时返回None"""
+        store_path = os.path.join(self.store_dir, digest + '.jpg')
+        if os.path.exists(store_path):
+            return store_path
+        if not os.path.exists(path) or file_sha256(path) != digest:
+            return None
+        with atomic_output(store_path) as tmp_path:
+            shutil.copyfile(path, tmp_path)
+        return store_path
+
+    def find(self, value, method, threshold, exclude_video=None):
+        """查找与给定哈希近似的已保存图片
+
+        Returns:
+            str: 共享副本的路径，没有近似的图片（或图片已被删除、修改）时返回None
+        """
+        with self._lock:
+            self._refresh()
+            hashes, paths, digests, videos = self._hashes.get(method, (np.zeros(0, dtype=np.uint64), [], [], []))
+            if not len(hashes):
+                return None
+            distances = hamming_distances(hashes, value)
+            for i in np.argsort(distances, kind='stable'):
+                if distances[i] > threshold:
+                    break
+                if videos[i] != exclude_video:
+                    shared_path = self._share(paths[i], digests[i])
+                    if shared_path:
+                        return shared_path
+        return None
+
+    def add(self, value, method, path, video):
+        """索引一张已保存的图片，记录其感知哈希、路径和内容的 SHA-256"""
+        digest = file_sha256(path)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO frames (method, hash, path, sha256, video, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (method, int(np.uint64(value).view(np.int64)), path, digest, video, time.time()))
+
+class VideoFrameIndex:
+    """绑定到单个视频的索引视图，供 save_images_streaming 使用"""
+    def __init__(self, index, video, method=DEDUP_HASH, threshold=DEDUP_THRESHOLD, batch_size=DEDUP_BATCH_SIZE):
+        self.index = index
+        self.video = video
+        self.method = method
+        self.threshold = threshold
+        self.batch_size = batch_size
+
+    def hash(self, frames):
+        """批量计算一组帧的感知哈希"""
+        return hash_frames(frames, self.method)
+
+    def find(self, value):
+        return self.index.find(value, self.method, self.threshold, exclude_video=self.video)
+
+    def add(self, value, path):
+        self.index.add(value, self.method, path, self.video)
+
+_frame_index = None
+_frame_index_lock = threading.Lock()
+
+def get_frame_index():
+    """获取进程内共享的跨视频关键帧索引，未启用时返回None"""
+    global _frame_index
+    if not FRAME_INDEX_ENABLED:
+        return None
+    with _frame_index_lock:
+        if _frame_index is None:
+            _frame_index = FrameHashIndex(FRAME_INDEX_PATH, FRAME_STORE_DIR)
+        return _frame_index
@@ -1,8 +1,16 @@
+import copy
+import hashlib
+import json
 import os
 import re
+import threading
+import time
+from collections import OrderedDict
 from urllib.parse import urlparse
 import yt_dlp
 from config import *
+from checkpoint import atomic_output
+from video_store import get_video_store, url_video_id
 
 def is_url(path):
     """检查路径是否为URL"""
@@ -33,34 +41,125 @@ def get_downloader(url):
     
     raise ValueError(f"不支持的视频网站: {domain}")
 
+_info_memory = OrderedDict()  # URL -> (获取时间, 视频信息)，按最近使用排序
+_info_lock = threading.Lock()
+
+def remembered_info(url, now):
+    """读取进程内缓存的视频信息，过期时删除并返回None"""
+    with _info_lock:
+        cached = _info_memory.get(url)
+        if cached is None:
+            return None
+        if now - cached[0] >= INFO_CACHE_TTL:
+            del _info_memory[url]
+            return None
+        _info_memory.move_to_end(url)
+        return cached[1]
+
+def remember_info(url, fetched, info):
+    """在进程内缓存视频信息，最多保留 INFO_MEMORY_ENTRIES 条"""
+    with _info_lock:
+        _info_memory[url] = (fetched, info)
+        _info_memory.move_to_end(url)
+        while len(_info_memory) > INFO_MEMORY_ENTRIES:
+            _info_memory.popitem(last=False)
+
+def info_cache_path(url):
+    return os.path.join(INFO_CACHE_DIR, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+def fetch_video_info(url, refresh=False):
+    """获取视频信息（不下载）
+    
+    同一URL在进程内只请求一次（最多保留最近使用的 INFO_MEMORY_ENTRIES 条），并在磁盘上缓存 INFO_CACHE_TTL 秒，
+    之后的格式选择和下载都复用这份信息，不再重复请求网页。
+    
+    Args:
+        url (str): 视频URL
+        refresh (bool): 忽略缓存重新获取
+        
+    Returns:
+        dict: 可JSON序列化的视频信息
+    """
+    now = time.time()
+    cached = None if refresh else remembered_info(url, now)
+    if cached is not None:
+        return cached
+    
+    cache_path = info_cache_path(url) if INFO_CACHE_ENABLED else None
+    if cache_path and not refresh:
+        try:
+            if now - os.path.getmtime(cache_path) < INFO_CACHE_TTL:
+                with open(cache_path, 'r', encoding='utf-8') as f:
+                    info = json.load(f)
+                remember_info(url, os.path.getmtime(cache_path), info)
+                return info
+        except (OSError, ValueError):
+            pass
+    
+    try:
+        with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True}) as ydl:
+            info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+    except Exception as e:
+        raise Exception(f"获取视频信息失败: {str(e)}")
+    
+    remember_info(url, now, info)
+    if cache_path:
+        with atomic_output(cache_path) as tmp_path:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(info, f, ensure_ascii=False)
+    return info
+
+def download_with_info(info, format_spec, outtmpl):
+    """使用已获取的视频信息下载指定格式，不再重复请求网页
+    
+    Args:
+        info (dict): fetch_video_info 返回的视频信息
+        format_spec (str): yt_dlp 格式选择
+        outtmpl (str): 输出文件名模板
+        
+    Returns:
+        str: 下载的文件路径
+    """
+    os.makedirs(os.path.dirname(outtmpl) or '.', exist_ok=True)
+    opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'format': format_spec,
+        'outtmpl': outtmpl,
+        'concurrent_fragment_downloads': DOWNLOAD_FRAGMENT_CONCURRENCY,
+    }
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        result = ydl.process_ie_result(copy.deepcopy(info), download=True)
+        downloads = result.get('requested_downloads') or [{}]
+        path = downloads[0].get('filepath') or ydl.prepare_filename(result)
+    if not os.path.exists(path):
+        raise FileNotFoundError("下载完成但找不到视频文件")
+    return path
+
 class VideoDownloader:
     """视频下载器基类"""
-    def __init__(self):
-        self.default_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'outtmpl': os.path.join(VIDEO_DIR, '%(title)s.%(ext)s')
-        }
+    # 配置的下载格式，视频存储中不同格式分别保存
+    format_spec = 'best'
+    outtmpl = os.path.join(VIDEO_DIR, '%(title)s.%(ext)s')
 
     def list_formats(self, url):
-        """列出视频可用的格式"""
+        """列出视频可用的格式（使用缓存的视频信息）"""
         print("\n可用的视频格式：")
         print("-" * 80)
         print(f"{'格式ID':<10} {'扩展名':<8} {'分辨率':<12} {'文件大小':<10} {'说明':<20}")
         print("-" * 80)
         
-        with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-            info = ydl.extract_info(url, download=False)
-            formats = info.get('formats', [])
-            for f in formats:
-                format_id = f.get('format_id', 'N/A')
-                ext = f.get('ext', 'N/A')
-                resolution = f.get('resolution', 'N/A')
-                filesize = f.get('filesize', 0)
-                filesize_str = f"{filesize/1024/1024:.1f}MB" if filesize else 'N/A'
-                note = f.get('format_note', '')
-                
-                print(f"{format_id:<10} {ext:<8} {resolution:<12} {filesize_str:<10} {note:<20}")
+        info = fetch_video_info(url)
+        formats = info.get('formats', [])
+        for f in formats:
+            format_id = f.get('format_id', 'N/A')
+            ext = f.get('ext', 'N/A')
+            resolution = f.get('resolution', 'N/A')
+            filesize = f.get('filesize', 0)
+            filesize_str = f"{filesize/1024/1024:.1f}MB" if filesize else 'N/A'
+            note = f.get('format_note', '')
+            
+            print(f"{format_id:<10} {ext:<8} {resolution:<12} {filesize_str:<10} {note:<20}")
         print("-" * 80)
         return formats
 
@@ -104,100 +203,121 @@ class VideoDownloader:
             
         return None
 
-    def download(self, url):
+    def download(self, url, outtmpl=None):
+        """下载视频到给定的文件名模板（默认为 VIDEO_DIR 下以标题命名），返回文件路径"""
         raise NotImplementedError
 
 class YoutubeDownloader(VideoDownloader):
     """YouTube视频下载器"""
-    def download(self, url):
-        # 确保下载目录存在
-        os.makedirs(VIDEO_DIR, exist_ok=True)
-        
-        def try_download(format_spec):
-            """尝试使用指定的格式下载视频"""
-            ydl_opts = {**self.default_opts, 'format': format_spec}
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                video_path = ydl.prepare_filename(info)
-                if os.path.exists(video_path):
-                    return video_path
-                raise FileNotFoundError("下载完成但找不到视频文件")
+    format_spec = YOUTUBE_DOWNLOAD_QUALITY
+
+    def download(self, url, outtmpl=None):
+        info = fetch_video_info(url)
+        outtmpl = outtmpl or self.outtmpl
         
         try:
             # 首先尝试使用配置的质量设置
-            return try_download(YOUTUBE_DOWNLOAD_QUALITY)
+            return download_with_info(info, self.format_spec, outtmpl)
         except Exception as first_error:
             print(f"\n使用配置的质量设置下载失败: {str(first_error)}")
             print("正在尝试使用备选分辨率...")
             
-            # 尝试使用select_format选择合适的格式
+            # 尝试使用select_format选择合适的格式（复用已获取的格式列表）
             format_id = self.select_format(url, TARGET_RESOLUTION)
             if format_id:
                 print(f"找到合适的格式: {format_id}")
                 try:
-                    return try_download(format_id)
+                    return download_with_info(info, format_id, outtmpl)
                 except Exception as second_error:
                     print(f"\n使用备选格式下载失败: {str(second_error)}")
             
-            # 如果都失败了，显示可用格式并抛出异常
-            print("\n所有下载尝试都失败了！正在获取可用格式信息...")
-            self.list_formats(url)
+            # select_format 已经列出了可用格式，这里不再重复获取
+            print("\n所有下载尝试都失败了！")
             raise Exception(f"YouTube视频下载失败: {str(first_error)}\n"
                           f"请在config.py中调整YOUTUBE_DOWNLOAD_QUALITY设置")
 
 class BilibiliDownloader(VideoDownloader):
     """Bilibili视频下载器"""
-    def download(self, url):
-        # 确保下载目录存在
-        os.makedirs(VIDEO_DIR, exist_ok=True)
-        
+    format_spec = BILIBILI_FORMAT
+
+    def download(self, url, outtmpl=None):
+        info = None
         try:
             # 首先获取可用格式
             print("正在获取视频信息...")
-            with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-                info = ydl.extract_info(url, download=False)
-                formats = info.get('formats', [])
-                if not formats:
-                    raise Exception("没有找到可用的视频格式")
-                
-                # 检查指定的格式是否可用
-                format_ids = [f.get('format_id') for f in formats]
-                if BILIBILI_FORMAT != 'best' and BILIBILI_FORMAT not in format_ids:
-                    print(f"\n警告: 配置的格式ID '{BILIBILI_FORMAT}' 不可用")
-                    self.list_formats(url)
-                    print("\n请在config.py中设置正确的BILIBILI_FORMAT")
-                    raise Exception(f"格式ID '{BILIBILI_FORMAT}' 不可用")
+            info = fetch_video_info(url)
+            formats = info.get('formats', [])
+            if not formats:
+                raise Exception("没有找到可用的视频格式")
             
-            # 设置下载选项
-            ydl_opts = {
-                **self.default_opts,
-                'format': BILIBILI_FORMAT
-            }
+            # 检查指定的格式是否可用
+            format_ids = [f.get('format_id') for f in formats]
+            if BILIBILI_FORMAT != 'best' and BILIBILI_FORMAT not in format_ids:
+                print(f"\n警告: 配置的格式ID '{BILIBILI_FORMAT}' 不可用")
+                self.list_formats(url)
+                print("\n请在config.py中设置正确的BILIBILI_FORMAT")
+                raise Exception(f"格式ID '{BILIBILI_FORMAT}' 不可用")
             
             # 下载视频
             print(f"使用格式: {BILIBILI_FORMAT}")
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                video_path = ydl.prepare_filename(info)
-                if os.path.exists(video_path):
-                    return video_path
-                raise FileNotFoundError("下载完成但找不到视频文件")
+            return download_with_info(info, self.format_spec, outtmpl or self.outtmpl)
                 
         except Exception as e:
-            if "formats" not in locals():
-                # 如果连格式信息都没获取到，重新尝试获取
-                print("\n获取可用格式信息...")
+            if info is not None:
+                # 视频信息已缓存，列出可用格式不会再次请求网页
                 self.list_formats(url)
             
             raise Exception(f"Bilibili视频下载失败: {str(e)}\n"
                           f"请在config.py中设置BILIBILI_FORMAT为上述可用的format ID之一")
 
+def find_downloaded_video(url, format_spec):
+    """不请求网络，在视频存储中查找URL对应的已下载文件，没有时返回None"""
+    return get_video_store().lookup(*url_video_id(url), format_spec)
+
 def download_video(url):
-    """下载视频的主函数"""
+    """下载视频的主函数
+    
+    视频保存在按平台和视频ID寻址的存储中：已下载过的视频不请求网络直接返回，
+    多个任务同时请求同一视频时只下载一次。
+    """
     try:
         downloader = get_downloader(url)
-        video_path = downloader.download(url)
+        video_path = find_downloaded_video(url, downloader.format_spec)
+        if video_path:
+            print(f"视频已下载过，跳过下载：{video_path}")
+            return video_path
+        
+        video_path = get_video_store().fetch(*url_video_id(url), downloader.format_spec,
+                                             lambda outtmpl: downloader.download(url, outtmpl), source=url)
         print(f"视频下载成功：{video_path}")
         return video_path
     except Exception as e:
         raise Exception(f"视频下载失败: {str(e)}")
+
+def has_audio_only_format(info):
+    """视频是否提供单独的纯音频格式（DASH 等分离音视频的网站）"""
+    return any(f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')
+               for f in info.get('formats') or [])
+
+def get_video_key(url):
+    """根据平台和视频ID生成标识，用于在视频下载完成前确定输出文件名和缓存键"""
+    platform, video_id = url_video_id(url)
+    return hashlib.md5(f"{platform}:{video_id}".encode('utf-8')).hexdigest()
+
+def download_stream(url, info, format_spec, label):
+    """按格式选择下载视频的一个流（保存在视频存储中，已下载过时直接返回）
+    
+    Args:
+        url (str): 视频URL，用于确定存储位置
+        info (dict): fetch_video_info 返回的视频信息
+        format_spec (str): yt_dlp 格式选择
+        label (str): 流的名称，例如 'audio'、'video'
+        
+    Returns:
+        str: 下载的文件路径
+    """
+    try:
+        return get_video_store().fetch(*url_video_id(url), format_spec,
+                                       lambda outtmpl: download_with_info(info, format_spec, outtmpl), source=url)
+    except Exception as e:
+        raise Exception(f"下载{label}流失败: {str(e)}")
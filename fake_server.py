@@ -0,0 +1,275 @@
+import argparse
+import email.parser
+import email.policy
+import io
+import json
+import mimetypes
+import os
+import random
+import re
+import threading
+import time
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def parse_multipart(content_type, body):
+    """解析 multipart/form-data 请求体
+
+    Returns:
+        dict: 字段名到内容（bytes）的映射
+    """
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode('utf-8') + body)
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        if name:
+            fields[name] = part.get_payload(decode=True)
+    return fields
+
+def audio_duration(data):
+    """估算上传音频的时长（秒），无法识别的格式返回0"""
+    try:
+        with wave.open(io.BytesIO(data), 'rb') as wav:
+            return wav.getnframes() / wav.getframerate()
+    except (wave.Error, EOFError):
+        return 0.0
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    """模拟 whisper-server 和 OpenAI 兼容 LLM 接口的请求处理器，并提供 /media/ 下的测试媒体文件"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET(send_body=False)
+
+    def do_GET(self, send_body=True):
+        """从 media_dir 提供静态文件，支持单个 Range 请求，可按 download_rate 限速"""
+        server = self.server.fake
+        server.record(self.path)
+        name = self.path.split('?', 1)[0][len('/media/'):] if self.path.startswith('/media/') else None
+        path = os.path.realpath(os.path.join(server.media_dir, name)) if server.media_dir and name else None
+        if not path or not path.startswith(os.path.realpath(server.media_dir) + os.sep) or not os.path.isfile(path):
+            self.send_json(404, {'error': f"未知路径: {self.path}"})
+            return
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(size - int(match.group(2)), 0)
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{size}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        if not send_body:
+            return
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            block = 64 * 1024
+            while remaining > 0:
+                data = f.read(min(block, remaining))
+                if not data:
+                    break
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # 客户端只读取了开头部分（例如探测文件类型）后就断开了连接
+                    self.close_connection = True
+                    return
+                remaining -= len(data)
+                if server.download_rate:
+                    time.sleep(len(data) / server.download_rate)
+
+    def do_POST(self):
+        server = self.server.fake
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server.record(self.path)
+
+        if server.latency:
+            time.sleep(server.latency)
+        if server.take_failure():
+            self.send_json(503, {'error': '模拟的服务器错误'})
+            return
+
+        if self.path == '/inference':
+            self.handle_inference(body)
+        elif self.path == '/v1/chat/completions':
+            self.handle_chat(body)
+        else:
+            self.send_json(404, {'error': f"未知路径: {self.path}"})
+
+    def handle_inference(self, body):
+        """按上传音频的时长生成固定间隔的片段"""
+        server = self.server.fake
+        fields = parse_multipart(self.headers.get('Content-Type', ''), body)
+        duration = audio_duration(fields.get('file', b''))
+
+        segments = []
+        start = 0.0
+        while duration - start > 1e-3:
+            end = min(start + server.segment_seconds, duration)
+            segments.append({'id': len(segments), 'start': round(start, 3), 'end': round(end, 3),
+                             'text': f" 第{len(segments) + 1}段语音。"})
+            start = end
+
+        result = {'text': ''.join(seg['text'] for seg in segments)}
+        if fields.get('response_format', b'').decode() == 'verbose_json':
+            result.update(duration=duration, segments=segments)
+        self.send_json(200, result)
+
+    def handle_chat(self, body):
+        """模拟 OpenAI 兼容的对话接口：原样返回代码块中的文本并加上标题"""
+        request = json.loads(body)
+        prompt = request['messages'][-1]['content']
+        match = re.search(r'```\n(.*?)\n```', prompt, re.S)
+        content = f"## 内容\n\n{(match.group(1) if match else prompt).strip()}"
+        usage = {'prompt_tokens': len(prompt), 'completion_tokens': len(content)}
+        
+        if request.get('stream'):
+            self.stream_chat(content, usage)
+            return
+        self.send_json(200, {
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content},
+                         'finish_reason': 'stop'}],
+            'usage': usage,
+        })
+
+    def stream_chat(self, content, usage):
+        """以 server-sent events 的形式逐段返回回复内容"""
+        server = self.server.fake
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        
+        def send_event(payload):
+            self.wfile.write(f"data: {payload}\n\n".encode('utf-8'))
+            self.wfile.flush()
+        
+        step = 8
+        for start in range(0, len(content), step):
+            if server.token_latency:
+                time.sleep(server.token_latency)
+            send_event(json.dumps({'choices': [{'index': 0, 'delta': {'content': content[start:start + step]}}]},
+                                  ensure_ascii=False))
+        send_event(json.dumps({'choices': [], 'usage': usage}))
+        send_event('[DONE]')
+
+class FakeInferenceServer:
+    """本地的假推理服务，用于在没有GPU和网络的环境下测试和压测
+
+    用法：
+        with FakeInferenceServer(latency=0.2, media_dir='fixtures') as server:
+            config.WHISPER_SERVER_URL = server.url('/inference')
+            config.LLM_SERVER_URL = server.url('/v1/chat/completions')
+            video_url = server.url('/media/test.mp4')
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, failure_rate=0.0, segment_seconds=5.0,
+                 token_latency=0.0, media_dir=None, download_rate=0, fail_requests=0):
+        """
+        Args:
+            host (str): 监听地址
+            port (int): 监听端口，0表示随机分配
+            latency (float): 每个请求的模拟处理延迟（秒）
+            failure_rate (float): 随机返回503的概率，用于测试重试
+            segment_seconds (float): 转录结果中每个片段的时长（秒）
+            token_latency (float): 流式回复中每段增量文本之间的延迟（秒）
+            media_dir (str): 通过 /media/ 提供的测试媒体文件目录，用于测试下载
+            download_rate (int): 媒体文件的下载限速（字节/秒），0表示不限速
+            fail_requests (int): 最先收到的若干个POST请求固定返回503，用于确定性地测试重试
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.segment_seconds = segment_seconds
+        self.token_latency = token_latency
+        self.media_dir = media_dir
+        self.download_rate = download_rate
+        self.fail_requests = fail_requests
+        self.requests = {}
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), FakeRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self._thread = None
+
+    def record(self, path):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def take_failure(self):
+        """决定当前请求是否返回模拟的服务器错误"""
+        with self._lock:
+            if self.fail_requests > 0:
+                self.fail_requests -= 1
+                return True
+        return bool(self.failure_rate) and random.random() < self.failure_rate
+
+    def url(self, path=''):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}{path}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="启动本地的假 whisper-server 和 LLM 服务")
+    parser.add_argument('--host', default='127.0.0.1', help="监听地址")
+    parser.add_argument('--port', type=int, default=8080, help="监听端口")
+    parser.add_argument('--latency', type=float, default=0.0, help="每个请求的模拟延迟（秒）")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="随机返回503的概率")
+    parser.add_argument('--media-dir', default=None, help="通过 /media/ 提供的测试媒体文件目录")
+    parser.add_argument('--download-rate', type=int, default=0, help="媒体文件的下载限速（字节/秒）")
+    args = parser.parse_args()
+
+    server = FakeInferenceServer(args.host, args.port, args.latency, args.failure_rate,
+                                 media_dir=args.media_dir, download_rate=args.download_rate)
+    print(f"假推理服务已启动: {server.url()}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
@@ -0,0 +1,90 @@
+import hashlib
+import mmap
+import os
+from config import *
+
+def full_md5(video_path, buffer_size=FINGERPRINT_BUFFER_SIZE, use_mmap=FINGERPRINT_USE_MMAP):
+    """计算整个文件的 MD5 值
+
+    使用大块缓冲区（或mmap）读取，hashlib 在处理大块数据时会释放GIL，
+    因此可以放在后台线程中与其他阶段重叠执行。
+
+    Args:
+        video_path (str): 视频文件路径
+        buffer_size (int): 读取缓冲区大小（字节）
+        use_mmap (bool): 是否使用mmap代替read
+
+    Returns:
+        str: MD5 十六进制字符串
+    """
+    hash_md5 = hashlib.md5()
+    with open(video_path, 'rb') as f:
+        if use_mmap and os.path.getsize(video_path) > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+                    for offset in range(0, len(view), buffer_size):
+                        hash_md5.update(view[offset:offset + buffer_size])
+                finally:
+                    view.release()
+        else:
+            buffer = bytearray(buffer_size)
+            view = memoryview(buffer)
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                hash_md5.update(view[:n])
+    return hash_md5.hexdigest()
+
+def sampled_md5(video_path, blocks=FINGERPRINT_SAMPLE_BLOCKS, block_size=FINGERPRINT_BLOCK_SIZE):
+    """根据文件大小和固定位置的若干数据块计算快速指纹
+
+    采样位置只由文件大小决定（首块、尾块以及中间等距的块），
+    因此同一文件的指纹是稳定的。文件小于采样总量时退化为完整MD5。
+
+    Args:
+        video_path (str): 视频文件路径
+        blocks (int): 采样块数量（至少2块：首块和尾块）
+        block_size (int): 每个采样块的大小（字节）
+
+    Returns:
+        str: MD5 十六进制字符串
+    """
+    size = os.path.getsize(video_path)
+    blocks = max(blocks, 2)
+    if size <= blocks * block_size:
+        return full_md5(video_path)
+
+    hash_md5 = hashlib.md5()
+    # 加入模式标识和文件大小，避免与完整MD5或其他大小的文件混淆
+    hash_md5.update(b'sampled:')
+    hash_md5.update(size.to_bytes(8, 'little'))
+    with open(video_path, 'rb') as f:
+        last = size - block_size
+        for i in range(blocks):
+            f.seek(last * i // (blocks - 1))
+            hash_md5.update(f.read(block_size))
+    return hash_md5.hexdigest()
+
+FINGERPRINT_FUNCTIONS = {
+    'full': full_md5,
+    'sampled': sampled_md5,
+}
+
+def compute_fingerprint(video_path, mode=FINGERPRINT_MODE):
+    """按指定模式计算视频指纹
+
+    Args:
+        video_path (str): 视频文件路径
+        mode (str): 指纹模式，'full' 或 'sampled'
+
+    Returns:
+        str: 视频指纹
+
+    Raises:
+        ValueError: 不支持的指纹模式
+    """
+    if mode not in FINGERPRINT_FUNCTIONS:
+        raise ValueError(f"不支持的指纹模式: {mode}")
+    return FINGERPRINT_FUNCTIONS[mode](video_path)
@@ -0,0 +1,195 @@
+import math
+import os
+import threading
+import cv2
+from config import *
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+PROC_CGROUP = '/proc/self/cgroup'
+
+def read_cgroup_file(*paths):
+    """读取第一个存在的 cgroup 控制文件的内容，都不存在时返回None"""
+    for path in paths:
+        try:
+            with open(path, 'r') as f:
+                return f.read().strip()
+        except OSError:
+            continue
+    return None
+
+def read_proc_cgroup():
+    """解析 /proc/self/cgroup，返回 {控制器: 进程所在的 cgroup 路径}
+
+    每行格式为 “层级ID:控制器列表:路径”，cgroup v2 统一层级的行是 “0::/路径”，控制器记为空字符串。
+    """
+    paths = {}
+    value = read_cgroup_file(PROC_CGROUP)
+    for line in (value or '').splitlines():
+        _, controllers, path = line.split(':', 2)
+        for controller in controllers.split(','):
+            paths[controller] = path
+    return paths
+
+def cgroup_dirs(controller=''):
+    """进程所在 cgroup 及其各级父 cgroup 的目录（由内到外），父级的限制对进程同样生效
+
+    controller 为空字符串表示 cgroup v2 统一层级，否则为 v1 控制器名（例如 'cpu'、'memory'），
+    v1 的挂载点可能是 cpu、cpu,cpuacct 等合并了多个控制器的目录。
+    容器内没有独立的 cgroup 命名空间时，路径在挂载点下不存在，最终回退到挂载点根目录。
+    """
+    path = read_proc_cgroup().get(controller, '/').strip('/')
+    if controller:
+        try:
+            mounts = [os.path.join(CGROUP_ROOT, name) for name in sorted(os.listdir(CGROUP_ROOT))
+                      if controller in name.split(',')]
+        except OSError:
+            mounts = []
+    else:
+        mounts = [CGROUP_ROOT]
+    dirs = []
+    for mount in mounts:
+        current = path
+        while True:
+            directory = os.path.join(mount, current) if current else mount
+            if os.path.isdir(directory):
+                dirs.append(directory)
+            if not current:
+                break
+            current = os.path.dirname(current)
+    return dirs
+
+def cgroup_cpu_limit():
+    """读取 cgroup 的CPU配额（核数，可以是小数），没有限制时返回None
+
+    支持 cgroup v2（cpu.max）和 v1（cpu.cfs_quota_us / cpu.cfs_period_us），
+    从进程所在的 cgroup 一直检查到根，取最严格的配额。
+    """
+    limits = []
+    v2_found = False
+    for directory in cgroup_dirs():
+        value = read_cgroup_file(os.path.join(directory, 'cpu.max'))
+        if value is None:
+            continue
+        v2_found = True
+        quota, _, period = value.partition(' ')
+        if quota != 'max' and period:
+            limits.append(int(quota) / int(period))
+    if not v2_found:
+        for directory in cgroup_dirs('cpu'):
+            quota = read_cgroup_file(os.path.join(directory, 'cpu.cfs_quota_us'))
+            period = read_cgroup_file(os.path.join(directory, 'cpu.cfs_period_us'))
+            if quota and period and int(quota) > 0:
+                limits.append(int(quota) / int(period))
+    return min(limits) if limits else None
+
+def cgroup_memory_limit():
+    """读取 cgroup 的内存上限（字节），没有限制时返回None
+
+    与 cgroup_cpu_limit 相同，检查进程所在的 cgroup 及其各级父 cgroup，取最小的上限。
+    """
+    limits = [read_cgroup_file(os.path.join(directory, 'memory.max')) for directory in cgroup_dirs()]
+    if not any(limits):
+        limits = [read_cgroup_file(os.path.join(directory, 'memory.limit_in_bytes'))
+                  for directory in cgroup_dirs('memory')]
+    limits = [int(value) for value in limits if value and value != 'max']
+    return min(limits) if limits else None
+
+def detect_cpus():
+    """可用的CPU核数：进程的CPU亲和性与 cgroup 配额中较小的一个"""
+    if GOVERNOR_CPUS:
+        return GOVERNOR_CPUS
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # 非 Linux 系统
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_limit()
+    if quota:
+        cpus = min(cpus, max(math.ceil(quota), 1))
+    return cpus
+
+def detect_memory():
+    """可用内存（字节）：物理内存与 cgroup 内存上限中较小的一个"""
+    if GOVERNOR_MEMORY_MB:
+        return GOVERNOR_MEMORY_MB * 1024 * 1024
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        memory = None
+    limit = cgroup_memory_limit()
+    # cgroup v1 没有限制时是一个接近 2^63 的值
+    if limit and (memory is None or limit < memory):
+        memory = limit
+    return memory
+
+def plan_resources(jobs=1, cpu_stages=None, cpus=None, memory=None, mode=GOVERNOR_MODE):
+    """根据核数和内存决定CPU阶段的并发数和每个阶段的线程数
+
+    每个任务最多同时有两个CPU阶段（并行执行时的音频提取和关键帧提取）。
+    'latency' 模式每个阶段至少分配 GOVERNOR_LATENCY_THREADS 个线程，单个任务完成得更快；
+    'throughput' 模式让尽可能多的阶段各自以较少的线程同时运行，避免线程同步开销，总吞吐量更高。
+    并发阶段数还受内存限制：每个阶段按 GOVERNOR_STAGE_MEMORY_MB 估算。
+
+    Args:
+        jobs (int): 同时处理的视频数
+        cpu_stages (int): 指定的CPU阶段并发数，None表示自动决定
+        cpus (int): 可用核数，None表示自动检测
+        memory (int): 可用内存（字节），None表示自动检测
+        mode (str): 'latency' 或 'throughput'
+
+    Returns:
+        dict: cpus、memory_mb、jobs、mode、cpu_stages（CPU阶段并发上限）、threads（每个阶段的线程数）
+    """
+    if mode not in ('latency', 'throughput'):
+        raise ValueError(f"不支持的资源调度模式: {mode}")
+    cpus = cpus or detect_cpus()
+    memory = memory or detect_memory()
+    max_stages = max(jobs, 1) * (2 if PARALLEL_STAGES else 1)
+
+    if not cpu_stages:
+        if mode == 'throughput':
+            cpu_stages = min(max_stages, cpus)
+        else:
+            cpu_stages = min(max_stages, max(cpus // GOVERNOR_LATENCY_THREADS, 1))
+        if memory and GOVERNOR_STAGE_MEMORY_MB:
+            cpu_stages = min(cpu_stages, max(memory // (GOVERNOR_STAGE_MEMORY_MB * 1024 * 1024), 1))
+    return {
+        'cpus': cpus,
+        'memory_mb': memory // (1024 * 1024) if memory else None,
+        'jobs': jobs,
+        'mode': mode,
+        'cpu_stages': cpu_stages,
+        'threads': max(cpus // cpu_stages, 1),
+    }
+
+_plan = None
+_plan_lock = threading.Lock()
+
+def configure_resources(jobs=1, cpu_stages=None):
+    """按同时处理的视频数计算资源分配并生效，返回分配结果（参见 plan_resources）"""
+    global _plan
+    plan = plan_resources(jobs, cpu_stages, mode=GOVERNOR_MODE)
+    with _plan_lock:
+        _plan = plan
+    if GOVERNOR_ENABLED:
+        cv2.setNumThreads(plan['threads'])
+        memory = f"{plan['memory_mb'] / 1024:.1f}GB" if plan['memory_mb'] else "未知"
+        print(f"资源调度 ({plan['mode']}): {plan['cpus']} 核, {memory} 内存, {jobs} 个任务 -> "
+              f"CPU阶段并发 {plan['cpu_stages']}, 每阶段 {plan['threads']} 线程")
+    return plan
+
+def get_resource_plan():
+    """当前的资源分配，尚未配置时按单个任务计算"""
+    with _plan_lock:
+        plan = _plan
+    return plan or configure_resources()
+
+def stage_threads():
+    """单个CPU阶段可以使用的 ffmpeg/OpenCV 线程数；未启用资源调度时返回0，表示使用库的默认值"""
+    if not GOVERNOR_ENABLED:
+        return 0
+    return get_resource_plan()['threads']
+
+def ffmpeg_input_kwargs():
+    """ffmpeg 输入端的解码线程参数（ffmpeg-python 关键字参数形式）"""
+    threads = stage_threads()
+    return {'threads': threads} if threads else {}
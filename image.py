@@ -1,55 +1,451 @@
 import cv2
 import os
+import re
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import ffmpeg
 import numpy as np
 from config import *
+from checkpoint import atomic_output
+from governor import ffmpeg_input_kwargs, stage_threads
 
-def extract_key_frames(video_path, max_images=15):
-    """从视频中提取关键帧"""
-    cap = cv2.VideoCapture(video_path)
-    frame_rate = cap.get(cv2.CAP_PROP_FPS)
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    duration = total_frames / frame_rate
+def get_video_info(video_path):
+    """读取视频的基本信息
     
-    frames = []
-    positions = []  # 存储每个关键帧的时间位置
+    Returns:
+        dict: 包含 fps、total_frames、duration、width、height
+    """
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if not cap.isOpened():
+            raise Exception(f"无法打开视频文件: {video_path}")
+        frame_rate = cap.get(cv2.CAP_PROP_FPS)
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        return {
+            'fps': frame_rate,
+            'total_frames': total_frames,
+            'duration': total_frames / frame_rate if frame_rate else 0,
+            'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        }
+    finally:
+        cap.release()
+
+def open_capture(video_path):
+    """打开用于解码的 VideoCapture，解码线程数由资源调度器决定"""
+    threads = stage_threads()
+    if threads:
+        return cv2.VideoCapture(video_path, cv2.CAP_ANY, [cv2.CAP_PROP_N_THREADS, threads])
+    return cv2.VideoCapture(video_path)
+
+def compute_target_frames(total_frames, max_images):
+    """计算均匀分布的目标帧序号（首帧到末帧）"""
+    if total_frames <= 0:
+        return []
+    last = total_frames - 1
+    if max_images <= 1:
+        return [0]
+    return sorted({round(i * last / (max_images - 1)) for i in range(max_images)})
+
+def scaled_size(width, height, max_height):
+    """按最大高度等比缩放，返回偶数宽高；不需要缩放时返回原尺寸"""
+    if not max_height or height <= max_height:
+        return width, height
+    new_width = int(round(width * max_height / height / 2)) * 2
+    return max(new_width, 2), max_height
+
+def resize_frame(frame, max_height):
+    """将帧缩放到不超过指定高度"""
+    height, width = frame.shape[:2]
+    new_width, new_height = scaled_size(width, height, max_height)
+    if (new_width, new_height) == (width, height):
+        return frame
+    return cv2.resize(frame, (new_width, new_height), interpolation=cv2.INTER_AREA)
+
+def iter_frames_seek(video_path, targets, info, max_height=None):
+    """逐个定位到目标帧读取
     
+    每次定位都需要从前一个关键帧开始解码，适合目标帧稀疏、GOP较短的视频。
+    """
+    cap = open_capture(video_path)
     try:
-        # 计算关键帧的间隔
-        if max_images > 1:
-            interval = duration / (max_images - 1)
-        else:
-            interval = duration
-        
-        for i in range(max_images):
-            # 计算目标时间点
-            target_time = i * interval
-            target_frame = int(target_time * frame_rate)
-            
-            # 设置帧位置
+        for i, target_frame in enumerate(targets):
             cap.set(cv2.CAP_PROP_POS_FRAMES, target_frame)
             ret, frame = cap.read()
-            
             if ret:
-                frames.append(frame)
-                # 记录实际的时间位置（秒）
-                actual_time = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
-                positions.append(actual_time)
+                yield resize_frame(frame, max_height), target_frame / info['fps']
             else:
                 print(f"警告：无法读取第 {i+1} 个关键帧")
+    finally:
+        cap.release()
+
+def iter_frames_sequential(video_path, targets, info, max_height=None):
+    """单次顺序解码，用 grab() 跳过非目标帧，只在目标帧上 retrieve()
     
-    except Exception as e:
-        print(f"提取关键帧时发生错误: {str(e)}")
-        raise
+    避免了反复定位带来的重复解码，适合目标帧密集或GOP很长的视频。
+    """
+    cap = open_capture(video_path)
+    try:
+        remaining = iter(targets)
+        target_frame = next(remaining, None)
+        index = 0
+        while target_frame is not None:
+            if not cap.grab():
+                print(f"警告：视频在第 {index} 帧提前结束")
+                break
+            if index == target_frame:
+                ret, frame = cap.retrieve()
+                if ret:
+                    yield resize_frame(frame, max_height), index / info['fps']
+                target_frame = next(remaining, None)
+            index += 1
+    finally:
+        cap.release()
+
+class ShowinfoTimestamps:
+    """在后台线程解析 ffmpeg showinfo 滤镜写到 stderr 的每帧时间戳
+    
+    stderr 需要单独线程持续读取，否则管道写满后 ffmpeg 会阻塞。
+    其他输出的最后几行保存在 errors 中，用于报告 ffmpeg 的错误。
+    """
+    pattern = re.compile(rb'pts_time:\s*([-\d.]+)')
+    
+    def __init__(self, stderr):
+        self.errors = deque(maxlen=20)
+        self._timestamps = []
+        self._done = False
+        self._ready = threading.Condition()
+        self._thread = threading.Thread(target=self._read, args=(stderr,), daemon=True)
+        self._thread.start()
+    
+    def _read(self, stderr):
+        for line in stderr:
+            match = self.pattern.search(line)
+            if match:
+                with self._ready:
+                    self._timestamps.append(float(match.group(1)))
+                    self._ready.notify_all()
+            elif not line.startswith(b'[Parsed_showinfo'):
+                self.errors.append(line.decode('utf-8', 'replace').rstrip())
+        with self._ready:
+            self._done = True
+            self._ready.notify_all()
     
+    def get(self, index):
+        """等待并返回第 index 帧的时间位置（秒），没有对应的时间戳时返回0"""
+        with self._ready:
+            self._ready.wait_for(lambda: len(self._timestamps) > index or self._done)
+            return self._timestamps[index] if index < len(self._timestamps) else 0.0
+    
+    def join(self):
+        self._thread.join()
+
+def iter_raw_frames(stream, width, height, timestamps):
+    """从管道中逐帧读取 BGR 原始数据
+    
+    Yields:
+        tuple: (帧, 时间位置（秒）)
+    """
+    frame_size = width * height * 3
+    index = 0
+    while True:
+        data = stream.read(frame_size)
+        if len(data) < frame_size:
+            break
+        yield np.frombuffer(data, np.uint8).reshape(height, width, 3), timestamps.get(index)
+        index += 1
+
+def iter_ffmpeg_frames(video_path, width, height, input_kwargs=None, vf=None):
+    """通过 ffmpeg 管道读取原始 BGR 帧
+    
+    Args:
+        video_path (str): 视频文件路径
+        width (int): 输出帧宽度
+        height (int): 输出帧高度
+        input_kwargs (dict): 传给 ffmpeg 输入端的参数
+        vf (list): 追加在缩放之前的滤镜（字符串）
+        
+    Yields:
+        tuple: (帧, 时间位置（秒）)
+    """
+    filters = list(vf or []) + [f"scale={width}:{height}", "showinfo"]
+    process = (
+        ffmpeg
+        .input(video_path, **{**ffmpeg_input_kwargs(), **(input_kwargs or {})})
+        .output('pipe:', format='rawvideo', pix_fmt='bgr24', vf=','.join(filters), vsync='vfr')
+        .global_args('-nostdin', '-hide_banner')
+        .run_async(pipe_stdout=True, pipe_stderr=True)
+    )
+    timestamps = ShowinfoTimestamps(process.stderr)
+    try:
+        yield from iter_raw_frames(process.stdout, width, height, timestamps)
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+        timestamps.join()
+
+def nearest_frames(frames, target_times):
+    """为每个目标时间选择时间上最近的帧，重复选中的帧只产出一次
+    
+    只为每个目标保留当前最近的一帧，内存占用与目标数量成正比。
+    """
+    best = [None] * len(target_times)
+    for frame, position in frames:
+        for i, target_time in enumerate(target_times):
+            distance = abs(position - target_time)
+            if best[i] is None or distance < best[i][0]:
+                best[i] = (distance, frame, position)
+    
+    seen = set()
+    for item in best:
+        if item is None or item[2] in seen:
+            continue
+        seen.add(item[2])
+        yield item[1], item[2]
+
+def iter_frames_keyframe(video_path, targets, info, max_height=None):
+    """只解码 I 帧（ffmpeg -skip_frame nokey），为每个目标时间选择最近的关键帧
+    
+    解码量与关键帧数量成正比，长视频最快，但时间位置会吸附到关键帧上。
+    """
+    new_width, new_height = scaled_size(info['width'], info['height'], max_height)
+    target_times = [target_frame / info['fps'] for target_frame in targets]
+    frames = iter_ffmpeg_frames(video_path, new_width, new_height, input_kwargs={'skip_frame': 'nokey'})
+    return nearest_frames(frames, target_times)
+
+def probe_keyframe_interval(video_path, max_packets=KEYFRAME_PROBE_PACKETS):
+    """读取视频开头的压缩数据包（只解复用，不解码），返回平均关键帧间隔（帧）
+
+    读取几千个数据包通常只需要几十毫秒。后端不支持读取原始数据包时返回None。
+    """
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if not cap.isOpened() or not cap.set(cv2.CAP_PROP_FORMAT, -1):
+            return None
+        packets = keyframes = 0
+        while packets < max_packets and cap.grab():
+            packets += 1
+            if cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME):
+                keyframes += 1
+        # 探测范围内只有一个关键帧时，实际间隔不小于探测的数据包数
+        return packets / max(keyframes, 1) if packets else None
     finally:
         cap.release()
+
+def estimate_strategy_costs(info, targets, gop):
+    """估算各策略的解码量，以顺序解码一帧为单位
+
+    sequential 解码所有帧；seek 每次定位从前一个关键帧开始解码，平均解码半个GOP；
+    keyframe 只解码I帧，但仍要解复用全部数据包，且关键帧太少时不参与选择。
+
+    Args:
+        info (dict): get_video_info 的返回值
+        targets (int): 目标帧数
+        gop (float): 平均关键帧间隔（帧）
+
+    Returns:
+        dict: 策略名称到估算开销的映射
+    """
+    frames = info['total_frames']
+    gop = min(max(gop, 1), max(frames, 1))
+    costs = {
+        'sequential': frames,
+        'seek': targets * (gop / 2 + KEYFRAME_SEEK_OVERHEAD),
+    }
+    keyframes = frames / gop
+    if shutil.which('ffmpeg') and keyframes >= targets * KEYFRAME_IFRAME_MIN_RATIO:
+        costs['keyframe'] = keyframes * KEYFRAME_IFRAME_COST + frames * KEYFRAME_DEMUX_COST
+    return costs
+
+def choose_strategy(video_path, info, max_images):
+    """按实测的关键帧间隔选择估算解码量最小的关键帧提取策略"""
+    gop = probe_keyframe_interval(video_path) or KEYFRAME_DEFAULT_GOP
+    targets = len(compute_target_frames(info['total_frames'], max_images))
+    costs = estimate_strategy_costs(info, targets, gop)
+    return min(costs, key=costs.get)
+
+FRAME_STRATEGIES = {
+    'seek': iter_frames_seek,
+    'sequential': iter_frames_sequential,
+    'keyframe': iter_frames_keyframe,
+}
+
+def frame_thumbnail(frame, size=SCENE_THUMB_SIZE):
+    """将帧缩小为灰度缩略图，用于场景变化检测"""
+    small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+def scene_scores(thumbs, prev_thumb=None, metric=SCENE_METRIC, bins=32):
+    """批量计算每个缩略图与前一个缩略图之间的差异分数
+    
+    Args:
+        thumbs (np.ndarray): 形状为 (B, H, W) 的灰度缩略图批次
+        prev_thumb (np.ndarray): 批次之前的最后一个缩略图，None表示批次从视频开头开始
+        metric (str): 'hist' 灰度直方图差异，'pixel' 像素平均绝对差
+        bins (int): 直方图分箱数量（必须能整除256）
+        
+    Returns:
+        np.ndarray: 形状为 (B,) 的分数，范围 [0, 1]；没有前一帧的位置为无穷大
+    """
+    batch = thumbs.reshape(len(thumbs), -1)
+    if prev_thumb is not None:
+        batch = np.concatenate([prev_thumb.reshape(1, -1), batch])
+    
+    if metric == 'hist':
+        # 通过给每一行加偏移量，用一次 bincount 计算整批直方图
+        rows, pixels = batch.shape
+        indices = (batch >> (8 - int(np.log2(bins)))).astype(np.int64)
+        indices += np.arange(rows)[:, None] * bins
+        hist = np.bincount(indices.ravel(), minlength=rows * bins).reshape(rows, bins) / pixels
+        diffs = 0.5 * np.abs(np.diff(hist, axis=0)).sum(axis=1)
+    elif metric == 'pixel':
+        diffs = np.abs(np.diff(batch.astype(np.int16), axis=0)).mean(axis=1) / 255.0
+    else:
+        raise ValueError(f"不支持的场景差异度量: {metric}")
+    
+    if prev_thumb is None:
+        diffs = np.concatenate([[np.inf], diffs])
+    return diffs
+
+def select_scene_frames(samples, max_images=MAX_IMAGES, max_height=KEYFRAME_MAX_HEIGHT,
+                        threshold=SCENE_THRESHOLD, batch_size=SCENE_BATCH_SIZE, min_gap=SCENE_MIN_GAP,
+                        metric=SCENE_METRIC):
+    """从按时间顺序的采样帧中按场景变化选择关键帧
+    
+    采样帧缩小成灰度缩略图后按批次向量化计算差异分数。分数超过阈值的帧视为场景边界候选，
+    在 min_gap 秒内只保留分数最高的一个，候选数超过 max_images 时淘汰分数最低的。
+    视频首帧总是保留。同时驻留内存的完整帧不超过 batch_size + max_images 个。
+    
+    Args:
+        samples (iterable): (帧, 时间位置（秒）) 的序列
+        
+    Yields:
+        tuple: (帧, 时间位置（秒）)，按时间顺序
+    """
+    candidates = []  # [分数, 时间位置, 帧]，按时间排序
+    
+    def add_candidate(score, position, frame):
+        if score < threshold:
+            return
+        if candidates and position - candidates[-1][1] < min_gap:
+            # 同一个转场内的连续高分帧只保留分数最高的
+            if score > candidates[-1][0]:
+                candidates[-1] = [score, position, frame]
+            return
+        candidates.append([score, position, frame])
+        if len(candidates) > max_images:
+            weakest = min(range(len(candidates)), key=lambda i: candidates[i][0])
+            del candidates[weakest]
+    
+    def flush(prev_thumb):
+        thumbs = np.stack(batch_thumbs)
+        scores = scene_scores(thumbs, prev_thumb, metric)
+        for score, position, frame in zip(scores, batch_positions, batch_frames):
+            add_candidate(float(score), position, frame)
+        return thumbs[-1]
+    
+    prev_thumb = None
+    batch_frames, batch_thumbs, batch_positions = [], [], []
+    for frame, position in samples:
+        batch_frames.append(resize_frame(frame, max_height))
+        batch_thumbs.append(frame_thumbnail(frame, SCENE_THUMB_SIZE))
+        batch_positions.append(position)
+        if len(batch_thumbs) >= batch_size:
+            prev_thumb = flush(prev_thumb)
+            batch_frames, batch_thumbs, batch_positions = [], [], []
+    if batch_thumbs:
+        flush(prev_thumb)
+    
+    for _, position, frame in candidates:
+        yield frame, position
+
+def iter_sampled_frames(video_path, sample_fps=SCENE_SAMPLE_FPS):
+    """单次顺序解码视频，以 sample_fps 的频率产出采样帧（完整分辨率）"""
+    info = get_video_info(video_path)
+    step = max(int(round(info['fps'] / sample_fps)), 1) if sample_fps else 1
+    cap = open_capture(video_path)
+    try:
+        index = 0
+        while cap.grab():
+            if index % step == 0:
+                ret, frame = cap.retrieve()
+                if ret:
+                    yield frame, index / info['fps']
+            index += 1
+    finally:
+        cap.release()
+
+def iter_scene_frames(video_path, max_images=MAX_IMAGES, max_height=KEYFRAME_MAX_HEIGHT,
+                      threshold=SCENE_THRESHOLD, sample_fps=SCENE_SAMPLE_FPS,
+                      batch_size=SCENE_BATCH_SIZE, min_gap=SCENE_MIN_GAP, metric=SCENE_METRIC):
+    """按场景变化选择关键帧（使用 OpenCV 顺序解码采样），参见 select_scene_frames
+    
+    Yields:
+        tuple: (帧, 时间位置（秒）)，按时间顺序
+    """
+    return select_scene_frames(iter_sampled_frames(video_path, sample_fps), max_images, max_height,
+                               threshold, batch_size, min_gap, metric)
+
+def iter_key_frames(video_path, max_images=MAX_IMAGES, strategy=KEYFRAME_STRATEGY,
+                    max_height=KEYFRAME_MAX_HEIGHT, mode=KEYFRAME_MODE):
+    """按指定策略逐个产出关键帧
+    
+    Args:
+        video_path (str): 视频文件路径
+        max_images (int): 最多提取的关键帧数量
+        strategy (str): 'auto'、'seek'、'sequential' 或 'keyframe'（仅均匀模式）
+        max_height (int): 输出帧的最大高度，None表示保持原始分辨率
+        mode (str): 'uniform' 均匀间隔取帧，'scene' 按场景变化取帧
+        
+    Yields:
+        tuple: (帧, 时间位置（秒）)
+    """
+    if mode == 'scene':
+        return iter_scene_frames(video_path, max_images, max_height, SCENE_THRESHOLD, SCENE_SAMPLE_FPS,
+                                 SCENE_BATCH_SIZE, SCENE_MIN_GAP, SCENE_METRIC)
+    if mode != 'uniform':
+        raise ValueError(f"不支持的关键帧选择模式: {mode}")
+    
+    info = get_video_info(video_path)
+    if strategy == 'auto':
+        strategy = choose_strategy(video_path, info, max_images)
+    if strategy not in FRAME_STRATEGIES:
+        raise ValueError(f"不支持的关键帧提取策略: {strategy}")
+    
+    targets = compute_target_frames(info['total_frames'], max_images)
+    return FRAME_STRATEGIES[strategy](video_path, targets, info, max_height)
+
+def extract_key_frames(video_path, max_images=MAX_IMAGES, strategy=KEYFRAME_STRATEGY, mode=KEYFRAME_MODE):
+    """从视频中提取关键帧"""
+    frames = []
+    positions = []  # 存储每个关键帧的时间位置
+    
+    try:
+        for frame, position in iter_key_frames(video_path, max_images, strategy, mode=mode):
+            frames.append(frame)
+            positions.append(position)
+    
+    except Exception as e:
+        print(f"提取关键帧时发生错误: {str(e)}")
+        raise
     
     if not frames:
         raise Exception("未能提取到任何关键帧")
     
     return frames, positions
 
-def save_images(frames, output_dir):
+def write_jpeg(frame, img_path, quality=IMAGE_JPEG_QUALITY):
+    """将帧编码为 JPEG 并写入文件（先写临时文件再原子重命名）"""
+    ok, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise Exception("JPEG编码失败")
+    with atomic_output(img_path) as tmp_path:
+        buffer.tofile(tmp_path)
+
+def save_images(frames, output_dir, quality=IMAGE_JPEG_QUALITY):
     """保存图片到指定目录"""
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
@@ -58,7 +454,7 @@ def save_images(frames, output_dir):
     for i, frame in enumerate(frames, 1):
         try:
             img_path = os.path.join(output_dir, f"{i}.jpg")
-            cv2.imwrite(img_path, frame)
+            write_jpeg(frame, img_path, quality)
             image_paths.append(img_path)
         except Exception as e:
             print(f"保存图片 {i} 时发生错误: {str(e)}")
@@ -69,6 +465,75 @@ def save_images(frames, output_dir):
     
     return image_paths
 
+def save_images_streaming(frames, output_dir, quality=IMAGE_JPEG_QUALITY, workers=IMAGE_ENCODE_WORKERS,
+                          index=None):
+    """边解码边编码保存关键帧
+    
+    每解码出一帧就提交到线程池编码为 JPEG（cv2.imencode 会释放GIL），
+    排队中的帧数不超过 workers 的两倍，因此内存中只保留少量完整分辨率的帧。
+    
+    Args:
+        frames (iterable): 产出 (帧, 时间位置) 的迭代器，例如 iter_key_frames()
+        output_dir (str): 图片输出目录
+        quality (int): JPEG 质量（0-100）
+        workers (int): 编码线程数
+        index (VideoFrameIndex): 可选的跨视频关键帧索引，与其他视频中已保存的图片近似时直接引用该图片；
+            此时每攒够 index.batch_size 帧批量计算一次感知哈希
+        
+    Returns:
+        tuple: (图片路径列表, 关键帧时间位置列表)
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    
+    image_paths = []
+    positions = []
+    pending = deque()
+    
+    def collect(item):
+        future, img_path, position, i, frame_hash = item
+        try:
+            if future is not None:
+                future.result()
+                if index:
+                    index.add(frame_hash, img_path)
+            image_paths.append(img_path)
+            positions.append(position)
+        except Exception as e:
+            print(f"保存图片 {i} 时发生错误: {str(e)}")
+    
+    def submit(executor, batch):
+        # 使用跨视频索引时每批帧一次性计算感知哈希
+        hashes = index.hash([frame for _, frame, _ in batch]) if index else [None] * len(batch)
+        for (i, frame, position), frame_hash in zip(batch, hashes):
+            shared_path = index.find(frame_hash) if index else None
+            if shared_path:
+                pending.append((None, shared_path, position, i, frame_hash))
+                continue
+            img_path = os.path.join(output_dir, f"{i}.jpg")
+            future = executor.submit(write_jpeg, frame, img_path, quality)
+            pending.append((future, img_path, position, i, frame_hash))
+            # 解码快于编码时等待最早的任务完成，避免帧在内存中堆积
+            while len(pending) > workers * 2:
+                collect(pending.popleft())
+    
+    batch_size = index.batch_size if index else 1
+    batch = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, (frame, position) in enumerate(frames, 1):
+            batch.append((i, frame, position))
+            if len(batch) >= batch_size:
+                submit(executor, batch)
+                batch = []
+        if batch:
+            submit(executor, batch)
+        while pending:
+            collect(pending.popleft())
+    
+    if not image_paths:
+        raise Exception("未能保存任何图片")
+    
+    return image_paths, positions
+
 def format_timestamp(seconds):
     """将秒数格式化为 HH:MM:SS 格式"""
     hours = int(seconds // 3600)
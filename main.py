@@ -1,82 +1,597 @@
-import cv2
 import hashlib
+import json
 import os
-import numpy as np
+import uuid
 import argparse
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
 from config import *
-from download import is_url, download_video
-from image import extract_key_frames, save_images, format_timestamp
-from audio import extract_audio_from_video, transcribe_audio_with_whisper_server
-from text import process_with_local_llm, generate_markdown, save_text
+from download import (is_url, download_video, fetch_video_info, has_audio_only_format, get_video_key,
+                      download_stream, find_downloaded_video)
+from image import iter_key_frames, save_images_streaming, choose_strategy, get_video_info
+from audio import extract_audio_from_video, transcribe_audio, transcribe_video_stream
+from text import process_text_with_llm, generate_markdown_streaming, render_markdown, save_text
+from cache import ResultCache, make_key, restore_file
+from checkpoint import JobManifest, restore_output
+from fingerprint import compute_fingerprint
+from align import write_subtitles
+from media import MediaReader
+from dedup import dedup_frames, get_frame_index, VideoFrameIndex
+from metrics import (PeakMemoryMonitor, StageMetrics, Profiler, format_bytes, get_metrics_sink,
+                     get_profiler, set_profiler, in_current_context)
+from video_store import holding_videos
+from governor import get_resource_plan
 
 
 def get_video_md5(video_path):
-    """计算视频文件的 MD5 值"""
-    hash_md5 = hashlib.md5()
-    with open(video_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
-
-def main(input_path):
-    """主函数"""
-    try:
-        # 如果输入是URL，先下载视频
-        if is_url(input_path):
-            print(f"正在从 {input_path} 下载视频...")
-            video_path = download_video(input_path)
-            print(f"视频已下载到: {video_path}")
+    """计算视频文件的指纹（模式由 FINGERPRINT_MODE 决定）"""
+    return compute_fingerprint(video_path, FINGERPRINT_MODE)
+
+def fingerprint_with_audio_prefetch(video_path, timings):
+    """在后台线程计算视频指纹，同时提前将音频提取到临时文件
+    
+    完整MD5需要读取整个文件，与音频提取重叠执行可以隐藏这部分耗时。
+    如果之后发现转录结果已被缓存，提前提取的音频会被丢弃。
+    
+    Returns:
+        tuple: (视频指纹, 临时音频文件路径；提取失败时为None)
+    """
+    os.makedirs(AUDIO_DIR, exist_ok=True)
+    tmp_audio = os.path.join(AUDIO_DIR, f"tmp-{uuid.uuid4().hex}.wav")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        md5_future = executor.submit(run_stage, 'video_md5', timings, get_video_md5, video_path)
+        try:
+            run_stage('extract_audio', timings, extract_audio_from_video, video_path, tmp_audio)
+        except Exception as e:
+            # 提取失败不影响指纹计算，音频分支会重新提取
+            print(f"警告：提前提取音频失败: {str(e)}")
+            if os.path.exists(tmp_audio):
+                os.remove(tmp_audio)
+            tmp_audio = None
+        return md5_future.result(), tmp_audio
+
+def start_stream_downloads(url, timings, executor):
+    """流水线下载：获取视频信息后并行下载纯音频流和低分辨率视频流
+    
+    网站只提供音视频合一的格式时只下载一次视频，两个分支共用同一个文件。
+    两个流都已在视频存储中时直接使用，不请求网络。
+    
+    Returns:
+        tuple: (视频标识, 音频文件路径或Future, 视频文件路径或Future)
+    """
+    audio_path = find_downloaded_video(url, DOWNLOAD_AUDIO_FORMAT)
+    video_path = find_downloaded_video(url, DOWNLOAD_VIDEO_FORMAT)
+    if audio_path and video_path:
+        print("音频流和视频流都已下载过，跳过下载")
+        return get_video_key(url), audio_path, video_path
+    
+    info = run_stage('download_info', timings, fetch_video_info, url)
+    # 在当前任务的上下文中下载，使下载的视频在任务结束前不被淘汰
+    video_future = executor.submit(in_current_context(run_stage), 'download_video', timings,
+                                   download_stream, url, info, DOWNLOAD_VIDEO_FORMAT, 'video')
+    if has_audio_only_format(info):
+        audio_future = executor.submit(in_current_context(run_stage), 'download_audio', timings,
+                                       download_stream, url, info, DOWNLOAD_AUDIO_FORMAT, 'audio')
+    else:
+        print("没有单独的音频流，音频将从视频文件中提取")
+        audio_future = video_future
+    return get_video_key(url), audio_future, video_future
+
+def resolve(source):
+    """返回输入文件路径；流水线下载时等待对应的流下载完成"""
+    return source.result() if isinstance(source, Future) else source
+
+# 各阶段所属的资源类别，按类别限制并发（参见 set_stage_limits 和 apply_resource_plan）
+STAGE_CATEGORIES = {
+    'download': 'download',
+    'download_info': 'download',
+    'download_audio': 'download',
+    'download_video': 'download',
+    'video_md5': 'cpu',
+    'extract_audio': 'cpu',
+    'key_frames': 'cpu',
+    'render_markdown': 'cpu',
+    'transcribe': 'remote',
+    'llm': 'remote',
+}
+
+_stage_limits = {}
+_stage_limits_configured = False  # 批处理和服务模式通过 set_stage_limits 设置过并发限制
+
+class StageTimings(dict):
+    """阶段耗时记录，可以在阶段开始和结束时通知监听者（用于服务模式汇报进度）
+    
+    监听者为 listener(event, name, seconds)，event 为 'start' 或 'finish'。
+    每个阶段完整的资源使用记录（StageMetrics）按完成顺序保存在 stages 中。
+    """
+    def __init__(self, listener=None):
+        super().__init__()
+        self.listener = listener
+        self.stages = []
+    
+    def stage_started(self, name):
+        if self.listener:
+            self.listener('start', name, None)
+    
+    def stage_finished(self, name, seconds, metrics=None):
+        self[name] = seconds
+        if metrics is not None:
+            self.stages.append(metrics)
+        if self.listener:
+            self.listener('finish', name, seconds)
+
+def set_stage_limits(limits):
+    """设置各资源类别的最大并发阶段数
+    
+    Args:
+        limits (dict): 类别（'download'、'cpu'、'remote'）到最大并发数的映射，
+                       值为None或0表示不限制
+    """
+    global _stage_limits_configured
+    _stage_limits.clear()
+    _stage_limits.update({category: threading.BoundedSemaphore(n)
+                          for category, n in limits.items() if n})
+    _stage_limits_configured = True
+
+def apply_resource_plan():
+    """单独运行时按资源分配限制CPU阶段的并发数
+
+    资源分配按 cpu_stages 个阶段同时运行计算每个阶段的线程数（latency 模式下可能只有一个阶段，
+    独占全部核心）；不加限制时音频和关键帧两个分支同时运行，CPU 会被超额使用。
+    批处理和服务模式已经通过 set_stage_limits 设置了限制，不做改动。
+    """
+    if not _stage_limits_configured:
+        _stage_limits['cpu'] = threading.BoundedSemaphore(get_resource_plan()['cpu_stages'])
+
+def run_stage(name, timings, func, *args, **kwargs):
+    """执行单个处理阶段并记录耗时和资源使用
+    
+    如果通过 set_stage_limits 限制了该阶段所属类别的并发数，会先等待空闲名额，
+    记录的耗时不包含等待时间。开启性能剖析时阶段函数在 cProfile 下执行。
+    
+    Args:
+        name (str): 阶段名称
+        timings (dict): 阶段名称到耗时（秒）的映射，结果写入其中；
+                        为 StageTimings 时同时保存完整的 StageMetrics
+        func (callable): 阶段函数
+        
+    Returns:
+        阶段函数的返回值
+    """
+    with _stage_limits.get(STAGE_CATEGORIES.get(name)) or nullcontext():
+        if isinstance(timings, StageTimings):
+            timings.stage_started(name)
+        stage = StageMetrics(name)
+        profiler = get_profiler()
+        try:
+            with stage:
+                if profiler:
+                    return profiler.run_stage(name, func, *args, **kwargs)
+                return func(*args, **kwargs)
+        finally:
+            if isinstance(timings, StageTimings):
+                timings.stage_finished(name, stage.wall_seconds, stage)
+            else:
+                timings[name] = stage.wall_seconds
+
+def print_timings(timings, total, peak_memory=None):
+    """打印各阶段耗时统计（以及本次运行的峰值内存）"""
+    stages = {stage.stage: stage for stage in getattr(timings, 'stages', [])}
+    print("\n各阶段耗时：")
+    print("-" * 86)
+    print(f"{'stage':<20} {'wall':>10} {'cpu':>10} {'peak rss':>11} {'read':>11} {'write':>11} {'remote':>8}")
+    for name, elapsed in timings.items():
+        stage = stages.get(name)
+        if stage is None:
+            print(f"{name:<20} {elapsed:>10.2f}s")
+            continue
+        remote = sum(entry['requests'] for entry in stage.remote.values())
+        print(f"{name:<20} {elapsed:>10.2f}s {stage.cpu_seconds:>9.2f}s {format_bytes(stage.peak_rss):>11} "
+              f"{format_bytes(stage.io.get('read_bytes', 0)):>11} {format_bytes(stage.io.get('write_bytes', 0)):>11} "
+              f"{remote:>8}")
+    print("-" * 86)
+    # 各阶段耗时之和与实际总耗时的差值即为并行带来的节省
+    print(f"{'sum of stages':<20} {sum(timings.values()):>10.2f}s")
+    print(f"{'total':<20} {total:>10.2f}s")
+    if peak_memory is not None:
+        print(f"{'peak memory':<20} {format_bytes(peak_memory):>11}")
+
+def audio_settings():
+    """影响音频提取与转录结果的配置"""
+    return {'sample_rate': AUDIO_SAMPLE_RATE, 'codec': AUDIO_CODEC}
+
+def transcript_settings():
+    """影响转录结果的配置"""
+    # 流式转录总是分块进行
+    chunked = WHISPER_CHUNKED or AUDIO_STREAMING
+    settings = {'audio': audio_settings(), 'chunked': chunked,
+                'streaming': AUDIO_STREAMING, 'upload_format': WHISPER_UPLOAD_FORMAT}
+    if chunked:
+        settings.update(chunk_seconds=WHISPER_CHUNK_SECONDS, overlap=WHISPER_CHUNK_OVERLAP,
+                        split_mode=WHISPER_SPLIT_MODE, silence_search=WHISPER_SILENCE_SEARCH)
+    return settings
+
+def frame_settings():
+    """影响关键帧提取结果的配置"""
+    settings = {'max_images': MAX_IMAGES, 'mode': KEYFRAME_MODE, 'max_height': KEYFRAME_MAX_HEIGHT,
+                'jpeg_quality': IMAGE_JPEG_QUALITY}
+    if KEYFRAME_MODE == 'scene':
+        settings.update(metric=SCENE_METRIC, threshold=SCENE_THRESHOLD, sample_fps=SCENE_SAMPLE_FPS,
+                        min_gap=SCENE_MIN_GAP, thumb_size=SCENE_THUMB_SIZE)
+    else:
+        settings['strategy'] = KEYFRAME_STRATEGY
+    if FRAME_DEDUP != 'none':
+        settings.update(dedup=FRAME_DEDUP, dedup_hash=DEDUP_HASH, dedup_threshold=DEDUP_THRESHOLD)
+    if FRAME_INDEX_ENABLED:
+        settings.update(frame_index=FRAME_INDEX_PATH, frame_store=FRAME_STORE_DIR)
+    return settings
+
+def llm_settings():
+    """影响LLM处理结果的配置（包含其输入转录文本所依赖的配置）"""
+    return {
+        'transcript': transcript_settings(),
+        'enabled': LLM_PROCESS,
+        'model': LLM_MODEL,
+        'role_prompt': ROLE_PROMPT,
+        'prompt_template': PROMPT_TEMPLATE,
+        'temperature': LLM_TEMPERATURE,
+        'max_tokens': LLM_MAX_TOKENS,
+        'chunk_tokens': LLM_CHUNK_TOKENS,
+        # 流式模式不进行合并整理
+        'merge_pass': LLM_MERGE_PASS and not LLM_STREAM,
+        'merge_prompt_template': MERGE_PROMPT_TEMPLATE if LLM_MERGE_PASS and not LLM_STREAM else None,
+    }
+
+def process_audio(video_path, video_md5, audio_path, txt_path, timings, cache=None, prefetched_audio=None,
+                  manifest=None, reader=None):
+    """音频分支：提取音频并转录
+    
+    Args:
+        video_path (str|Future): 视频或音频文件路径；流水线下载时为音频流下载的Future
+        prefetched_audio (str): 已提前提取的音频文件路径，存在时跳过提取
+        manifest (JobManifest): 处理清单，已完成的阶段直接复用其输出
+        reader (MediaReader): 与关键帧分支共用的单次解码读取器，存在时从中读取音频
+    
+    Returns:
+        tuple: (转录的文本, 带时间戳的片段列表)
+    """
+    done = manifest.completed('transcript', transcript_settings()) if manifest else None
+    if done:
+        print("从处理清单恢复转录结果")
+        if prefetched_audio:
+            os.remove(prefetched_audio)
+        restore_output(done['outputs']['text'], txt_path)
+        with open(txt_path, 'r', encoding='utf-8') as f:
+            return f.read(), done['data'].get('segments', [])
+    
+    transcript_key = make_key(video_md5, 'transcript', transcript_settings())
+    entry = cache.get(transcript_key) if cache else None
+    if entry:
+        print("使用缓存的转录结果")
+        if prefetched_audio:
+            os.remove(prefetched_audio)
+        restore_file(entry['files']['transcript.txt'], txt_path)
+        if manifest:
+            manifest.mark_done('transcript', transcript_settings(), {'text': txt_path}, entry['data'])
+        with open(txt_path, 'r', encoding='utf-8') as f:
+            return f.read(), entry['data'].get('segments', [])
+    
+    audio_done = manifest.completed('audio', audio_settings()) if manifest and AUDIO_KEEP_FILE else None
+    audio_key = make_key(video_md5, 'audio', audio_settings())
+    entry = cache.get(audio_key) if cache and not audio_done else None
+    with manifest.recording_failure('transcript') if manifest else nullcontext():
+        if reader:
+            print("正在转录单次解码的音频流...")
+            result = run_stage('transcribe', timings, reader.transcribe, AUDIO_KEEP_FILE)
+            if manifest and AUDIO_KEEP_FILE:
+                manifest.mark_done('audio', audio_settings(), {'audio': audio_path})
+        elif AUDIO_STREAMING and not prefetched_audio and not audio_done and not entry:
+            # 直接从 ffmpeg 管道读取音频并转录，只在需要保留时写入 WAV 文件
+            print("正在流式提取并转录音频...")
+            result = run_stage('transcribe', timings, transcribe_video_stream, resolve(video_path),
+                               audio_path if AUDIO_KEEP_FILE else None)
+            if manifest and AUDIO_KEEP_FILE:
+                manifest.mark_done('audio', audio_settings(), {'audio': audio_path})
         else:
-            video_path = input_path
+            if audio_done:
+                print("从处理清单恢复音频文件")
+                if prefetched_audio:
+                    os.remove(prefetched_audio)
+                restore_output(audio_done['outputs']['audio'], audio_path)
+            elif prefetched_audio:
+                os.replace(prefetched_audio, audio_path)
+                if cache and not entry and AUDIO_KEEP_FILE:
+                    cache.put(audio_key, files={'audio.wav': audio_path})
+            elif entry:
+                print("使用缓存的音频文件")
+                restore_file(entry['files']['audio.wav'], audio_path)
+            else:
+                print("正在提取音频...")
+                run_stage('extract_audio', timings, extract_audio_from_video, resolve(video_path), audio_path)
+                if cache and AUDIO_KEEP_FILE:
+                    cache.put(audio_key, files={'audio.wav': audio_path})
+            if manifest and AUDIO_KEEP_FILE and not audio_done:
+                manifest.mark_done('audio', audio_settings(), {'audio': audio_path})
             
-        if not os.path.exists(video_path):
-            raise FileNotFoundError(f"视频文件不存在: {video_path}")
-        
-        # 获取当前日期和视频MD5
-        current_date = datetime.now().strftime('%Y%m%d')
-        video_md5 = get_video_md5(video_path)
-        
-        # 准备输出路径
-        audio_path = os.path.join(AUDIO_DIR, f"{current_date}-{video_md5}.wav")
-        md_path = os.path.join(MD_DIR, f"{current_date}-{video_md5}.md")
-        txt_path = os.path.join(MD_DIR, f"{current_date}-{video_md5}.txt")
-        image_dir = os.path.join(MD_DIR, video_md5)
-        
-        # 确保必要的目录存在
-        os.makedirs(AUDIO_DIR, exist_ok=True)
-        os.makedirs(MD_DIR, exist_ok=True)
-        os.makedirs(image_dir, exist_ok=True)
+            print("正在转录音频...")
+            result = run_stage('transcribe', timings, transcribe_audio, audio_path)
+            if not AUDIO_KEEP_FILE:
+                os.remove(audio_path)
+    
+    text = result['text']
+    save_text(text, txt_path)
+    if cache:
+        cache.put(transcript_key, files={'transcript.txt': txt_path}, data={'segments': result['segments']})
+    if manifest:
+        manifest.mark_done('transcript', transcript_settings(), {'text': txt_path}, {'segments': result['segments']})
+    return text, result['segments']
+
+def process_frames(video_path, video_md5, image_dir, timings, cache=None, manifest=None, reader=None):
+    """关键帧分支：提取并保存关键帧
+    
+    Args:
+        video_path (str|Future): 视频文件路径；流水线下载时为视频流下载的Future
+        reader (MediaReader): 与音频分支共用的单次解码读取器，存在时从中读取关键帧
+    
+    Returns:
+        tuple: (图片路径列表, 关键帧时间位置列表)
+    """
+    done = manifest.completed('frames', frame_settings()) if manifest else None
+    if done:
+        print("从处理清单恢复关键帧图片")
+        image_paths = []
+        for src in done['outputs']['images']:
+            if os.path.dirname(os.path.abspath(src)) != os.path.abspath(image_dir):
+                # 通过跨视频索引引用的其他视频的图片
+                image_paths.append(src)
+                continue
+            img_path = os.path.join(image_dir, os.path.basename(src))
+            restore_output(src, img_path)
+            image_paths.append(img_path)
+        return image_paths, done['data']['positions']
+    
+    frames_key = make_key(video_md5, 'frames', frame_settings())
+    entry = cache.get(frames_key) if cache else None
+    if entry:
+        print("使用缓存的关键帧图片")
+        image_paths = []
+        for name in entry['data']['images']:
+            img_path = os.path.join(image_dir, name)
+            restore_file(entry['files'][name], img_path)
+            image_paths.append(img_path)
+        positions = entry['data']['positions']
+    else:
+        # 解码与JPEG编码流水线执行，不在内存中保留全部完整分辨率的帧
+        print("正在提取并保存关键帧...")
+        with manifest.recording_failure('frames') if manifest else nullcontext():
+            # 配置显式传入（而不是依赖导入时绑定的默认参数），与 frame_settings() 读取的值保持一致
+            frames = reader.frames() if reader else iter_key_frames(resolve(video_path), MAX_IMAGES, KEYFRAME_STRATEGY,
+                                                                    KEYFRAME_MAX_HEIGHT, KEYFRAME_MODE)
+            frames = dedup_frames(frames, FRAME_DEDUP, DEDUP_HASH, DEDUP_THRESHOLD, DEDUP_BATCH_SIZE)
+            frame_index = get_frame_index()
+            index = frame_index and VideoFrameIndex(frame_index, video_md5, DEDUP_HASH, DEDUP_THRESHOLD,
+                                                    DEDUP_BATCH_SIZE)
+            image_paths, positions = run_stage('key_frames', timings, save_images_streaming, frames, image_dir,
+                                               IMAGE_JPEG_QUALITY, IMAGE_ENCODE_WORKERS, index=index)
+        if cache:
+            # 引用的其他视频的图片也复制到缓存条目中，按顺序重新编号以免与本视频的文件重名
+            names = [f"{i}.jpg" for i in range(1, len(image_paths) + 1)]
+            cache.put(frames_key,
+                      files=dict(zip(names, image_paths)),
+                      data={'images': names, 'positions': positions})
+    if manifest:
+        manifest.mark_done('frames', frame_settings(), {'images': image_paths}, {'positions': positions})
+    return image_paths, positions
+
+def has_result(stage, settings, video_md5, cache=None, manifest=None):
+    """查询阶段结果是否已经在处理清单或缓存中"""
+    if manifest and manifest.completed(stage, settings):
+        return True
+    return bool(cache and cache.get(make_key(video_md5, stage, settings)))
+
+def single_decode_strategy(video_path, video_md5, cache=None, manifest=None):
+    """判断是否由同一个 ffmpeg 进程同时解码音频和关键帧
+    
+    只有两个分支都需要解码同一个本地文件时才有收益：任一分支的结果可以从清单或缓存复用时，
+    单独解码另一个分支更快。单次解码需要解码所有视频帧（I帧策略只解码关键帧），
+    因此只在关键帧分支本来就要顺序解码整个视频时使用；seek 策略只解码目标帧附近的少量帧，
+    改为单次解码反而慢很多。
+    
+    Returns:
+        str: 单次解码使用的关键帧提取策略（auto 已解析为具体策略）；不使用单次解码时返回None
+    """
+    if not (SINGLE_DECODE and PARALLEL_STAGES and os.name == 'posix') or isinstance(video_path, Future):
+        return None
+    if (has_result('transcript', transcript_settings(), video_md5, cache, manifest)
+            or has_result('audio', audio_settings(), video_md5, cache, manifest)
+            or has_result('frames', frame_settings(), video_md5, cache, manifest)):
+        return None
+    strategy = KEYFRAME_STRATEGY
+    if KEYFRAME_MODE == 'uniform' and strategy == 'auto':
+        strategy = choose_strategy(video_path, get_video_info(video_path), MAX_IMAGES)
+    if KEYFRAME_MODE == 'uniform' and strategy == 'seek':
+        return None
+    return strategy
+
+def markdown_settings(text, image_paths, positions, segments=None):
+    """影响 Markdown 文件内容的配置和输入（输入以内容哈希表示，转录或关键帧变化时需要重新生成）"""
+    settings = {
+        'llm': llm_settings(),
+        'text_sha256': hashlib.sha256(text.encode('utf-8')).hexdigest(),
+        'images': [os.path.basename(path) for path in image_paths],
+        'positions': positions,
+        'placement': FRAME_PLACEMENT,
+    }
+    if FRAME_PLACEMENT == 'inline':
+        settings['segments_sha256'] = hashlib.sha256(
+            json.dumps(segments or [], sort_keys=True).encode('utf-8')).hexdigest()
+    return settings
+
+def process_markdown(text, video_md5, image_paths, positions, md_path, timings, cache=None, manifest=None,
+                     segments=None):
+    """文本阶段：使用LLM处理转录文本并生成 Markdown 文件
+    
+    Args:
+        segments (list): 带时间戳的转录片段，FRAME_PLACEMENT 为 'inline' 时用于将关键帧插入到对应段落
+    """
+    settings = markdown_settings(text, image_paths, positions, segments)
+    # 不读取LLM缓存时也不复用上次生成的 Markdown，确保重新请求LLM
+    bypass = LLM_PROCESS and LLM_CACHE_BYPASS
+    done = manifest.completed('markdown', settings) if manifest and not bypass else None
+    if done:
+        print("从处理清单恢复Markdown文件")
+        restore_output(done['outputs']['markdown'], md_path)
+        return
+    
+    failures = 0
+    streamed = False
+    with manifest.recording_failure('markdown') if manifest else nullcontext():
+        if LLM_PROCESS:
+            llm_key = make_key(video_md5, 'llm', llm_settings())
+            entry = cache.get(llm_key) if cache and not bypass else None
+            if entry:
+                print("使用缓存的LLM处理结果")
+                processed_text = entry['data']['text']
+            else:
+                if LLM_STREAM:
+                    # 流式模式下LLM输出直接写入 Markdown 文件
+                    processed_text, failures = run_stage('llm', timings, generate_markdown_streaming,
+                                                         text, image_paths, positions, md_path)
+                    streamed = True
+                else:
+                    processed_text, failures = run_stage('llm', timings, process_text_with_llm, text)
+                # 有块处理失败时保留了原文，此时不写入缓存以便下次重试
+                if cache and not failures:
+                    cache.put(llm_key, data={'text': processed_text})
+        else:
+            processed_text = text
         
-        print("开始处理视频...")
+        # 流式输出的关键帧集中在文末，按时间对齐时需要根据完整的段落重新生成
+        if not streamed or (FRAME_PLACEMENT == 'inline' and segments):
+            run_stage('render_markdown', timings, render_markdown, processed_text, image_paths, positions, md_path,
+                      segments)
+    
+    # 同样地，包含未处理原文的 Markdown 不记为完成，下次运行会重新调用LLM
+    if manifest and not failures:
+        manifest.mark_done('markdown', settings, {'markdown': md_path})
+
+def main(input_path, listener=None):
+    """主函数
+    
+    Args:
+        input_path (str): 视频文件路径或视频URL
+        listener (callable): 可选，阶段开始/结束时的回调，参见 StageTimings
+    
+    Returns:
+        dict: 包含 video_path、md_path、timings（各阶段耗时）和 elapsed（总耗时）
+    """
+    start_time = time.perf_counter()
+    timings = StageTimings(listener)
+    downloads = ThreadPoolExecutor(max_workers=2)
+    video_md5 = None
+    profiler = Profiler(PROFILE_DIR) if PROFILE_DIR else None
+    set_profiler(profiler)
+    apply_resource_plan()
+    # 任务使用的视频在处理完成前持有共享锁，不会被视频存储的LRU淘汰删除
+    with PeakMemoryMonitor() as memory, profiler or nullcontext(), holding_videos():
+        try:
+            current_date = datetime.now().strftime('%Y%m%d')
+            prefetched_audio = None
+            if is_url(input_path) and DOWNLOAD_PIPELINED:
+                # 音频流和视频流分别下载，各分支只等待自己需要的流
+                print(f"正在从 {input_path} 分别下载音频流和视频流...")
+                video_md5, audio_source, video_path = start_stream_downloads(input_path, timings, downloads)
+            else:
+                # 如果输入是URL，先下载视频
+                if is_url(input_path):
+                    print(f"正在从 {input_path} 下载视频...")
+                    video_path = run_stage('download', timings, download_video, input_path)
+                    print(f"视频已下载到: {video_path}")
+                else:
+                    video_path = input_path
+                
+                if not os.path.exists(video_path):
+                    raise FileNotFoundError(f"视频文件不存在: {video_path}")
+                
+                # 获取视频MD5
+                if FINGERPRINT_MODE == 'full' and FINGERPRINT_BACKGROUND:
+                    video_md5, prefetched_audio = fingerprint_with_audio_prefetch(video_path, timings)
+                else:
+                    video_md5 = run_stage('video_md5', timings, get_video_md5, video_path)
+                audio_source = video_path
         
-        # 1. 提取并转录音频
-        print("正在提取音频...")
-        extract_audio_from_video(video_path, audio_path)
+            # 准备输出路径
+            audio_path = os.path.join(AUDIO_DIR, f"{current_date}-{video_md5}.wav")
+            md_path = os.path.join(MD_DIR, f"{current_date}-{video_md5}.md")
+            txt_path = os.path.join(MD_DIR, f"{current_date}-{video_md5}.txt")
+            image_dir = os.path.join(MD_DIR, video_md5)
         
-        print("正在转录音频...")
-        text = transcribe_audio_with_whisper_server(audio_path)
-        save_text(text, txt_path)
+            # 确保必要的目录存在
+            os.makedirs(AUDIO_DIR, exist_ok=True)
+            os.makedirs(MD_DIR, exist_ok=True)
+            os.makedirs(image_dir, exist_ok=True)
         
-        # 2. 提取并保存关键帧
-        print("正在提取关键帧...")
-        frames, positions = extract_key_frames(video_path)
+            print("开始处理视频...")
+            cache = ResultCache(CACHE_DIR, CACHE_MAX_SIZE_MB, CACHE_MAX_AGE_DAYS) if CACHE_ENABLED else None
+            # 处理清单记录已完成的阶段，上次运行中断时从第一个未完成的阶段继续
+            manifest = JobManifest.for_video(video_md5, MD_DIR) if CHECKPOINT_ENABLED else None
         
-        print("正在保存关键帧图片...")
-        image_paths = save_images(frames, image_dir)
+            # 音频分支（提取+转录）与关键帧分支相互独立，可以并行执行；
+            # 性能剖析时顺序执行，使两个分支的阶段都能被剖析
+            if PARALLEL_STAGES and not profiler:
+                strategy = (audio_source is video_path and not prefetched_audio
+                            and single_decode_strategy(video_path, video_md5, cache, manifest))
+                with MediaReader(video_path, audio_path, MAX_IMAGES, strategy, KEYFRAME_MAX_HEIGHT,
+                                 KEYFRAME_MODE) if strategy else nullcontext() as reader, \
+                        ThreadPoolExecutor(max_workers=2) as executor:
+                    audio_future = executor.submit(process_audio, audio_source, video_md5, audio_path, txt_path, timings, cache,
+                                                   prefetched_audio, manifest, reader)
+                    frames_future = executor.submit(process_frames, video_path, video_md5, image_dir, timings, cache,
+                                                    manifest, reader)
+                    text, segments = audio_future.result()
+                    image_paths, positions = frames_future.result()
+            else:
+                text, segments = process_audio(audio_source, video_md5, audio_path, txt_path, timings, cache,
+                                               prefetched_audio, manifest)
+                image_paths, positions = process_frames(video_path, video_md5, image_dir, timings, cache, manifest)
         
-        # 3. 生成markdown文件
-        print("正在生成Markdown文件...")
-        generate_markdown(text, image_paths, positions, md_path)
+            # 3. 生成markdown文件
+            print("正在生成Markdown文件...")
+            process_markdown(text, video_md5, image_paths, positions, md_path, timings, cache, manifest, segments)
+            if SUBTITLE_FORMATS:
+                subtitle_paths = write_subtitles(segments, os.path.splitext(md_path)[0], SUBTITLE_FORMATS)
+                print(f"字幕文件已生成: {', '.join(subtitle_paths)}")
         
-        print(f"处理完成！Markdown文件已生成: {md_path}")
+            print(f"处理完成！Markdown文件已生成: {md_path}")
+            elapsed = time.perf_counter() - start_time
+            print_timings(timings, elapsed, memory.peak)
+            return {'video_path': resolve(video_path), 'md_path': md_path, 'timings': timings, 'elapsed': elapsed}
         
-    except Exception as e:
-        print(f"处理失败: {str(e)}")
-        raise
+        except Exception as e:
+            print(f"处理失败: {str(e)}")
+            raise
+        finally:
+            downloads.shutdown()
+            set_profiler(None)
+            get_metrics_sink().emit({'input': input_path, 'video_md5': video_md5}, timings.stages)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="将视频文件或在线视频转换为包含音频转录文本和关键帧图片的 Markdown 文件")
     parser.add_argument('input_path', type=str, help="输入的视频文件路径或视频URL")
+    parser.add_argument('--no-llm-cache', action='store_true', help="不读取LLM回复缓存（仍会写入新的回复）")
+    parser.add_argument('--metrics', default=None, help="阶段指标的输出文件（.prom 结尾时使用 Prometheus 文本格式，否则为 JSON-lines）")
+    parser.add_argument('--profile', default=None, help="对本次运行进行 cProfile/tracemalloc 剖析，结果保存到该目录")
     args = parser.parse_args()
+    if args.metrics:
+        from metrics import MetricsSink, set_metrics_sink
+        set_metrics_sink(MetricsSink(args.metrics, 'prometheus' if args.metrics.endswith('.prom') else 'jsonl'))
+    if args.profile:
+        PROFILE_DIR = args.profile
+    if args.no_llm_cache:
+        import text
+        LLM_CACHE_BYPASS = True
+        text.LLM_CACHE_BYPASS = True
     main(args.input_path)
@@ -0,0 +1,195 @@
+import os
+import subprocess
+import threading
+import wave
+from config import *
+from image import (get_video_info, compute_target_frames, scaled_size, choose_strategy, nearest_frames,
+                   select_scene_frames, iter_raw_frames, ShowinfoTimestamps, FRAME_STRATEGIES)
+from audio import transcribe_pcm_source, transcribe_audio
+from checkpoint import temp_path_for
+from governor import stage_threads
+
+WAV_HEADER_SIZE = 44  # wave 模块写入的 PCM WAV 文件头长度
+
+class MediaReader:
+    """单次解复用读取媒体：同一个 ffmpeg 进程同时输出重采样的音频和选中的关键帧
+
+    音频以单声道 s16le PCM 输出到 stdout，由后台线程持续写入临时 WAV 文件，
+    转录从这个不断增长的文件中顺序读取，因此转录较慢时不会阻塞解码。
+    视频帧经过 select/fps/scale 滤镜后以 BGR 原始数据输出到单独的管道（pass_fds），
+    时间位置由 showinfo 滤镜提供。只支持 POSIX 系统。
+
+    用法：
+        with MediaReader(video_path, audio_path) as reader:
+            # 两个分支在不同线程中同时消费
+            result = reader.transcribe(keep_audio=True)
+            image_paths, positions = save_images_streaming(reader.frames(), image_dir)
+    """
+    def __init__(self, video_path, audio_path, max_images=MAX_IMAGES, strategy=KEYFRAME_STRATEGY,
+                 max_height=KEYFRAME_MAX_HEIGHT, mode=KEYFRAME_MODE):
+        self.video_path = video_path
+        self.audio_path = audio_path
+        self.sample_rate = int(AUDIO_SAMPLE_RATE)
+        info = get_video_info(video_path)
+        self.width, self.height = scaled_size(info['width'], info['height'], max_height)
+        self._input_args, filters, self._select = self._frame_plan(video_path, info, max_images, strategy,
+                                                                   max_height, mode)
+        self._filters = filters + [f"scale={self.width}:{self.height}", "showinfo"]
+        self.process = None
+
+    @staticmethod
+    def _frame_plan(video_path, info, max_images, strategy, max_height, mode):
+        """根据关键帧选择模式确定解码参数和滤镜
+
+        Returns:
+            tuple: (输入参数, 缩放之前的滤镜, 从解码出的帧中选择关键帧的函数)
+        """
+        if mode == 'scene':
+            return [], [f"fps={SCENE_SAMPLE_FPS}"], \
+                lambda frames: select_scene_frames(frames, max_images, max_height, SCENE_THRESHOLD,
+                                                   SCENE_BATCH_SIZE, SCENE_MIN_GAP, SCENE_METRIC)
+        if mode != 'uniform':
+            raise ValueError(f"不支持的关键帧选择模式: {mode}")
+
+        if strategy == 'auto':
+            strategy = choose_strategy(video_path, info, max_images)
+        if strategy not in FRAME_STRATEGIES:
+            raise ValueError(f"不支持的关键帧提取策略: {strategy}")
+        targets = compute_target_frames(info['total_frames'], max_images)
+        if strategy == 'keyframe':
+            target_times = [target_frame / info['fps'] for target_frame in targets]
+            return ['-skip_frame:v', 'nokey'], [], lambda frames: nearest_frames(frames, target_times)
+        # seek 和 sequential 都按帧序号精确取帧，这里由 select 滤镜在缩放之前丢弃非目标帧；
+        # 这需要解码所有帧，seek 策略应优先使用两个进程分别解码（参见 main.single_decode_strategy）
+        expression = '+'.join(f"eq(n\\,{target_frame})" for target_frame in targets) or '0'
+        return [], [f"select={expression}"], lambda frames: frames
+
+    def start(self):
+        frames_read, frames_write = os.pipe()
+        threads = stage_threads()
+        threads = ['-threads', str(threads)] if threads else []
+        command = [
+            'ffmpeg', '-nostdin', '-hide_banner', *self._input_args, *threads, '-i', self.video_path,
+            '-map', '0:v:0', '-vf', ','.join(self._filters), '-vsync', 'vfr',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', f'pipe:{frames_write}',
+            '-map', '0:a:0', '-ac', '1', '-ar', AUDIO_SAMPLE_RATE, '-acodec', AUDIO_CODEC,
+            '-f', 's16le', 'pipe:1',
+        ]
+        try:
+            self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                            pass_fds=(frames_write,))
+        except BaseException:
+            os.close(frames_read)
+            raise
+        finally:
+            os.close(frames_write)
+        self._frames_pipe = os.fdopen(frames_read, 'rb')
+        self._timestamps = ShowinfoTimestamps(self.process.stderr)
+
+        self._audio_tmp = temp_path_for(self.audio_path)
+        os.makedirs(os.path.dirname(self.audio_path) or '.', exist_ok=True)
+        self._audio_written = 0
+        self._audio_done = False
+        self._audio_ready = threading.Condition()
+        self._audio_file = open(self._audio_tmp, 'wb')
+        self._audio_reader = open(self._audio_tmp, 'rb')
+        self._audio_reader.seek(WAV_HEADER_SIZE)
+        self._audio_thread = threading.Thread(target=self._drain_audio, daemon=True)
+        self._audio_thread.start()
+        return self
+
+    def _drain_audio(self):
+        """将 ffmpeg 输出的音频持续写入临时 WAV 文件"""
+        try:
+            with wave.open(self._audio_file, 'wb') as wav:
+                wav.setnchannels(1)
+                wav.setsampwidth(2)
+                wav.setframerate(self.sample_rate)
+                for data in iter(lambda: self.process.stdout.read1(1024 * 1024), b''):
+                    wav.writeframes(data)
+                    self._audio_file.flush()
+                    with self._audio_ready:
+                        self._audio_written += len(data)
+                        self._audio_ready.notify_all()
+        finally:
+            self._audio_file.close()
+            with self._audio_ready:
+                self._audio_done = True
+                self._audio_ready.notify_all()
+
+    def read_audio(self, n):
+        """读取 n 字节的 PCM 数据，数据还没有解码出来时等待；返回空bytes表示音频结束"""
+        position = self._audio_reader.tell() - WAV_HEADER_SIZE
+        with self._audio_ready:
+            self._audio_ready.wait_for(lambda: self._audio_written - position >= n or self._audio_done)
+            available = self._audio_written - position
+        return self._audio_reader.read(min(n, available))
+
+    def transcribe(self, keep_audio=AUDIO_KEEP_FILE):
+        """转录音频，完成后将 WAV 文件保存到 audio_path（keep_audio 为 False 时删除）
+        
+        WHISPER_CHUNKED 为 True 时边解码边分块转录；否则等待音频全部写入临时 WAV 文件后整段上传，
+        与非单次解码时的整段转录相同，不在内存中拼接完整的音频。
+        
+        Returns:
+            dict: {'text': 完整文本, 'segments': [{'start', 'end', 'text'}]}
+        """
+        try:
+            if WHISPER_CHUNKED:
+                result = transcribe_pcm_source(self.read_audio, self.sample_rate)
+            else:
+                self.wait()
+                result = transcribe_audio(self._audio_tmp)
+        except Exception:
+            # 解码失败导致音频不完整时优先报告解码错误
+            self.wait()
+            raise
+        self.wait()
+        if keep_audio:
+            os.replace(self._audio_tmp, self.audio_path)
+        return result
+
+    def frames(self):
+        """产出选中的关键帧，消费中途出错时终止 ffmpeg
+
+        Yields:
+            tuple: (帧, 时间位置（秒）)
+        """
+        try:
+            yield from self._select(iter_raw_frames(self._frames_pipe, self.width, self.height, self._timestamps))
+        except BaseException:
+            self.process.kill()
+            raise
+        self.wait()
+
+    def wait(self):
+        """等待 ffmpeg 结束，解码失败时抛出异常"""
+        self._audio_thread.join()
+        self.process.wait()
+        self._timestamps.join()
+        if self.process.returncode != 0:
+            errors = [line for line in self._timestamps.errors if not line.startswith(' ')]
+            raise Exception(f"媒体解码失败: {' '.join(errors[-3:])}")
+
+    def close(self):
+        """终止未结束的 ffmpeg 并清理管道和临时文件"""
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.kill()
+        self._frames_pipe.close()
+        self.process.wait()
+        self._audio_thread.join()
+        self._timestamps.join()
+        self.process.stdout.close()
+        self.process.stderr.close()
+        self._audio_reader.close()
+        if os.path.exists(self._audio_tmp):
+            os.remove(self._audio_tmp)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -0,0 +1,375 @@
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from config import *
+from checkpoint import atomic_output
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+def current_rss():
+    """读取当前进程的常驻内存（字节）
+
+    优先读取 /proc/self/statm；不可用时退回到 ru_maxrss（历史峰值）。
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return max_rss()
+
+def max_rss():
+    """进程生命周期内的峰值常驻内存（字节），无法获取时返回0"""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 上单位为KB，macOS 上单位为字节
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class PeakMemoryMonitor:
+    """在后台线程定期采样常驻内存，记录代码块执行期间的峰值
+
+    ru_maxrss 只能给出进程生命周期内的峰值，无法区分单次运行，
+    因此这里通过采样得到某个时间段内的峰值。
+
+    用法：
+        with PeakMemoryMonitor() as monitor:
+            ...
+        print(monitor.peak)
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.start = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self.start = self.peak = current_rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+        return False
+
+    @property
+    def growth(self):
+        """峰值相对于开始时增加的内存（字节）"""
+        return self.peak - self.start
+
+def format_bytes(size):
+    """将字节数格式化为便于阅读的字符串"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024 or unit == 'GB':
+            return f"{size:.1f}{unit}" if unit != 'B' else f"{size}B"
+        size /= 1024
+
+def read_proc_io():
+    """读取 /proc/self/io 中的读写字节数
+
+    包含已退出并被回收的子进程（例如 ffmpeg）的读写量；不可用时返回None。
+
+    Returns:
+        dict: {'read_bytes', 'write_bytes', 'rchar', 'wchar'}
+    """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return {name: int(fields[name]) for name in ('read_bytes', 'write_bytes', 'rchar', 'wchar')}
+    except (OSError, ValueError, KeyError):
+        return None
+
+def cpu_seconds():
+    """本进程及已回收子进程的CPU时间（秒）"""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+_current_stage = contextvars.ContextVar('current_stage', default=None)
+
+def record_remote(service, seconds, ok=True):
+    """记录一次远程请求（Whisper/LLM）的耗时，计入当前阶段"""
+    stage = _current_stage.get()
+    if stage is not None:
+        stage.record_remote(service, seconds, ok)
+
+def in_current_context(func):
+    """包装函数，使其在线程池中执行时沿用提交时的上下文
+
+    远程请求通过上下文找到所属阶段，提交到线程池的任务需要用它包装。
+    """
+    context = contextvars.copy_context()
+    def run(*args, **kwargs):
+        # 同一个 Context 不能同时在多个线程中进入，每次调用使用副本
+        return context.copy().run(func, *args, **kwargs)
+    return run
+
+class StageMetrics:
+    """单个阶段的资源使用记录
+
+    记录墙钟时间、CPU时间、峰值常驻内存、磁盘读写字节数和远程请求耗时。
+    CPU时间、内存和读写量是整个进程的数值（包括 ffmpeg 等子进程），
+    与其他阶段并行执行时会包含对方的消耗；thread_cpu_seconds 只统计阶段所在线程。
+
+    用法：
+        with StageMetrics('transcribe') as stage:
+            ...
+        print(stage.as_dict())
+    """
+    def __init__(self, stage, memory_interval=0.1):
+        self.stage = stage
+        self.ok = None
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.thread_cpu_seconds = 0.0
+        self.io = {}
+        self.remote = {}
+        self._lock = threading.Lock()
+        self._memory = PeakMemoryMonitor(memory_interval)
+
+    def record_remote(self, service, seconds, ok=True):
+        with self._lock:
+            entry = self.remote.setdefault(service, {'requests': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            entry['requests'] += 1
+            entry['errors'] += 0 if ok else 1
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+
+    def __enter__(self):
+        self._memory.__enter__()
+        self._io_start = read_proc_io()
+        self._cpu_start = cpu_seconds()
+        self._thread_cpu_start = time.thread_time()
+        self._wall_start = time.perf_counter()
+        self._token = _current_stage.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_stage.reset(self._token)
+        self.wall_seconds = time.perf_counter() - self._wall_start
+        self.thread_cpu_seconds = time.thread_time() - self._thread_cpu_start
+        self.cpu_seconds = cpu_seconds() - self._cpu_start
+        io_end = read_proc_io()
+        if self._io_start and io_end:
+            self.io = {name: io_end[name] - self._io_start[name] for name in io_end}
+        self._memory.__exit__(exc_type, exc, tb)
+        self.ok = exc_type is None
+        return False
+
+    @property
+    def peak_rss(self):
+        return self._memory.peak
+
+    def as_dict(self):
+        return {
+            'stage': self.stage,
+            'ok': self.ok,
+            'wall_seconds': round(self.wall_seconds, 6),
+            'cpu_seconds': round(self.cpu_seconds, 6),
+            'thread_cpu_seconds': round(self.thread_cpu_seconds, 6),
+            'peak_rss_bytes': self.peak_rss,
+            'io': self.io,
+            'remote': self.remote,
+        }
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class MetricsSink:
+    """将阶段记录输出为 JSON-lines 或 Prometheus 文本格式
+
+    - jsonl：每个阶段追加一行JSON，包含任务标识和全部记录字段
+    - prometheus：在内存中累加各阶段的计数，每次输出时整体重写文件
+      （可供 node_exporter 的 textfile collector 读取，服务模式下也通过 /metrics 提供）
+    """
+    def __init__(self, path=METRICS_OUTPUT, fmt=METRICS_FORMAT):
+        if fmt not in ('jsonl', 'prometheus'):
+            raise ValueError(f"不支持的指标格式: {fmt}")
+        self.path = path
+        self.format = fmt
+        self._lock = threading.Lock()
+        self._totals = {}
+        self._remote = {}
+
+    def emit(self, job, stages):
+        """输出一个任务的阶段记录
+
+        Args:
+            job (dict): 任务标识，例如 {'input': ..., 'video_md5': ...}
+            stages (list): StageMetrics 列表
+        """
+        with self._lock:
+            for stage in stages:
+                self._accumulate(stage)
+            if not self.path:
+                return
+            if self.format == 'jsonl':
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    for stage in stages:
+                        f.write(json.dumps({'time': time.time(), **job, **stage.as_dict()},
+                                           ensure_ascii=False) + '\n')
+            else:
+                with atomic_output(self.path) as tmp_path:
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        f.write(self._render())
+
+    def _accumulate(self, stage):
+        totals = self._totals.setdefault(stage.stage, {
+            'runs_ok': 0, 'runs_failed': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+            'read_bytes': 0, 'write_bytes': 0, 'peak_rss_bytes': 0})
+        totals['runs_ok' if stage.ok else 'runs_failed'] += 1
+        totals['wall_seconds'] += stage.wall_seconds
+        totals['cpu_seconds'] += stage.cpu_seconds
+        totals['read_bytes'] += stage.io.get('read_bytes', 0)
+        totals['write_bytes'] += stage.io.get('write_bytes', 0)
+        totals['peak_rss_bytes'] = max(totals['peak_rss_bytes'], stage.peak_rss)
+        for service, entry in stage.remote.items():
+            remote = self._remote.setdefault(service, {'requests': 0, 'errors': 0, 'seconds': 0.0})
+            for name in remote:
+                remote[name] += entry[name]
+
+    def _render(self):
+        lines = []
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP video2md_{name} {help_text}")
+            lines.append(f"# TYPE video2md_{name} {kind}")
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{escape_label(val)}"' for key, val in labels.items())
+                lines.append(f"video2md_{name}{{{label_text}}} {value}")
+
+        stages = sorted(self._totals.items())
+        metric('stage_runs_total', 'counter', "Stage executions by status.",
+               [({'stage': name, 'status': status}, totals[f'runs_{status}'])
+                for name, totals in stages for status in ('ok', 'failed')])
+        metric('stage_wall_seconds_total', 'counter', "Wall-clock time spent in each stage.",
+               [({'stage': name}, totals['wall_seconds']) for name, totals in stages])
+        metric('stage_cpu_seconds_total', 'counter', "Process and child CPU time during each stage.",
+               [({'stage': name}, totals['cpu_seconds']) for name, totals in stages])
+        metric('stage_read_bytes_total', 'counter', "Bytes read from storage during each stage.",
+               [({'stage': name}, totals['read_bytes']) for name, totals in stages])
+        metric('stage_write_bytes_total', 'counter', "Bytes written to storage during each stage.",
+               [({'stage': name}, totals['write_bytes']) for name, totals in stages])
+        metric('stage_peak_rss_bytes', 'gauge', "Highest resident set size observed during each stage.",
+               [({'stage': name}, totals['peak_rss_bytes']) for name, totals in stages])
+        remote = sorted(self._remote.items())
+        metric('remote_requests_total', 'counter', "Requests to remote inference services.",
+               [({'service': name}, entry['requests']) for name, entry in remote])
+        metric('remote_errors_total', 'counter', "Failed requests to remote inference services.",
+               [({'service': name}, entry['errors']) for name, entry in remote])
+        metric('remote_seconds_total', 'counter', "Latency of requests to remote inference services.",
+               [({'service': name}, entry['seconds']) for name, entry in remote])
+        return '\n'.join(lines) + '\n'
+
+    def render_prometheus(self):
+        """返回累计指标的 Prometheus 文本格式"""
+        with self._lock:
+            return self._render()
+
+_sink = None
+_sink_lock = threading.Lock()
+
+def set_metrics_sink(sink):
+    """替换进程内共享的指标输出（例如命令行指定了输出文件）"""
+    global _sink
+    with _sink_lock:
+        _sink = sink
+
+def get_metrics_sink():
+    """获取进程内共享的指标输出"""
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            _sink = MetricsSink()
+        return _sink
+
+class Profiler:
+    """单次运行的性能剖析：阶段在 cProfile 下执行，整个运行期间开启 tracemalloc
+
+    cProfile 只统计阶段所在的线程；结束时各阶段的结果分别保存为 <阶段>.pstats，
+    并合并为 all.pstats，内存分配最多的位置写入 tracemalloc.txt。
+    同一时间只剖析一个阶段：Python 3.12 起同时启用第二个 cProfile 会抛出 ValueError，
+    与正在剖析的阶段并行执行的阶段不剖析，名称记录在 profile.txt 中。
+    """
+    def __init__(self, output_dir, tracemalloc_frames=10, top=30):
+        self.output_dir = output_dir
+        self.tracemalloc_frames = tracemalloc_frames
+        self.top = top
+        self._lock = threading.Lock()
+        self._files = []
+        self._active = False
+        self._skipped = []
+
+    def run_stage(self, name, func, *args, **kwargs):
+        """在 cProfile 下执行阶段函数，其他阶段正在剖析时直接执行"""
+        with self._lock:
+            if self._active:
+                self._skipped.append(name)
+                profile = None
+            else:
+                self._active = True
+                profile = cProfile.Profile()
+        if profile is None:
+            return func(*args, **kwargs)
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            path = os.path.join(self.output_dir, f"{name}.pstats")
+            profile.dump_stats(path)
+            with self._lock:
+                self._files.append(path)
+                self._active = False
+
+    def __enter__(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        tracemalloc.start(self.tracemalloc_frames)
+        return self
+
+    def __exit__(self, *exc):
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        with open(os.path.join(self.output_dir, 'tracemalloc.txt'), 'w', encoding='utf-8') as f:
+            f.write(f"traced current: {format_bytes(current)}, peak: {format_bytes(peak)}\n\n")
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                f.write(f"{stat}\n")
+
+        if self._files:
+            stats = pstats.Stats(*self._files, stream=io.StringIO())
+            stats.dump_stats(os.path.join(self.output_dir, 'all.pstats'))
+            report = io.StringIO()
+            pstats.Stats(os.path.join(self.output_dir, 'all.pstats'), stream=report) \
+                .sort_stats('cumulative').print_stats(self.top)
+            with open(os.path.join(self.output_dir, 'profile.txt'), 'w', encoding='utf-8') as f:
+                if self._skipped:
+                    f.write(f"not profiled (ran concurrently with a profiled stage): {', '.join(self._skipped)}\n\n")
+                f.write(report.getvalue())
+        print(f"性能剖析结果已保存到: {self.output_dir}")
+        return False
+
+_profiler = None
+
+def set_profiler(profiler):
+    """设置当前运行使用的剖析器（None表示关闭）"""
+    global _profiler
+    _profiler = profiler
+
+def get_profiler():
+    return _profiler
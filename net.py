@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+import uuid
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import record_remote
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(name='default', pool_size=10):
+    """获取按名称共享的 requests.Session
+
+    同一名称的会话在进程内复用，保持与服务器的长连接，
+    连接池大小应不小于对应服务的并发数。
+
+    Args:
+        name (str): 会话名称，例如 'whisper'、'llm'
+        pool_size (int): 每个主机的连接池大小
+
+    Returns:
+        requests.Session: 共享会话
+    """
+    with _sessions_lock:
+        session = _sessions.get(name)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            # 用于在指标中区分远程服务
+            session.service = name
+            _sessions[name] = session
+        return session
+
+class MultipartFile:
+    """以流的方式发送单个文件的 multipart/form-data 请求体
+
+    每次迭代都重新打开文件并按块读取，因此可以直接用于 post_with_retries 的重试，
+    请求体不会整体读入内存；长度事先计算好，requests 据此设置 Content-Length。
+
+    用法：
+        body = MultipartFile('file', audio_path, 'audio/wav', fields={'response_format': 'json'})
+        post_with_retries(session, url, data=body, headers={'Content-Type': body.content_type})
+    """
+    def __init__(self, name, path, content_type, filename=None, fields=None, chunk_size=1024 * 1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        head = ''.join(f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'
+                       for key, value in (fields or {}).items())
+        head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                 f'filename="{filename or os.path.basename(path)}"\r\nContent-Type: {content_type}\r\n\r\n')
+        self.head = head.encode('utf-8')
+        self.tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+    def __len__(self):
+        return len(self.head) + os.path.getsize(self.path) + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        with open(self.path, 'rb') as f:
+            yield from iter(lambda: f.read(self.chunk_size), b'')
+        yield self.tail
+
+def post_with_retries(session, url, retries=3, backoff=1.0, **kwargs):
+    """发送POST请求，连接失败或服务器返回5xx时按指数退避重试
+
+    Args:
+        session (requests.Session): 使用的会话
+        url (str): 请求地址
+        retries (int): 最大重试次数（不含首次请求）
+        backoff (float): 首次重试前的等待时间（秒），之后每次翻倍
+        **kwargs: 传给 session.post 的参数；files 中的文件内容必须是bytes以便重发，
+            大文件改用 MultipartFile 作为 data 流式发送
+
+    Returns:
+        requests.Response: 最后一次请求的响应
+
+    Raises:
+        requests.exceptions.RequestException: 重试耗尽后仍然连接失败
+    """
+    service = getattr(session, 'service', url)
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        try:
+            response = session.post(url, **kwargs)
+            # 流式请求只统计到收到响应头为止
+            record_remote(service, time.perf_counter() - start, response.status_code < 500)
+            if response.status_code < 500 or attempt == retries:
+                return response
+            # 归还连接，否则流式请求的连接一直被占用，多次失败后连接池会被耗尽
+            response.close()
+            print(f"服务器错误 {response.status_code}，正在重试 ({attempt + 1}/{retries})...")
+        except requests.exceptions.RequestException as e:
+            record_remote(service, time.perf_counter() - start, False)
+            if attempt == retries:
+                raise
+            print(f"请求失败: {str(e)}，正在重试 ({attempt + 1}/{retries})...")
+        time.sleep(backoff * (2 ** attempt))
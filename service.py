@@ -0,0 +1,289 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import *
+from batch import VIDEO_EXTENSIONS
+from download import is_url
+from metrics import get_metrics_sink
+from governor import configure_resources, get_resource_plan
+import main
+
+class JobQueue:
+    """基于 SQLite 的持久化任务队列
+
+    服务重启时，上次处于运行中的任务会被重新放回队列。
+    """
+    def __init__(self, path=SERVICE_DB):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    input TEXT NOT NULL,
+                    source TEXT UNIQUE,
+                    status TEXT NOT NULL,
+                    stages TEXT NOT NULL DEFAULT '{}',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )""")
+            resumed = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', updated = ? WHERE status = 'running'",
+                (time.time(),)).rowcount
+        if resumed:
+            print(f"恢复了 {resumed} 个未完成的任务")
+
+    @staticmethod
+    def _to_dict(row):
+        job = dict(row)
+        job['stages'] = json.loads(job['stages'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def submit(self, input_path, source=None):
+        """加入新任务
+
+        Args:
+            input_path (str): 视频文件路径或视频URL
+            source (str): 可选的去重标识（例如监视目录中的文件及其大小和修改时间），
+                          相同标识的任务只会加入一次
+
+        Returns:
+            str: 任务ID
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            if source:
+                row = self._conn.execute("SELECT id FROM jobs WHERE source = ?", (source,)).fetchone()
+                if row:
+                    return row['id']
+            job_id = uuid.uuid4().hex
+            self._conn.execute(
+                "INSERT INTO jobs (id, input, source, status, created, updated) VALUES (?, ?, ?, 'queued', ?, ?)",
+                (job_id, input_path, source, now, now))
+            return job_id
+
+    def claim(self):
+        """取出最早加入的排队任务并标记为运行中
+
+        Returns:
+            dict: 任务信息，没有排队任务时返回None
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1").fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE jobs SET status = 'running', stages = '{}', attempts = attempts + 1, updated = ? "
+                "WHERE id = ?", (time.time(), row['id']))
+            job = self._to_dict(row)
+            job['attempts'] += 1
+            return job
+
+    def update(self, job_id, **fields):
+        """更新任务字段（stages、result 会被序列化为JSON）"""
+        for name in ('stages', 'result'):
+            if name in fields and fields[name] is not None:
+                fields[name] = json.dumps(fields[name], ensure_ascii=False)
+        fields['updated'] = time.time()
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        with self._lock, self._conn:
+            self._conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def list(self, limit=100):
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM jobs ORDER BY created DESC LIMIT ?", (limit,)).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+def expected_stages(input_path):
+    """估计任务需要经过的阶段数，用于计算进度（命中缓存的阶段会被跳过）"""
+    stages = set(main.STAGE_CATEGORIES)
+    pipeline_stages = {'download_info', 'download_audio', 'download_video'}
+    if not is_url(input_path):
+        stages -= pipeline_stages | {'download'}
+    elif DOWNLOAD_PIPELINED:
+        # 流水线下载以视频ID作为标识，不计算文件指纹
+        stages -= {'download', 'video_md5'}
+    else:
+        stages -= pipeline_stages
+    return len(stages)
+
+class VideoService:
+    """常驻服务：保持模块、连接池和缓存在进程内常驻，从队列中取任务处理"""
+    def __init__(self, queue, workers=SERVICE_WORKERS, watch_dir=SERVICE_WATCH_DIR,
+                 watch_interval=SERVICE_WATCH_INTERVAL):
+        self.queue = queue
+        self.workers = workers
+        self.watch_dir = watch_dir
+        self.watch_interval = watch_interval
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def submit(self, input_path, source=None):
+        job_id = self.queue.submit(input_path, source)
+        self._wakeup.set()
+        return job_id
+
+    def run_job(self, job):
+        """执行单个任务，阶段开始和结束时更新任务进度"""
+        stages = {}
+        total = expected_stages(job['input'])
+
+        def listener(event, name, seconds):
+            stages[name] = {'status': 'running'} if event == 'start' else {'status': 'done', 'seconds': seconds}
+            done = sum(1 for stage in stages.values() if stage['status'] == 'done')
+            self.queue.update(job['id'], stages={'progress': min(done / total, 0.99), 'detail': stages})
+
+        try:
+            result = main.main(job['input'], listener)
+            self.queue.update(job['id'], status='done', error=None,
+                              stages={'progress': 1.0, 'detail': stages},
+                              result={'md_path': result['md_path'], 'timings': dict(result['timings']),
+                                      'elapsed': result['elapsed']})
+        except Exception as e:
+            status = 'queued' if job['attempts'] < SERVICE_MAX_ATTEMPTS else 'failed'
+            self.queue.update(job['id'], status=status, error=str(e))
+
+    def worker_loop(self):
+        while not self._stop.is_set():
+            job = self.queue.claim()
+            if job is None:
+                self._wakeup.wait(1)
+                self._wakeup.clear()
+                continue
+            self.run_job(job)
+
+    def watch_loop(self):
+        """定期扫描监视目录，文件大小在两次扫描之间不再变化时才加入队列"""
+        last_sizes = {}
+        while not self._stop.wait(self.watch_interval):
+            for root, _, files in os.walk(self.watch_dir):
+                for name in files:
+                    if not name.lower().endswith(VIDEO_EXTENSIONS):
+                        continue
+                    path = os.path.abspath(os.path.join(root, name))
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    if last_sizes.get(path) == stat.st_size:
+                        self.submit(path, source=f"{path}:{stat.st_size}:{int(stat.st_mtime)}")
+                    last_sizes[path] = stat.st_size
+
+    def start(self):
+        main.set_stage_limits({
+            'download': BATCH_DOWNLOAD_CONCURRENCY,
+            'cpu': configure_resources(self.workers, BATCH_CPU_CONCURRENCY)['cpu_stages'],
+            'remote': BATCH_REMOTE_CONCURRENCY,
+        })
+        targets = [self.worker_loop] * self.workers
+        if self.watch_dir:
+            os.makedirs(self.watch_dir, exist_ok=True)
+            targets.append(self.watch_loop)
+        for target in targets:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        """停止接收新任务；正在运行的任务不等待完成，下次启动时会被重新放回队列"""
+        self._stop.set()
+        self._wakeup.set()
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """任务接口：
+    - POST /jobs      {"input": "视频路径或URL"} 提交任务
+    - GET  /jobs      列出最近的任务
+    - GET  /jobs/<id> 查询任务状态和进度
+    - GET  /metrics   各阶段累计指标（Prometheus 文本格式）
+    - GET  /resources 资源调度器检测到的核数和内存，以及分配的CPU阶段并发数和线程数
+    - GET  /health    健康检查
+    """
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        elif self.path == '/metrics':
+            body = get_metrics_sink().render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == '/resources':
+            self.send_json(200, get_resource_plan())
+        elif self.path == '/jobs':
+            self.send_json(200, service.queue.list())
+        elif self.path.startswith('/jobs/'):
+            job = service.queue.get(self.path[len('/jobs/'):])
+            self.send_json(200 if job else 404, job or {'error': "任务不存在"})
+        else:
+            self.send_json(404, {'error': f"未知路径: {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            self.send_json(404, {'error': f"未知路径: {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            input_path = request['input']
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {'error': "请求体必须是包含 input 字段的JSON"})
+            return
+        job_id = self.server.service.submit(input_path)
+        self.send_json(202, {'id': job_id, 'status': 'queued'})
+
+def serve(host=SERVICE_HOST, port=SERVICE_PORT, workers=SERVICE_WORKERS, watch_dir=SERVICE_WATCH_DIR):
+    """启动服务并阻塞，直到收到 KeyboardInterrupt"""
+    service = VideoService(JobQueue(), workers, watch_dir).start()
+    httpd = ThreadingHTTPServer((host, port), ServiceRequestHandler)
+    httpd.daemon_threads = True
+    httpd.service = service
+    print(f"服务已启动: http://{host}:{httpd.server_address[1]}")
+    if watch_dir:
+        print(f"正在监视目录: {watch_dir}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        service.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="以常驻服务的方式运行，通过HTTP接口或监视目录接收任务")
+    parser.add_argument('--host', default=SERVICE_HOST, help="监听地址")
+    parser.add_argument('--port', type=int, default=SERVICE_PORT, help="监听端口")
+    parser.add_argument('--workers', type=int, default=SERVICE_WORKERS, help="同时处理的任务数")
+    parser.add_argument('--watch-dir', default=SERVICE_WATCH_DIR, help="监视的目录，新视频会自动加入队列")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers, args.watch_dir)
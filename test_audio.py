@@ -0,0 +1,151 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import audio
+from audio import (iter_pcm_chunks, stitch_segments, transcribe_chunk, transcribe_pcm_stream, encode_wav,
+                   transcribe_audio_with_whisper_server)
+from fake_server import FakeInferenceServer
+
+SAMPLE_RATE = 16000
+
+def make_pcm(seconds, sample_rate=SAMPLE_RATE):
+    """生成 s16le 单声道测试音频：440Hz 正弦波，每10秒中最后0.5秒为静音"""
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    samples = np.sin(2 * np.pi * 440 * t) * 8000
+    samples[(t % 10) >= 9.5] = 0
+    return samples.astype('<i2').tobytes()
+
+def reader(data):
+    """将 bytes 包装为 read(n) 形式的数据源，每次最多返回 4096 字节以模拟管道"""
+    position = 0
+    def read(n):
+        nonlocal position
+        chunk = data[position:position + min(n, 4096)]
+        position += len(chunk)
+        return chunk
+    return read
+
+class PcmChunkTest(unittest.TestCase):
+    def test_fixed_chunks_overlap_and_cover_input(self):
+        pcm = make_pcm(25)
+        chunks = list(iter_pcm_chunks(reader(pcm), SAMPLE_RATE, window=10, overlap=1, split_mode='fixed'))
+
+        self.assertEqual([start for start, _ in chunks], [0.0, 10.0, 20.0])
+        self.assertEqual([len(data) / 2 / SAMPLE_RATE for _, data in chunks], [11.0, 11.0, 5.0])
+        # 去掉重叠部分后按顺序拼接应与原始数据完全一致
+        rebuilt = b''.join(data[:10 * SAMPLE_RATE * 2] for _, data in chunks[:-1]) + chunks[-1][1]
+        self.assertEqual(rebuilt, pcm)
+
+    def test_silence_split_cuts_inside_silent_gap(self):
+        pcm = make_pcm(25)
+        chunks = list(iter_pcm_chunks(reader(pcm), SAMPLE_RATE, window=12, overlap=1, split_mode='silence',
+                                      silence_search=4))
+
+        # 8~12秒的搜索范围内只有 9.5~10 秒是静音
+        self.assertGreaterEqual(chunks[1][0], 9.5)
+        self.assertLess(chunks[1][0], 10.0)
+
+class StitchSegmentsTest(unittest.TestCase):
+    def test_overlap_duplicates_are_removed(self):
+        # 两块在 9~11 秒重叠，以中点10秒为分界
+        first = {'text': '', 'segments': [
+            {'start': 0.0, 'end': 4.0, 'text': '一'},
+            {'start': 4.0, 'end': 9.4, 'text': '二'},
+            {'start': 9.4, 'end': 10.4, 'text': '三'},
+            {'start': 10.4, 'end': 11.0, 'text': '四'},
+        ]}
+        second = {'text': '', 'segments': [
+            {'start': 0.0, 'end': 0.4, 'text': '二'},
+            {'start': 0.6, 'end': 1.6, 'text': '三。'},
+            {'start': 1.6, 'end': 5.0, 'text': '四'},
+        ]}
+        segments = stitch_segments([(0.0, 11.0, first), (9.0, 15.0, second)])
+
+        self.assertEqual([seg['text'] for seg in segments], ['一', '二', '三', '四'])
+        # 第一块中心在分界之后的片段被丢弃，第二块中与前一片段文本相同的片段也被丢弃
+        self.assertEqual(segments[2]['start'], 9.4)
+        self.assertEqual(segments[3]['start'], 10.6)
+
+    def test_repeated_speech_inside_a_chunk_is_kept(self):
+        first = {'text': '', 'segments': [
+            {'start': 0.0, 'end': 2.0, 'text': '好的'},
+            {'start': 2.0, 'end': 4.0, 'text': '好的'},
+            {'start': 9.4, 'end': 10.4, 'text': '好的'},
+        ]}
+        second = {'text': '', 'segments': [
+            {'start': 0.6, 'end': 1.6, 'text': '好的'},
+            {'start': 3.0, 'end': 4.0, 'text': '好的'},
+        ]}
+        segments = stitch_segments([(0.0, 11.0, first), (9.0, 15.0, second)])
+
+        # 只有第二块中开始于重叠区间（9~11秒）的重复片段被丢弃
+        self.assertEqual([seg['start'] for seg in segments], [0.0, 2.0, 9.4, 12.0])
+
+    def test_chunk_without_segments_becomes_one_segment(self):
+        segments = stitch_segments([(0.0, 5.0, {'text': ' 整段 ', 'segments': []})])
+        self.assertEqual(segments, [{'start': 0.0, 'end': 5.0, 'text': '整段'}])
+
+class ChunkedTranscriptionTest(unittest.TestCase):
+    """对本地的假 whisper-server 进行分块转录"""
+    def setUp(self):
+        self.saved = (audio.WHISPER_SERVER_URL, audio.WHISPER_RETRIES)
+
+    def tearDown(self):
+        audio.WHISPER_SERVER_URL, audio.WHISPER_RETRIES = self.saved
+
+    def test_segments_are_stitched_in_order(self):
+        seconds = 300
+        with FakeInferenceServer(segment_seconds=5.0) as server:
+            audio.WHISPER_SERVER_URL = server.url('/inference')
+            result = transcribe_pcm_stream(reader(make_pcm(seconds)), SAMPLE_RATE)
+            requests = server.requests['/inference']
+
+        segments = result['segments']
+        self.assertEqual(requests, 3)
+        # 重叠区间只保留一份转录：片段总时长超出音频时长的部分小于全部重叠区间的总时长
+        excess = sum(seg['end'] - seg['start'] for seg in segments) - seconds
+        self.assertLess(excess, audio.WHISPER_CHUNK_OVERLAP * (requests - 1))
+        # 片段中心严格递增，相邻片段之间也没有遗漏的空隙
+        centers = [(seg['start'] + seg['end']) / 2 for seg in segments]
+        for previous, current in zip(centers, centers[1:]):
+            self.assertLess(previous, current)
+        for previous, current in zip(segments, segments[1:]):
+            self.assertGreaterEqual(previous['end'], current['start'] - 0.01)
+        self.assertAlmostEqual(segments[0]['start'], 0.0)
+        self.assertAlmostEqual(segments[-1]['end'], seconds, places=2)
+        self.assertEqual(result['text'], ' '.join(seg['text'] for seg in segments))
+
+    def test_server_errors_are_retried(self):
+        audio.WHISPER_RETRIES = 2
+        with FakeInferenceServer(fail_requests=1) as server:
+            audio.WHISPER_SERVER_URL = server.url('/inference')
+            result = transcribe_chunk(encode_wav(make_pcm(8), SAMPLE_RATE))
+            requests = server.requests['/inference']
+
+        self.assertEqual(requests, 2)
+        self.assertEqual(len(result['segments']), 2)
+
+    def test_whole_file_transcription_is_retried(self):
+        audio.WHISPER_RETRIES = 2
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            audio_path = os.path.join(tmp_dir, 'audio.wav')
+            with open(audio_path, 'wb') as f:
+                f.write(encode_wav(make_pcm(12), SAMPLE_RATE))
+            with FakeInferenceServer(fail_requests=1) as server:
+                audio.WHISPER_SERVER_URL = server.url('/inference')
+                result = transcribe_audio_with_whisper_server(audio_path)
+                requests = server.requests['/inference']
+
+        self.assertEqual(requests, 2)
+        self.assertEqual(len(result['segments']), 3)
+
+    def test_error_is_raised_when_retries_are_exhausted(self):
+        audio.WHISPER_RETRIES = 0
+        with FakeInferenceServer(failure_rate=1.0) as server:
+            audio.WHISPER_SERVER_URL = server.url('/inference')
+            with self.assertRaises(Exception):
+                transcribe_chunk(encode_wav(make_pcm(1), SAMPLE_RATE))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,55 +1,450 @@
+import json
 import os
+import re
+import threading
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from config import *
 from image import format_timestamp
+from net import get_session, post_with_retries
+from cache import LLMCache
+from checkpoint import atomic_output
+from metrics import in_current_context
+from align import split_paragraphs, is_heading, paragraph_times, segment_paragraphs, place_frames, CJK_CHAR
 
-def process_with_local_llm(text):
-    """使用本地LLM处理文本
+# 句末标点、英文句号加空白或换行都视为句子边界，分隔符保留在句子末尾
+SENTENCE_END = re.compile(r'([。！？!?；;]+|\.\s+|\n+)')
+
+def estimate_tokens(text):
+    """粗略估计文本的 token 数
+    
+    中日韩字符按每字一个 token 计算，其余字符按每4个字符一个 token 计算。
+    """
+    cjk = len(CJK_CHAR.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def split_sentences(text):
+    """按句子边界切分文本，拼接结果与原文完全一致"""
+    parts = SENTENCE_END.split(text)
+    sentences = []
+    for i in range(0, len(parts), 2):
+        sentence = parts[i] + (parts[i + 1] if i + 1 < len(parts) else '')
+        if sentence:
+            sentences.append(sentence)
+    return sentences
+
+def split_long_sentence(sentence, max_tokens):
+    """将超过上限的单个句子（例如没有标点的转录文本）按长度硬切分"""
+    pieces = []
+    tokens = estimate_tokens(sentence)
+    size = max(len(sentence) * max_tokens // max(tokens, 1), 1)
+    for start in range(0, len(sentence), size):
+        pieces.append(sentence[start:start + size])
+    return pieces
+
+def split_text_by_tokens(text, max_tokens=LLM_CHUNK_TOKENS):
+    """在句子边界上将文本切分为不超过 max_tokens 的若干块
     
     Args:
-        text (str): 需要处理的原始文本
+        text (str): 原始文本
+        max_tokens (int): 每块的最大 token 数（估算值）
         
     Returns:
-        str: 处理后的文本，如果处理失败则返回原文
+        list: 文本块列表，按顺序拼接后与原文一致
     """
-    headers = {'Content-Type': 'application/json'}
+    chunks = []
+    current = []
+    current_tokens = 0
+    for sentence in split_sentences(text):
+        for piece in (split_long_sentence(sentence, max_tokens)
+                      if estimate_tokens(sentence) > max_tokens else [sentence]):
+            piece_tokens = estimate_tokens(piece)
+            if current and current_tokens + piece_tokens > max_tokens:
+                chunks.append(''.join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append(''.join(current))
+    return chunks
+
+_llm_cache = None
+_llm_cache_lock = threading.Lock()
+
+def get_llm_cache():
+    """获取进程内共享的LLM回复缓存，未启用时返回None"""
+    global _llm_cache
+    if not LLM_CACHE_ENABLED:
+        return None
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            _llm_cache = LLMCache()
+        return _llm_cache
+
+def cached_response(messages):
+    """查询LLM回复缓存
     
-    # 构造请求数据
+    Returns:
+        tuple: (缓存键, 命中时为 (回复内容, usage)，否则为None)；未启用缓存时缓存键为None
+    """
+    cache = get_llm_cache()
+    if cache is None:
+        return None, None
+    key = LLMCache.make_key(LLM_MODEL, messages, LLM_TEMPERATURE, LLM_MAX_TOKENS)
+    # 跳过读取时仍然写入，相当于刷新缓存
+    return key, None if LLM_CACHE_BYPASS else cache.get(key)
+
+def print_llm_cache_stats():
+    """打印LLM回复缓存的命中统计"""
+    cache = get_llm_cache()
+    if cache is not None:
+        stats = cache.stats()
+        print(f"LLM缓存: 命中 {stats['hits']}, 未命中 {stats['misses']}, "
+              f"共 {stats['entries']} 条 ({stats['size'] / 1024 / 1024:.1f}MB)")
+
+def build_llm_request(messages, **extra):
+    """构造LLM请求数据"""
     data = {
-        'messages': [
-            {
-                'role': 'system',
-                'content': ROLE_PROMPT
-            },
-            {
-                'role': 'user',
-                'content': PROMPT_TEMPLATE.format(text=text)
-            }
-        ],
+        'messages': messages,
         'temperature': LLM_TEMPERATURE,
-        'max_tokens': LLM_MAX_TOKENS
+        'max_tokens': LLM_MAX_TOKENS,
+        **extra
     }
+    if LLM_MODEL:
+        data['model'] = LLM_MODEL
+    return data
+
+def build_messages(text, template=PROMPT_TEMPLATE):
+    """构造发送给LLM的消息列表"""
+    return [
+        {
+            'role': 'system',
+            'content': ROLE_PROMPT
+        },
+        {
+            'role': 'user',
+            'content': template.format(text=text)
+        }
+    ]
+
+def request_llm(messages):
+    """向本地LLM发送一次请求
+    
+    Returns:
+        tuple: (回复内容, usage 字典；服务器未返回时为空字典)
+        
+    Raises:
+        Exception: 请求失败或返回格式不正确
+    """
+    key, hit = cached_response(messages)
+    if hit is not None:
+        content, usage = hit
+        return content, {**usage, 'cached': True}
+    
+    # 构造请求数据
+    data = build_llm_request(messages)
     
     try:
-        response = requests.post(LLM_SERVER_URL, 
-                               headers=headers, 
-                               json=data)
+        session = get_session('llm', LLM_CONCURRENCY)
+        response = post_with_retries(session, LLM_SERVER_URL,
+                                     retries=LLM_RETRIES,
+                                     headers={'Content-Type': 'application/json'},
+                                     json=data,
+                                     timeout=LLM_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        raise Exception(f"LLM服务器连接失败: {str(e)}")
+    
+    if response.status_code != 200:
+        raise Exception(f"LLM处理失败: {response.text}")
+    
+    result = response.json()
+    content, usage = result['choices'][0]['message']['content'], result.get('usage') or {}
+    if key is not None:
+        get_llm_cache().put(key, content, usage)
+    return content, usage
+
+def stream_llm(messages, on_token):
+    """以流式（server-sent events）方式请求本地LLM
+    
+    Args:
+        messages (list): 消息列表
+        on_token (callable): 每收到一段增量文本时调用 on_token(text)
         
-        if response.status_code == 200:
-            result = response.json()
-            return result['choices'][0]['message']['content']
-        else:
-            print(f"LLM处理失败: {response.text}")
-            return text  # 处理失败时返回原文
+    Returns:
+        tuple: (完整回复内容, 统计信息 {'ttft', 'elapsed', 'completion_tokens'})
+        
+    Raises:
+        Exception: 请求失败或流中断
+    """
+    start = time.perf_counter()
+    key, hit = cached_response(messages)
+    if hit is not None:
+        content, usage = hit
+        on_token(content)
+        return content, {
+            'ttft': time.perf_counter() - start,
+            'elapsed': time.perf_counter() - start,
+            'completion_tokens': usage.get('completion_tokens', estimate_tokens(content)),
+            'cached': True,
+        }
+    
+    data = build_llm_request(messages, stream=True, stream_options={'include_usage': True})
+    
+    ttft = None
+    parts = []
+    events = 0
+    usage = {}
+    finished = False
+    try:
+        session = get_session('llm', LLM_CONCURRENCY)
+        with post_with_retries(session, LLM_SERVER_URL,
+                               retries=LLM_RETRIES,
+                               headers={'Content-Type': 'application/json'},
+                               json=data,
+                               stream=True,
+                               timeout=LLM_TIMEOUT) as response:
+            if response.status_code != 200:
+                raise Exception(f"LLM处理失败: {response.text}")
             
+            response.encoding = 'utf-8'
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                payload = line[len('data:'):].strip()
+                if payload == '[DONE]':
+                    finished = True
+                    break
+                event = json.loads(payload)
+                usage = event.get('usage') or usage
+                for choice in event.get('choices') or []:
+                    finished = finished or bool(choice.get('finish_reason'))
+                    content = (choice.get('delta') or {}).get('content')
+                    if content:
+                        if ttft is None:
+                            ttft = time.perf_counter() - start
+                        events += 1
+                        parts.append(content)
+                        on_token(content)
     except requests.exceptions.RequestException as e:
-        print(f"LLM服务器连接失败: {str(e)}")
-        return text
+        raise Exception(f"LLM服务器连接失败: {str(e)}")
+    
+    if not finished:
+        # 没有收到 [DONE] 或 finish_reason 说明连接中途断开，不能把截断的回复当作结果
+        raise Exception("LLM流式输出意外中断")
+    content = ''.join(parts)
+    if key is not None:
+        get_llm_cache().put(key, content, usage)
+    return content, {
+        'ttft': ttft,
+        'elapsed': time.perf_counter() - start,
+        'completion_tokens': usage.get('completion_tokens', events),
+    }
+
+def process_llm_chunk(index, total, chunk, template=PROMPT_TEMPLATE):
+    """处理单个文本块并记录耗时和 token 数
+    
+    Returns:
+        tuple: (处理后的文本, 是否成功)；失败且允许回退时返回原文
+    """
+    start = time.perf_counter()
+    try:
+        content, usage = request_llm(build_messages(chunk, template))
+    except Exception as e:
+        print(f"LLM块 {index}/{total} 处理失败: {str(e)}")
+        if not LLM_FALLBACK_TO_RAW:
+            raise
+        return chunk, False
+    
+    if usage.get('cached'):
+        print(f"LLM块 {index}/{total}: 命中缓存")
+        return content, True
+    
+    elapsed = time.perf_counter() - start
+    prompt_tokens = usage.get('prompt_tokens', estimate_tokens(chunk))
+    completion_tokens = usage.get('completion_tokens', estimate_tokens(content))
+    print(f"LLM块 {index}/{total}: 输入 {prompt_tokens} tokens, 输出 {completion_tokens} tokens, "
+          f"耗时 {elapsed:.2f}s, {completion_tokens / elapsed if elapsed else 0:.1f} tokens/s")
+    return content, True
+
+def process_text_with_llm(text):
+    """分块并发处理长文本（map），按原顺序拼接，可选再做一次合并整理（reduce）
+    
+    Args:
+        text (str): 需要处理的原始文本
+        
+    Returns:
+        tuple: (处理后的文本, 失败的块数)
+    """
+    chunks = split_text_by_tokens(text, LLM_CHUNK_TOKENS)
+    if not chunks:
+        return text, 0
+    if len(chunks) > 1:
+        print(f"文本较长，分为 {len(chunks)} 块处理")
+    
+    with ThreadPoolExecutor(max_workers=LLM_CONCURRENCY) as executor:
+        results = list(executor.map(in_current_context(process_llm_chunk), range(1, len(chunks) + 1),
+                                    [len(chunks)] * len(chunks), chunks, [PROMPT_TEMPLATE] * len(chunks)))
+    
+    processed_text = "\n\n".join(content.strip() for content, _ in results)
+    failures = sum(1 for _, ok in results if not ok)
+    
+    if LLM_MERGE_PASS and len(chunks) > 1 and not failures:
+        if estimate_tokens(processed_text) <= LLM_MERGE_MAX_TOKENS:
+            print("正在合并整理各块的处理结果...")
+            merged, ok = process_llm_chunk(1, 1, processed_text, MERGE_PROMPT_TEMPLATE)
+            if ok:
+                processed_text = merged
+        else:
+            print("处理结果过长，跳过合并整理")
+    
+    print_llm_cache_stats()
+    return processed_text, failures
+
+def process_with_local_llm(text):
+    """使用本地LLM处理文本
+    
+    Args:
+        text (str): 需要处理的原始文本
+        
+    Returns:
+        str: 处理后的文本，处理失败的部分保留原文
+    """
+    processed_text, _ = process_text_with_llm(text)
+    return processed_text
+
+class OrderedStreamWriter:
+    """将并发生成的多个文本块按顺序写入文件
+    
+    当前块的增量文本直接写入，后续块的文本先缓存，前一块完成后再依次写入。
+    """
+    def __init__(self, f, total, separator="\n\n"):
+        self.f = f
+        self.total = total
+        self.separator = separator
+        self.buffers = [[] for _ in range(total)]
+        self.done = [False] * total
+        self.current = 0
+        self.lock = threading.Lock()
+    
+    def write(self, index, text):
+        with self.lock:
+            if index == self.current:
+                self.f.write(text)
+                self.f.flush()
+            else:
+                self.buffers[index].append(text)
+    
+    def finish(self, index):
+        with self.lock:
+            self.done[index] = True
+            while self.current < self.total and self.done[self.current]:
+                self.current += 1
+                if self.current < self.total:
+                    self.f.write(self.separator + ''.join(self.buffers[self.current]))
+                    self.buffers[self.current] = []
+            self.f.flush()
+
+def stream_llm_chunk(writer, index, total, chunk):
+    """流式处理单个文本块，增量写入 writer
+    
+    Returns:
+        tuple: (该块处理后的文本, 是否成功)；尚未输出任何内容就失败且允许回退时返回原文
+    """
+    written = []
+    
+    def on_token(token):
+        written.append(token)
+        writer.write(index, token)
+    
+    try:
+        content, stats = stream_llm(build_messages(chunk, PROMPT_TEMPLATE), on_token)
     except Exception as e:
-        print(f"LLM处理异常: {str(e)}")
-        return text
+        print(f"LLM块 {index + 1}/{total} 处理失败: {str(e)}")
+        # 已经写出部分内容时无法回退为原文
+        if written or not LLM_FALLBACK_TO_RAW:
+            raise
+        writer.write(index, chunk)
+        writer.finish(index)
+        return chunk, False
+    
+    if stats.get('cached'):
+        print(f"LLM块 {index + 1}/{total}: 命中缓存")
+        writer.finish(index)
+        return content, True
+    
+    elapsed = stats['elapsed']
+    ttft = f"{stats['ttft']:.2f}s" if stats['ttft'] is not None else 'N/A'
+    print(f"LLM块 {index + 1}/{total}: 首个token {ttft}, 输出 {stats['completion_tokens']} tokens, "
+          f"耗时 {elapsed:.2f}s, {stats['completion_tokens'] / elapsed if elapsed else 0:.1f} tokens/s")
+    writer.finish(index)
+    return content, True
 
-def generate_markdown(text, image_paths, positions, output_md):
+def write_image_section(f, image_paths, positions, output_md):
+    """写入关键帧图片部分"""
+    # 将图片路径转换为相对于markdown文件的路径
+    relative_image_paths = [os.path.relpath(path, os.path.dirname(output_md)) for path in image_paths]
+    
+    f.write("# 关键帧图片\n\n")
+    for img_path, pos in zip(relative_image_paths, positions):
+        timestamp = format_timestamp(pos)
+        f.write(f"![关键帧 {timestamp}]({img_path})\n\n")
+
+def write_aligned_body(f, processed_text, image_paths, positions, output_md, segments):
+    """按转录时间戳将关键帧插入到正在朗读的段落前面（标题段落则放在标题后面）"""
+    if LLM_PROCESS:
+        paragraphs = split_paragraphs(processed_text)
+        times = paragraph_times(paragraphs, segments)
+    else:
+        # 未经LLM处理的原文没有分段，直接在关键帧的时间点切分转录片段
+        paragraphs, times = segment_paragraphs(segments, positions)
+    
+    relative_image_paths = [os.path.relpath(path, os.path.dirname(output_md)) for path in image_paths]
+    for paragraph, frames in zip(paragraphs, place_frames(times, positions)):
+        images = ''.join(f"![关键帧 {format_timestamp(positions[i])}]({relative_image_paths[i]})\n\n"
+                         for i in frames)
+        if is_heading(paragraph):
+            f.write(f"{paragraph}\n\n{images}")
+        else:
+            f.write(f"{images}{paragraph}\n\n")
+
+def write_markdown_body(f, processed_text, image_paths, positions, output_md, segments=None):
+    """写入正文和关键帧：FRAME_PLACEMENT 为 'inline' 且有转录片段时按时间对齐，否则图片集中放在文末"""
+    if FRAME_PLACEMENT not in ('section', 'inline'):
+        raise ValueError(f"不支持的关键帧放置方式: {FRAME_PLACEMENT}")
+    if FRAME_PLACEMENT == 'inline' and segments:
+        write_aligned_body(f, processed_text, image_paths, positions, output_md, segments)
+    else:
+        f.write(processed_text + "\n\n")
+        write_image_section(f, image_paths, positions, output_md)
+
+def generate_markdown_streaming(text, image_paths, positions, output_md):
+    """以流式方式调用LLM，边接收边写入 Markdown 文件
+    
+    内容先写入同目录下的临时文件，完成后原子地重命名为目标文件，
+    因此目标文件要么是旧的完整文件，要么是新的完整文件。
+    关键帧总是集中写在文末；按时间对齐需要完整的段落，由调用方在完成后用 render_markdown 重新生成。
+    
+    Returns:
+        tuple: (处理后的文本, 失败的块数)
+    """
+    chunks = split_text_by_tokens(text, LLM_CHUNK_TOKENS) or [text]
+    if len(chunks) > 1:
+        print(f"文本较长，分为 {len(chunks)} 块流式处理")
+    
+    with atomic_output(output_md) as tmp_path:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            writer = OrderedStreamWriter(f, len(chunks))
+            stream_chunk = in_current_context(lambda i: stream_llm_chunk(writer, i, len(chunks), chunks[i]))
+            with ThreadPoolExecutor(max_workers=LLM_CONCURRENCY) as executor:
+                results = list(executor.map(stream_chunk, range(len(chunks))))
+            f.write("\n\n")
+            write_image_section(f, image_paths, positions, output_md)
+    
+    print_llm_cache_stats()
+    return "\n\n".join(content for content, _ in results), sum(1 for _, ok in results if not ok)
+
+def generate_markdown(text, image_paths, positions, output_md, segments=None):
     """生成 Markdown 文件
     
     Args:
@@ -57,37 +452,48 @@ def generate_markdown(text, image_paths, positions, output_md):
         image_paths (list): 图片文件路径列表
         positions (list): 图片对应的视频时间戳列表
         output_md (str): 输出的markdown文件路径
+        segments (list): 可选，带时间戳的转录片段，用于将关键帧插入到对应段落
     """
+    if LLM_PROCESS and LLM_STREAM:
+        processed_text, _ = generate_markdown_streaming(text, image_paths, positions, output_md)
+        if FRAME_PLACEMENT == 'inline' and segments:
+            render_markdown(processed_text, image_paths, positions, output_md, segments)
+        return
+    
     # 使用LLM处理文本
     if LLM_PROCESS:
         processed_text = process_with_local_llm(text)
     else:
         processed_text = text
     
-    # 将图片路径转换为相对于markdown文件的路径
-    relative_image_paths = [os.path.relpath(path, os.path.dirname(output_md)) for path in image_paths]
+    render_markdown(processed_text, image_paths, positions, output_md, segments)
+
+def render_markdown(processed_text, image_paths, positions, output_md, segments=None):
+    """将处理后的文本和关键帧写入 Markdown 文件（先写临时文件再原子重命名）
     
-    with open(output_md, 'w', encoding='utf-8') as f:
-        f.write(processed_text + "\n\n")
-        f.write("# 关键帧图片\n\n")
-        for img_path, pos in zip(relative_image_paths, positions):
-            timestamp = format_timestamp(pos)
-            f.write(f"![关键帧 {timestamp}]({img_path})\n\n")
+    Args:
+        processed_text (str): LLM处理后（或原始）的文本
+        image_paths (list): 图片文件路径列表
+        positions (list): 图片对应的视频时间戳列表
+        output_md (str): 输出的markdown文件路径
+        segments (list): 可选，带时间戳的转录片段，FRAME_PLACEMENT 为 'inline' 时用于对齐关键帧
+    """
+    with atomic_output(output_md) as tmp_path:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            write_markdown_body(f, processed_text, image_paths, positions, output_md, segments)
 
 def save_text(text, txt_path):
-    """保存文本到文件
+    """保存文本到文件（先写临时文件再原子重命名）
     
     Args:
         text (str): 要保存的文本内容
         txt_path (str): 文本文件保存路径
     """
     try:
-        # 确保目录存在
-        os.makedirs(os.path.dirname(txt_path), exist_ok=True)
-        
         # 保存文本文件
-        with open(txt_path, 'w', encoding='utf-8') as f:
-            f.write(text)
+        with atomic_output(txt_path) as tmp_path:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
             
     except Exception as e:
         raise Exception(f"保存文本文件失败: {str(e)}")
\ No newline at end of file
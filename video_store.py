@@ -0,0 +1,306 @@
+import contextvars
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import lru_cache
+import yt_dlp
+from config import *
+
+try:
+    import fcntl
+except ImportError:  # Windows 上只在进程内互斥
+    fcntl = None
+
+META_FILE = 'meta.json'
+
+@lru_cache(maxsize=1024)
+def url_video_id(url):
+    """不请求网络，根据URL确定平台和视频ID
+
+    使用 yt_dlp 提取器的URL规则（InfoExtractor.get_temp_id）；
+    没有专用提取器或无法从URL中解析ID时，使用URL的哈希作为ID。
+
+    Returns:
+        tuple: (平台, 视频ID)
+    """
+    for ie in yt_dlp.extractor.gen_extractor_classes():
+        if ie.ie_key() == 'Generic' or not ie.suitable(url):
+            continue
+        video_id = ie.get_temp_id(url)
+        if video_id:
+            return ie.ie_key(), video_id
+        break
+    return 'Generic', hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+
+_leases = contextvars.ContextVar('video_store_leases', default=None)
+
+@contextmanager
+def holding_videos():
+    """在上下文中从视频存储获取的视频都持有共享锁，直到退出上下文，期间不会被LRU淘汰
+
+    一个任务在处理期间应始终处于该上下文中。在线程池中获取视频时，
+    提交的函数需要用 metrics.in_current_context 包装才能沿用同一个上下文。
+    """
+    leases = []
+    token = _leases.set(leases)
+    try:
+        yield
+    finally:
+        _leases.reset(token)
+        for release in leases:
+            release()
+
+class VideoStore:
+    """按平台和视频ID寻址的共享视频存储
+
+    每个视频（及下载格式）对应 VIDEO_STORE_DIR 下的一个目录，包含下载的文件和 meta.json。
+    下载在临时目录中进行，完成后整体重命名发布，因此只要 meta.json 存在条目就是完整的。
+    每个条目有一个锁文件：下载和淘汰持有排他锁，正在使用条目的任务（holding_videos）持有共享锁，
+    因此并发请求同一视频时只有一个下载，正在解码的视频也不会被淘汰。
+    meta.json 的修改时间作为最近访问时间，总容量超过上限时按最近最少使用淘汰。
+    没有 fcntl 的系统上只在进程内互斥。
+    """
+    _thread_locks = {}  # 条目目录 -> [线程锁, 使用者数]，仅在没有 fcntl 时使用
+    _in_use = {}  # 条目目录 -> 进程内持有共享锁的任务数，仅在没有 fcntl 时使用
+    _thread_locks_guard = threading.Lock()
+
+    def __init__(self, store_dir=VIDEO_STORE_DIR, max_size_mb=VIDEO_STORE_MAX_SIZE_MB):
+        self.store_dir = store_dir
+        self.max_size = max_size_mb * 1024 * 1024 if max_size_mb else None
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    def entry_dir(self, platform, video_id, format_spec):
+        format_hash = hashlib.sha256(format_spec.encode('utf-8')).hexdigest()[:12]
+        safe_id = ''.join(c if c.isalnum() or c in '-_' else '_' for c in str(video_id))
+        return os.path.join(self.store_dir, platform.lower(), f"{safe_id}-{format_hash}")
+
+    def _flock(self, entry_dir, mode, blocking=True):
+        """获取条目锁文件上的 flock，返回打开的锁文件（关闭即释放）；非阻塞获取失败时返回None
+
+        淘汰条目时会删除锁文件，等待期间锁文件被删除时重新打开新的锁文件再获取。
+        """
+        path = f"{entry_dir}.lock"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        while True:
+            lock_file = open(path, 'a')
+            try:
+                fcntl.flock(lock_file, mode | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                lock_file.close()
+                return None
+            except BaseException:
+                lock_file.close()
+                raise
+            try:
+                if os.fstat(lock_file.fileno()).st_ino == os.stat(path).st_ino:
+                    return lock_file
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+
+    @contextmanager
+    def _locked(self, entry_dir, blocking=True):
+        """获取条目的排他锁，非阻塞获取失败时返回False"""
+        if fcntl is not None:
+            lock_file = self._flock(entry_dir, fcntl.LOCK_EX, blocking)
+            if lock_file is None:
+                yield False
+                return
+            with lock_file:
+                yield True
+            return
+
+        with self._thread_locks_guard:
+            entry = self._thread_locks.setdefault(entry_dir, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            if not entry[0].acquire(blocking):
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                entry[0].release()
+        finally:
+            # 没有使用者时删除，避免字典随条目数量无限增长
+            with self._thread_locks_guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._thread_locks[entry_dir]
+
+    def _hold(self, entry_dir):
+        """在 holding_videos 上下文中获取条目的共享锁
+
+        Returns:
+            callable: 释放共享锁的函数；不在上下文中时返回None
+        """
+        if _leases.get() is None:
+            return None
+        if fcntl is not None:
+            return self._flock(entry_dir, fcntl.LOCK_SH).close
+
+        with self._thread_locks_guard:
+            self._in_use[entry_dir] = self._in_use.get(entry_dir, 0) + 1
+
+        def release():
+            with self._thread_locks_guard:
+                self._in_use[entry_dir] -= 1
+                if not self._in_use[entry_dir]:
+                    del self._in_use[entry_dir]
+        return release
+
+    def _read_entry(self, entry_dir):
+        """读取条目的文件路径，不存在或文件不完整时返回None"""
+        meta_path = os.path.join(entry_dir, META_FILE)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        path = os.path.join(entry_dir, meta['file'])
+        if not os.path.exists(path) or os.path.getsize(path) != meta['size']:
+            return None
+        # 更新访问时间用于LRU淘汰
+        os.utime(meta_path, None)
+        return path
+
+    def lookup(self, platform, video_id, format_spec):
+        """查询已下载的视频，不存在或文件不完整时返回None
+
+        在 holding_videos 上下文中查询到的视频持有共享锁直到退出上下文。
+        """
+        entry_dir = self.entry_dir(platform, video_id, format_spec)
+        # 先获取共享锁再检查，避免检查后、获取锁之前条目被淘汰
+        release = self._hold(entry_dir)
+        path = self._read_entry(entry_dir)
+        if release:
+            if path:
+                _leases.get().append(release)
+            else:
+                release()
+        return path
+
+    def fetch(self, platform, video_id, format_spec, download, source=None):
+        """获取视频文件，存储中没有时调用 download 下载
+
+        Args:
+            platform (str): 平台名称（yt_dlp 提取器名称）
+            video_id (str): 视频ID
+            format_spec (str): 下载格式，不同格式分别存储
+            download (callable): download(outtmpl) 下载到给定的文件名模板并返回文件路径
+            source (str): 可选，记录在 meta.json 中的来源URL
+
+        Returns:
+            str: 存储中的视频文件路径
+        """
+        entry_dir = self.entry_dir(platform, video_id, format_spec)
+        while True:
+            path = self.lookup(platform, video_id, format_spec)
+            if path:
+                return path
+
+            with self._locked(entry_dir):
+                # 等待锁期间其他任务可能已经下载完成
+                if self._read_entry(entry_dir):
+                    continue
+
+                tmp_dir = f"{entry_dir}.tmp-{uuid.uuid4().hex}"
+                os.makedirs(tmp_dir)
+                try:
+                    downloaded = download(os.path.join(tmp_dir, '%(title).100B.%(ext)s'))
+                    name = os.path.basename(downloaded)
+                    with open(os.path.join(tmp_dir, META_FILE), 'w', encoding='utf-8') as f:
+                        json.dump({'platform': platform, 'id': video_id, 'format': format_spec,
+                                   'source': source, 'file': name, 'size': os.path.getsize(downloaded),
+                                   'created': time.time()}, f, ensure_ascii=False)
+                    # 残留的不完整条目（没有 meta.json）直接替换
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                    os.rename(tmp_dir, entry_dir)
+                finally:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+            self.evict(keep=entry_dir)
+            # 下一轮获取共享锁后返回；释放排他锁后条目极少数情况下可能被其他进程淘汰，此时重新下载
+
+    def _entries(self):
+        """列出所有条目：(最近访问时间, 占用字节数, 目录)"""
+        entries = []
+        for platform in os.listdir(self.store_dir):
+            platform_dir = os.path.join(self.store_dir, platform)
+            if not os.path.isdir(platform_dir):
+                continue
+            for name in os.listdir(platform_dir):
+                entry_dir = os.path.join(platform_dir, name)
+                meta_path = os.path.join(entry_dir, META_FILE)
+                if not os.path.exists(meta_path):
+                    continue
+                size = sum(os.path.getsize(os.path.join(entry_dir, f))
+                           for f in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(meta_path), size, entry_dir))
+        return entries
+
+    def _remove_stale_locks(self):
+        """删除已没有对应条目的锁文件（例如下载失败后残留的），正在使用的锁文件不会被删除"""
+        if fcntl is None:
+            return
+        for platform in os.listdir(self.store_dir):
+            platform_dir = os.path.join(self.store_dir, platform)
+            if not os.path.isdir(platform_dir):
+                continue
+            for name in os.listdir(platform_dir):
+                entry_dir = os.path.join(platform_dir, name[:-len('.lock')])
+                if not name.endswith('.lock') or os.path.exists(entry_dir):
+                    continue
+                with self._locked(entry_dir, blocking=False) as acquired:
+                    if acquired and not os.path.exists(entry_dir):
+                        os.remove(f"{entry_dir}.lock")
+
+    def evict(self, keep=None):
+        """总容量超过上限时按最长未访问时间淘汰条目
+
+        正在下载或正在被任务使用（持有共享锁）的条目不会被淘汰。
+
+        Args:
+            keep (str): 不淘汰的条目目录（通常是刚刚下载的视频）
+
+        Returns:
+            int: 被淘汰的条目数
+        """
+        self._remove_stale_locks()
+        if not self.max_size:
+            return 0
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, entry_dir in entries:
+            if total <= self.max_size:
+                break
+            if entry_dir == keep or entry_dir in self._in_use:
+                continue
+            with self._locked(entry_dir, blocking=False) as acquired:
+                if not acquired:
+                    continue
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                if fcntl is not None:
+                    # 持有排他锁时删除锁文件，等待该锁的任务会重新打开新的锁文件
+                    os.remove(f"{entry_dir}.lock")
+            total -= size
+            removed += 1
+        return removed
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_video_store():
+    """获取进程内共享的视频存储"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = VideoStore()
+        return _store